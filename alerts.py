@@ -0,0 +1,306 @@
+"""Alert rules evaluated on readings as they are stored.
+
+The process that commits readings hands every committed group to
+AlertEngine.observe(), which updates a small fixed-size state per sensor and
+never reads the database:
+
+- category: the mean AQI of a sensor's last ALERT_WINDOW readings moved into
+  another EPA category. CO2-only readings count with the AQI the sender
+  derives from CO2 (see aqi.from_co2).
+- co2_high: CO2 rose to ALERT_CO2_PPM or above, after being below it.
+- co2_spike: CO2 rose more than ALERT_CO2_SPIKE_SIGMA standard deviations,
+  and at least ALERT_CO2_SPIKE_PPM, above its exponentially weighted moving
+  average (ALERT_EWMA_ALPHA), once the average has seen a few readings.
+- stale: a sensor sent nothing for ALERT_STALE_SECONDS, and recovered when it
+  reports again. Only sensors seen by this process since it started are
+  watched.
+
+Readings older than a sensor's newest one, such as a device catching up on
+buffered data, keep the sensor from going stale but are not evaluated.
+
+An event that repeats one from the last ALERT_DEDUP_SECONDS (same sensor,
+rule and category) is dropped, and no more than ALERT_RATE_PER_MINUTE events
+go out overall. Events are sent from a background thread, as JSON, to
+ALERT_WEBHOOK_URL (a POST per event) or as lines appended to ALERT_LOG ('-'
+for stdout). With neither set alerting is off.
+"""
+import bisect
+import collections
+import json
+import math
+import os
+import queue
+import sys
+import threading
+import time
+import urllib.request
+
+import aqi
+import categories
+import rollups
+import telemetry
+
+WEBHOOK_URL = os.environ.get('ALERT_WEBHOOK_URL')
+LOG_PATH = os.environ.get('ALERT_LOG')
+WINDOW = int(os.environ.get('ALERT_WINDOW', 5))
+CO2_PPM = float(os.environ.get('ALERT_CO2_PPM', 1500))
+CO2_SPIKE_SIGMA = float(os.environ.get('ALERT_CO2_SPIKE_SIGMA', 4))
+CO2_SPIKE_PPM = float(os.environ.get('ALERT_CO2_SPIKE_PPM', 200))
+EWMA_ALPHA = float(os.environ.get('ALERT_EWMA_ALPHA', 0.1))
+STALE_SECONDS = float(os.environ.get('ALERT_STALE_SECONDS', 900))
+DEDUP_SECONDS = float(os.environ.get('ALERT_DEDUP_SECONDS', 600))
+RATE_PER_MINUTE = float(os.environ.get('ALERT_RATE_PER_MINUTE', 60))
+
+# Readings the CO2 average needs before spikes are judged against it
+EWMA_WARMUP = 10
+# Events waiting for the sink; more are dropped
+QUEUE_SIZE = 1000
+WEBHOOK_TIMEOUT_SECONDS = 5
+
+_BREAKPOINTS = aqi.BREAKPOINTS.tolist()
+
+telemetry.describe('alerts_sent_total', 'counter', 'Alerts handed to the sink')
+telemetry.describe('alerts_suppressed_total', 'counter', 'Alerts dropped as duplicates, over the rate limit or failed')
+
+
+class SensorState:
+    __slots__ = ('recent', 'recent_sum', 'category', 'co2_mean', 'co2_var', 'co2_count', 'co2_high',
+                 'last_ts', 'last_seen', 'stale')
+
+    def __init__(self, window):
+        self.recent = collections.deque(maxlen=window)
+        self.recent_sum = 0.0
+        self.category = None
+        self.co2_mean = 0.0
+        self.co2_var = 0.0
+        self.co2_count = 0
+        # None until the first CO2 reading
+        self.co2_high = None
+        self.last_ts = None
+        self.last_seen = 0.0
+        self.stale = False
+
+
+def _present(value):
+    return value is not None and not math.isnan(value)
+
+
+def _category(value):
+    return categories.NAMES[bisect.bisect_left(_BREAKPOINTS, value)]
+
+
+class AlertEngine:
+    def __init__(self, send=None, window=WINDOW, stale_seconds=STALE_SECONDS,
+                 dedup_seconds=DEDUP_SECONDS, rate_per_minute=RATE_PER_MINUTE, clock=time.monotonic):
+        """send(event) delivers one event; the default follows ALERT_WEBHOOK_URL and ALERT_LOG"""
+        self._send = send or default_sink()
+        self.enabled = self._send is not None
+        self.window = window
+        self.stale_seconds = stale_seconds
+        self.dedup_seconds = dedup_seconds
+        self.rate_per_minute = rate_per_minute
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._sensors = {}
+        # Sensors in the order they last reported, the longest silent first
+        self._silence = collections.OrderedDict()
+        self._last_sent = {}
+        self._tokens = rate_per_minute
+        self._refilled = clock()
+
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._thread = None
+        self._stopping = False
+
+    def observe(self, rows):
+        """Evaluate committed (sensor_id, aqi_value, co2_ppm, aqi_category, ts) rows"""
+        if not self.enabled:
+            return
+        now = self._clock()
+        events = []
+        with self._lock:
+            for row in rows:
+                self._evaluate(row, now, events)
+        self._start()
+        for event in events:
+            self._emit(event, now)
+
+    def _evaluate(self, row, now, events):
+        sensor_id, aqi_value, co2_ppm, _, ts = row[:5]
+        state = self._sensors.get(sensor_id)
+        if state is None:
+            state = self._sensors[sensor_id] = SensorState(self.window)
+        state.last_seen = now
+        self._silence[sensor_id] = None
+        self._silence.move_to_end(sensor_id)
+        if state.stale:
+            state.stale = False
+            events.append(self._event('recovered', sensor_id, ts, "Sensor reports again"))
+
+        if state.last_ts is not None and ts < state.last_ts:
+            return
+        state.last_ts = ts
+
+        if not _present(aqi_value) and _present(co2_ppm):
+            aqi_value = float(aqi.from_co2(co2_ppm))
+        if _present(aqi_value):
+            if len(state.recent) == state.recent.maxlen:
+                state.recent_sum -= state.recent[0]
+            state.recent.append(aqi_value)
+            state.recent_sum += aqi_value
+            mean = state.recent_sum / len(state.recent)
+            category = _category(mean)
+            if state.category is not None and category != state.category:
+                events.append(self._event('category', sensor_id, ts,
+                                          f"AQI {mean:.0f} is {category}, was {state.category}",
+                                          key=category, aqi=round(mean, 1),
+                                          category=category, previous=state.category))
+            state.category = category
+
+        if _present(co2_ppm):
+            high = co2_ppm >= CO2_PPM
+            if high and state.co2_high is False:
+                events.append(self._event('co2_high', sensor_id, ts,
+                                          f"CO2 {co2_ppm:.0f} ppm is at or above {CO2_PPM:.0f} ppm",
+                                          co2_ppm=co2_ppm))
+            state.co2_high = high
+
+            # Judged against the average before this reading
+            rise = co2_ppm - state.co2_mean
+            if (state.co2_count >= EWMA_WARMUP and rise >= CO2_SPIKE_PPM
+                    and rise > CO2_SPIKE_SIGMA * math.sqrt(state.co2_var)):
+                events.append(self._event('co2_spike', sensor_id, ts,
+                                          f"CO2 {co2_ppm:.0f} ppm is {rise:.0f} ppm above its average",
+                                          co2_ppm=co2_ppm, average=round(state.co2_mean, 1)))
+            if state.co2_count == 0:
+                state.co2_mean = co2_ppm
+            else:
+                # Exponentially weighted mean and variance, updated in place
+                state.co2_var = (1 - EWMA_ALPHA) * (state.co2_var + EWMA_ALPHA * rise * rise)
+                state.co2_mean += EWMA_ALPHA * rise
+            state.co2_count += 1
+
+    def _event(self, rule, sensor_id, ts, message, key=None, **details):
+        event = {'rule': rule, 'sensor_id': sensor_id, 'timestamp': rollups.ms_to_iso(ts),
+                 'message': message}
+        event.update(details)
+        # Not sent; tells duplicates apart
+        event['_key'] = (sensor_id, rule, key)
+        return event
+
+    def check_stale(self):
+        """Raise stale alerts for sensors silent longer than stale_seconds"""
+        if not self.enabled or self.stale_seconds <= 0:
+            return
+        now = self._clock()
+        events = []
+        with self._lock:
+            while self._silence:
+                sensor_id = next(iter(self._silence))
+                state = self._sensors[sensor_id]
+                if now - state.last_seen < self.stale_seconds:
+                    break
+                del self._silence[sensor_id]
+                state.stale = True
+                events.append(self._event('stale', sensor_id, state.last_ts,
+                                          f"No readings for {now - state.last_seen:.0f} seconds"))
+        for event in events:
+            self._emit(event, now)
+
+    def forget(self, sensor_id):
+        with self._lock:
+            self._sensors.pop(sensor_id, None)
+            self._silence.pop(sensor_id, None)
+
+    def _emit(self, event, now):
+        key = event.pop('_key')
+        rule = (('rule', event['rule']),)
+        with self._lock:
+            sent = self._last_sent.get(key)
+            if sent is not None and now - sent < self.dedup_seconds:
+                telemetry.inc('alerts_suppressed_total', rule + (('reason', 'duplicate'),))
+                return
+            self._tokens = min(self.rate_per_minute,
+                               self._tokens + (now - self._refilled) * self.rate_per_minute / 60)
+            self._refilled = now
+            if self._tokens < 1:
+                telemetry.inc('alerts_suppressed_total', rule + (('reason', 'rate_limit'),))
+                return
+            self._tokens -= 1
+            self._last_sent[key] = now
+            if len(self._last_sent) > 4 * QUEUE_SIZE:
+                self._last_sent = {k: t for k, t in self._last_sent.items() if now - t < self.dedup_seconds}
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            telemetry.inc('alerts_suppressed_total', rule + (('reason', 'queue_full'),))
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='alerts', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        # Also the stale sensor timer: wakes up at least this often
+        interval = min(max(self.stale_seconds / 10, 1), 30) if self.stale_seconds > 0 else 30
+        next_check = self._clock() + interval
+        while not self._stopping or not self._queue.empty():
+            try:
+                event = self._queue.get(timeout=max(0.0, min(interval, next_check - self._clock())))
+            except queue.Empty:
+                event = None
+            if event is not None:
+                try:
+                    self._send(event)
+                    telemetry.inc('alerts_sent_total', (('rule', event['rule']),))
+                except Exception as e:
+                    telemetry.inc('alerts_suppressed_total', (('rule', event['rule']), ('reason', 'failed')))
+                    print(f"Alert could not be sent: {e}")
+            if self._clock() >= next_check:
+                self.check_stale()
+                next_check = self._clock() + interval
+
+    def stop(self, timeout=5):
+        """Send the queued events and stop the background thread"""
+        self._stopping = True
+        try:
+            # Wakes the thread up; a full queue keeps it busy anyway
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+def webhook_sink(url):
+    def send(event):
+        request = urllib.request.Request(url, data=json.dumps(event).encode(),
+                                         headers={'Content-Type': 'application/json'}, method='POST')
+        with urllib.request.urlopen(request, timeout=WEBHOOK_TIMEOUT_SECONDS) as response:
+            response.read()
+    return send
+
+
+def log_sink(path):
+    def send(event):
+        line = json.dumps(event, separators=(',', ':')) + '\n'
+        if path == '-':
+            sys.stdout.write(line)
+            sys.stdout.flush()
+        else:
+            with open(path, 'a') as f:
+                f.write(line)
+    return send
+
+
+def default_sink():
+    """The sink configured in the environment, or None when alerting is off"""
+    if WEBHOOK_URL:
+        return webhook_sink(WEBHOOK_URL)
+    if LOG_PATH:
+        return log_sink(LOG_PATH)
+    return None
@@ -0,0 +1,116 @@
+"""AQI classification and derived metrics over whole arrays.
+
+Every function takes and returns numpy arrays, with NaN for a missing value,
+so a page or a series is classified with one searchsorted call instead of a
+Python branch per reading.
+
+- classify() and labels() map AQI values to the EPA categories, whose codes
+  are those of the aqi_categories table (see categories).
+- from_co2() is the AQI the LoRa sender computes from its CO2 reading, for
+  readings that came with CO2 but no AQI. from_concentration() is the EPA
+  piecewise-linear AQI of PM2.5 or PM10 concentrations.
+- rolling_means() computes trailing averages, such as the 8 and 24 hour
+  windows of the EPA, for several windows in one pass over a series.
+"""
+import numpy as np
+
+import categories
+
+# Highest AQI of each category but the last, which is open-ended
+BREAKPOINTS = np.array([50, 100, 150, 200, 300], dtype=float)
+# CSS classes of the categories, in categories.NAMES order
+CLASS_NAMES = ('good', 'moderate', 'unhealthy-sensitive', 'unhealthy', 'very-unhealthy', 'hazardous')
+
+# The sender maps CO2 linearly onto the AQI scale between these concentrations
+CO2_FLOOR_PPM = 400.0
+CO2_CEILING_PPM = 5000.0
+MAX_AQI = 500
+
+# EPA breakpoints as (concentration low, concentration high, AQI low, AQI high)
+# rows, with the decimals concentrations are truncated to
+POLLUTANTS = {
+    # µg/m³, 24-hour, as revised in 2024
+    'pm25': (np.array([
+        (0.0, 9.0, 0, 50),
+        (9.1, 35.4, 51, 100),
+        (35.5, 55.4, 101, 150),
+        (55.5, 125.4, 151, 200),
+        (125.5, 225.4, 201, 300),
+        (225.5, 325.4, 301, 500),
+    ]), 1),
+    # µg/m³, 24-hour
+    'pm10': (np.array([
+        (0, 54, 0, 50),
+        (55, 154, 51, 100),
+        (155, 254, 101, 150),
+        (255, 354, 151, 200),
+        (355, 424, 201, 300),
+        (425, 604, 301, 500),
+    ]), 0),
+}
+
+
+def as_array(values):
+    """A float array of values, with None read as NaN"""
+    return np.asarray(values, dtype=float)
+
+
+def classify(aqi):
+    """Category codes (1 for Good to 6 for Hazardous) of AQI values; 0 where missing"""
+    aqi = as_array(aqi)
+    codes = np.searchsorted(BREAKPOINTS, aqi, side='left') + 1
+    return np.where(np.isnan(aqi), 0, codes)
+
+
+def labels(aqi):
+    """(names, CSS classes) of AQI values, as lists; ('Unknown', '') where missing"""
+    names = ('Unknown',) + categories.NAMES
+    classes = ('',) + CLASS_NAMES
+    codes = classify(aqi).tolist()
+    return [names[code] for code in codes], [classes[code] for code in codes]
+
+
+def from_co2(ppm):
+    """AQI of CO2 concentrations in ppm, as sender.ino computes it"""
+    ppm = np.clip(as_array(ppm), CO2_FLOOR_PPM, CO2_CEILING_PPM)
+    return np.floor((ppm - CO2_FLOOR_PPM) * (MAX_AQI / (CO2_CEILING_PPM - CO2_FLOOR_PPM)))
+
+
+def from_concentration(values, pollutant):
+    """EPA AQI of pollutant ('pm25' or 'pm10') concentrations; NaN where missing or negative.
+
+    Concentrations are truncated to the table's precision first, and anything
+    above the top of the table is reported as 500.
+    """
+    table, decimals = POLLUTANTS[pollutant]
+    scale = 10 ** decimals
+    # The small offset keeps values such as 35.4 from truncating to 35.3
+    c = np.floor(as_array(values) * scale + 1e-9) / scale
+    row = np.minimum(np.searchsorted(table[:, 1], c, side='left'), len(table) - 1)
+    c_low, c_high, i_low, i_high = table[row].T
+    index = np.floor((i_high - i_low) / (c_high - c_low) * (np.minimum(c, c_high) - c_low) + i_low + 0.5)
+    return np.where(c >= 0, index, np.nan)
+
+
+def rolling_means(ts, values, windows):
+    """Trailing means of values over each window, at every point of a series.
+
+    ts is ascending and in the same unit as the windows. The mean at a point
+    covers the values with a time in (t - window, t], ignoring missing ones,
+    and is NaN when there are none. All windows share one pass of cumulative
+    sums. Returns one array per window.
+    """
+    ts = np.asarray(ts)
+    values = as_array(values)
+    present = ~np.isnan(values)
+    sums = np.concatenate(([0.0], np.cumsum(np.where(present, values, 0.0))))
+    counts = np.concatenate(([0], np.cumsum(present)))
+    # Points sharing a time are all inside each other's windows
+    end = np.searchsorted(ts, ts, side='right')
+    means = []
+    for window in windows:
+        start = np.searchsorted(ts, ts - window, side='right')
+        count = counts[end] - counts[start]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means.append(np.where(count > 0, (sums[end] - sums[start]) / count, np.nan))
+    return means
@@ -16,6 +16,12 @@ const char* password = "letsbagp#123";
 const char* serverUrl = "http://192.168.1.100:9090";  // Replace with your computer's local IP
 int sensorId = -1; // Will be set after registration
 
+// Each forwarded reading gets a message_id of a random boot id and a counter,
+// so the server stores a reading once however often it is retried
+uint32_t bootId = 0;
+uint32_t messageCount = 0;
+#define SEND_ATTEMPTS 3
+
 // NTP Configuration
 const char* ntpServer = "pool.ntp.org";
 const long gmtOffset_sec = 19800; // IST offset +5:30
@@ -67,6 +73,12 @@ String getTime() {
   return String(timeString);
 }
 
+// True once NTP has set the clock; doesn't wait for it
+bool timeIsSet() {
+  struct tm timeinfo;
+  return getLocalTime(&timeinfo, 0);
+}
+
 
 String translateWiFiStatus(wl_status_t status) {
   switch (status) {
@@ -131,23 +143,36 @@ bool sendDataToServer(String value) {
   http.begin(url);
   http.addHeader("Content-Type", "application/json");
   
-  StaticJsonDocument<200> doc;
+  StaticJsonDocument<256> doc;
   doc["sensor_id"] = sensorId;
   doc["value"] = value.toFloat();
-  doc["timestamp"] = getTime();
+  // Until the clock is set the server stamps the reading on arrival
+  if (timeIsSet()) {
+    doc["timestamp"] = getTime();
+  }
+  doc["message_id"] = String(bootId, HEX) + "-" + String(messageCount++);
   
   String requestBody;
   serializeJson(doc, requestBody);
   
-  int httpResponseCode = http.POST(requestBody);
   bool success = false;
   
-  if (httpResponseCode > 0) {
-    String response = http.getString();
-    Serial.printf("📡 Data sent to API, response: %s\n", response.c_str());
-    success = true;
-  } else {
-    Serial.printf("❌ API Error when sending data: %d\n", httpResponseCode);
+  // Retries send the same body; the server ignores copies it already stored
+  for (int attempt = 1; attempt <= SEND_ATTEMPTS && !success; attempt++) {
+    int httpResponseCode = http.POST(requestBody);
+    if (httpResponseCode >= 200 && httpResponseCode < 300) {
+      String response = http.getString();
+      Serial.printf("📡 Data sent to API, response: %s\n", response.c_str());
+      success = true;
+    } else if (httpResponseCode >= 400 && httpResponseCode < 500) {
+      // The server rejected the reading; sending it again would not help
+      String response = http.getString();
+      Serial.printf("❌ Reading rejected: %d %s\n", httpResponseCode, response.c_str());
+      break;
+    } else {
+      Serial.printf("❌ API Error when sending data: %d (attempt %d)\n", httpResponseCode, attempt);
+      delay(1000 * attempt);
+    }
   }
   
   http.end();
@@ -159,6 +184,7 @@ void setup() {
   Serial.begin(115200);
   delay(2000);
   Serial.println("🔄 Starting ESP32 Receiver...");
+  bootId = esp_random();
 
 
   WiFi.mode(WIFI_STA);
@@ -16,6 +16,12 @@ const char* password = "YOUR_WIFI_PASSWORD";
 const char* serverUrl = "http://YOUR_SERVER_IP:9090";
 int sensorId = -1; // Will be set after registration
 
+// Each reading gets a message_id of a random boot id and a counter, so the
+// server stores a reading once however often it is retried
+uint32_t bootId = 0;
+uint32_t messageCount = 0;
+#define SEND_ATTEMPTS 3
+
 // AQI sensor settings
 const int airQualityPin = A0;
 
@@ -29,6 +35,7 @@ void setup() {
   delay(1000);
 
   Serial.println("🔄 Starting ESP32 Server Integration...");
+  bootId = esp_random();
 
   WiFi.mode(WIFI_STA);
   WiFi.begin(ssid, password);
@@ -138,24 +145,32 @@ bool sendSensorData(int value) {
   http.addHeader("Content-Type", "application/json");
   
   // Prepare JSON data
-  StaticJsonDocument<200> doc;
+  StaticJsonDocument<256> doc;
   doc["sensor_id"] = sensorId;
   doc["value"] = value;
+  doc["message_id"] = String(bootId, HEX) + "-" + String(messageCount++);
   
   String requestBody;
   serializeJson(doc, requestBody);
   
-  // Send POST request
-  int httpResponseCode = http.POST(requestBody);
-  
   bool success = false;
   
-  if (httpResponseCode > 0) {
-    String response = http.getString();
-    Serial.printf("📡 HTTP Response: %s\n", response.c_str());
-    success = true;
-  } else {
-    Serial.printf("❌ Error on sending POST: %d\n", httpResponseCode);
+  // Send POST request; retries send the same body, which the server stores once
+  for (int attempt = 1; attempt <= SEND_ATTEMPTS && !success; attempt++) {
+    int httpResponseCode = http.POST(requestBody);
+    if (httpResponseCode >= 200 && httpResponseCode < 300) {
+      String response = http.getString();
+      Serial.printf("📡 HTTP Response: %s\n", response.c_str());
+      success = true;
+    } else if (httpResponseCode >= 400 && httpResponseCode < 500) {
+      // The server rejected the reading; sending it again would not help
+      String response = http.getString();
+      Serial.printf("❌ Reading rejected: %d %s\n", httpResponseCode, response.c_str());
+      break;
+    } else {
+      Serial.printf("❌ Error on sending POST: %d (attempt %d)\n", httpResponseCode, attempt);
+      delay(1000 * attempt);
+    }
   }
   
   http.end();
@@ -0,0 +1,320 @@
+"""Load generator and benchmarks for the server.
+
+Write scenarios replay device traffic. --clients simulated ESP32 boards
+register through /api/sensor/register, as server_integration.ino does, and
+post readings to /api/sensor/data. --lora-clients simulated LoRa receivers
+register and post sender.ino's text payloads to /api/lora/data. Read
+scenarios request the pages whose cost grows with the data: /,
+/dashboard/data from raw readings and from the rollups, and readings pages
+followed from cursor to cursor.
+
+By default requests go through Flask's test client in this process, against
+--db or a temporary database. With --url they are sent over HTTP to a running
+server instead; pass the server's database as --db to also report its
+growth. Each scenario reports requests per second and latency percentiles.
+
+Read timings only mean something against a database of realistic size.
+--seed-rows bulk-loads synthetic readings, spread over --seed-days, into --db
+with generate.py before the benchmark runs; keep the file to benchmark it
+again without reseeding.
+
+    python bench.py --clients 50 --requests 20
+    python bench.py --db bench.db --seed-rows 1000000 --reads-only
+    python bench.py --url http://localhost:9090 --clients 200 --concurrency 32
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import db
+import generate
+
+ZONES = ['Good', 'Moderate', 'Unhealthy for Sensitive Groups', 'Unhealthy']
+
+
+class InProcessClient:
+    """Requests through Flask's test client, against db.DATABASE"""
+
+    def __init__(self):
+        # Imported here so that main picks up the database chosen on the command line
+        import main
+        main.init_db()
+        self.main = main
+        self.app = main.app
+
+    def request(self, method, path, body=None):
+        # A test client per request, as they are not safe to share between threads
+        response = self.app.test_client().open(path, method=method, json=body)
+        return response.status_code, response.headers, response.get_data()
+
+    def settle(self):
+        """Wait until queued readings are on disk"""
+        self.main.writer.flush(timeout=60)
+
+
+class HttpClient:
+    """Requests over HTTP to a running server"""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def request(self, method, path, body=None):
+        data = None
+        headers = {}
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(self.url + path, data=data, headers=headers, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=60) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers, e.read()
+        except OSError:
+            return 0, {}, b''
+
+    def settle(self):
+        # Each worker has its own queue; poll until the one answering is empty
+        for _ in range(50):
+            status, _, body = self.request('GET', '/api/ingest/stats')
+            if status != 200 or json.loads(body)['queue_depth'] == 0:
+                break
+            time.sleep(0.1)
+
+
+class Stats:
+    """Latencies and status codes of one scenario, shared between threads"""
+
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.statuses = collections.Counter()
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def call(self, client, method, path, body=None):
+        started = time.perf_counter()
+        status, headers, data = client.request(method, path, body)
+        seconds = time.perf_counter() - started
+        with self._lock:
+            self.latencies.append(seconds)
+            self.statuses[status] += 1
+        return status, headers, data
+
+    def ok(self):
+        return sum(count for status, count in self.statuses.items() if 200 <= status < 300)
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        if not count:
+            return f"{self.name:<22} no requests"
+
+        def percentile(fraction):
+            return latencies[min(count - 1, int(fraction * count))] * 1000
+
+        failed = ', '.join(f"{count} x {status or 'no response'}"
+                           for status, count in sorted(self.statuses.items()) if not 200 <= status < 300)
+        return (f"{self.name:<22} {count:>7} req {count / self.elapsed:>9,.1f} req/s  "
+                f"p50 {percentile(0.50):>8.2f}  p95 {percentile(0.95):>8.2f}  "
+                f"p99 {percentile(0.99):>8.2f}  max {latencies[-1] * 1000:>8.2f} ms"
+                + (f"  failed: {failed}" if failed else ''))
+
+
+def run(stats, tasks, concurrency):
+    """Run tasks (callables) on concurrency threads and return their results"""
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = [future.result() for future in [pool.submit(task) for task in tasks]]
+    for s in stats:
+        s.elapsed = time.perf_counter() - started
+    return results
+
+
+def register(client, stats, name, description):
+    status, _, body = stats.call(client, 'POST', '/api/sensor/register',
+                                 {'name': name, 'description': description})
+    return json.loads(body)['sensor_id'] if status == 201 else None
+
+
+def esp32_device(client, register_stats, stats, index, requests, seed):
+    """One server_integration.ino board: register, then post a raw AQI value per reading"""
+    rng = random.Random(seed * 100003 + index)
+    sensor_id = register(client, register_stats, f'bench-esp32-{index}', 'Simulated ESP32 sensor')
+    if sensor_id is None:
+        return None
+    for _ in range(requests):
+        stats.call(client, 'POST', '/api/sensor/data',
+                   {'sensor_id': sensor_id, 'value': rng.randint(0, 300)})
+    return sensor_id
+
+
+def lora_receiver(client, register_stats, stats, index, requests, seed):
+    """One receiver.ino gateway: register, then forward each LoRa text payload with its time"""
+    rng = random.Random(seed * 100019 + index)
+    sensor_id = register(client, register_stats, f'bench-lora-{index}',
+                         'Simulated LoRa air quality sensor')
+    if sensor_id is None:
+        return None
+    # Random per run like the receiver's boot id, so reruns are not duplicates
+    boot_id = f'{random.getrandbits(32):08x}'
+    for n in range(requests):
+        payload = (f"CO2:{rng.uniform(400, 2000):.1f} ppm,AQI:{rng.randint(0, 300)},"
+                   f"Zone:{rng.choice(ZONES)}")
+        stats.call(client, 'POST', '/api/lora/data', {
+            'sensor_id': sensor_id,
+            'value': payload,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'message_id': f'{boot_id}-{n}',
+        })
+    return sensor_id
+
+
+def write_scenarios(client, args):
+    register_stats = Stats('register')
+    esp32_stats = Stats('esp32 /api/sensor/data')
+    lora_stats = Stats('lora /api/lora/data')
+    tasks = [lambda i=i: esp32_device(client, register_stats, esp32_stats, i, args.requests, args.seed)
+             for i in range(args.clients)]
+    tasks += [lambda i=i: lora_receiver(client, register_stats, lora_stats, i, args.requests, args.seed)
+              for i in range(args.lora_clients)]
+    sensor_ids = run([register_stats, esp32_stats, lora_stats], tasks, args.concurrency)
+    return [register_stats, esp32_stats, lora_stats], [i for i in sensor_ids if i is not None]
+
+
+def walk_pages(client, stats, sensor_id, pages):
+    """Follow the readings API from the newest page back through older ones"""
+    path = f'/api/sensor/data/{sensor_id}?limit=100'
+    for _ in range(pages):
+        status, headers, _ = stats.call(client, 'GET', path)
+        cursor = headers.get('X-Next-Cursor') if status == 200 else None
+        if not cursor:
+            break
+        path = f'/api/sensor/data/{sensor_id}?limit=100&cursor={cursor}'
+
+
+def read_scenarios(client, args, sensor_ids):
+    rng = random.Random(args.seed)
+    now = int(time.time())
+    month_ago = now - 30 * 86400
+    count = args.reads
+    scenarios = [
+        ('GET /', lambda: '/'),
+        ('dashboard raw 24h', lambda: f'/dashboard/data?sensors={rng.choice(sensor_ids)}'),
+        ('dashboard 1h 30d', lambda: f'/dashboard/data?from={month_ago}&to={now}&resolution=1h'),
+        ('readings page', lambda: f'/sensors/{rng.choice(sensor_ids)}/readings'),
+    ]
+    results = []
+    for name, make_path in scenarios:
+        stats = Stats(name)
+        paths = [make_path() for _ in range(count)]
+        run([stats], [lambda path=path: stats.call(client, 'GET', path) for path in paths],
+            args.concurrency)
+        results.append(stats)
+
+    stats = Stats('readings api pages')
+    walks = [rng.choice(sensor_ids) for _ in range(max(1, count // 10))]
+    run([stats], [lambda sensor_id=sensor_id: walk_pages(client, stats, sensor_id, 10)
+                  for sensor_id in walks], args.concurrency)
+    results.append(stats)
+    return results
+
+
+def database_size(path):
+    return sum(os.path.getsize(path + suffix) for suffix in ('', '-wal') if os.path.exists(path + suffix))
+
+
+def last_reading_id(path):
+    conn = db.connect(path)
+    try:
+        return conn.execute('SELECT COALESCE(MAX(id), 0) FROM readings').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def sensor_ids_in(path):
+    conn = db.connect(path)
+    try:
+        # Sensors with readings, so that the read scenarios have something to read
+        return [row[0] for row in conn.execute('SELECT sensor_id FROM sensor_latest')]
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a sensor fleet and benchmark the server')
+    parser.add_argument('--url', help='Benchmark a running server at this URL instead of in-process')
+    parser.add_argument('--db', help='Database to use in-process, or the server\'s to report its growth '
+                                     '(default: a temporary database in-process)')
+    parser.add_argument('--clients', type=int, default=20, help='Simulated ESP32 sensors')
+    parser.add_argument('--lora-clients', type=int, default=5, help='Simulated LoRa receivers')
+    parser.add_argument('--requests', type=int, default=50, help='Readings posted by each client')
+    parser.add_argument('--reads', type=int, default=200, help='Requests per read scenario')
+    parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight at once')
+    parser.add_argument('--writes-only', action='store_true', help='Skip the read scenarios')
+    parser.add_argument('--reads-only', action='store_true', help='Skip the write scenarios')
+    parser.add_argument('--seed-rows', type=int, default=0, help='Add this many synthetic readings to --db first')
+    parser.add_argument('--seed-sensors', type=int, default=10, help='Sensors the synthetic readings belong to')
+    parser.add_argument('--seed-days', type=float, default=90, help='Days the synthetic readings span')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the simulated traffic')
+
+    args = parser.parse_args()
+    if args.writes_only and args.reads_only:
+        parser.error("--writes-only and --reads-only exclude each other")
+    if args.url and args.seed_rows:
+        parser.error("--seed-rows loads the database offline; run generate.py before starting the server")
+
+    temporary = None
+    path = args.db
+    if path is None and not args.url:
+        temporary = tempfile.mkdtemp(prefix='bench-')
+        path = os.path.join(temporary, 'bench.db')
+    try:
+        if path:
+            db.DATABASE = path
+        client = HttpClient(args.url) if args.url else InProcessClient()
+        if args.seed_rows:
+            interval = max(1, int(args.seed_days * generate.DAY * args.seed_sensors / args.seed_rows))
+            generate.generate(path, args.seed_sensors, args.seed_days, interval,
+                              prefix=time.strftime('bench-%Y%m%d%H%M%S'))
+
+        print(f"Target: {args.url or 'in-process'}" + (f", database {path}" if path else ''))
+        results = []
+        sensor_ids = []
+        if not args.reads_only:
+            size_before = database_size(path) if path else 0
+            id_before = last_reading_id(path) if path else 0
+            stats, sensor_ids = write_scenarios(client, args)
+            results.extend(stats)
+            client.settle()
+            accepted = stats[1].ok() + stats[2].ok()
+            print(f"Posted {accepted:,} readings from {args.clients + args.lora_clients} clients "
+                  f"({accepted / stats[0].elapsed:,.1f} readings/s)")
+            if path:
+                growth = database_size(path) - size_before
+                stored = last_reading_id(path) - id_before
+                print(f"Database grew by {growth:,} bytes for {stored:,} readings stored"
+                      + (f" ({growth / stored:,.0f} bytes each)" if stored else ''))
+        if not args.writes_only:
+            if path:
+                sensor_ids = sensor_ids_in(path)
+            if not sensor_ids:
+                print("No sensors with readings to read; skipping the read scenarios")
+            else:
+                results.extend(read_scenarios(client, args, sensor_ids))
+
+        print()
+        for stats in results:
+            print(stats.summary())
+    finally:
+        if temporary:
+            shutil.rmtree(temporary, ignore_errors=True)
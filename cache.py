@@ -0,0 +1,104 @@
+"""Response cache for the polled read routes, keyed by data versions.
+
+data_versions holds a counter per sensor, bumped in the same transaction as
+every change to the sensor or its readings: ingestion bumps each sensor of a
+committed group once. Since the counters live in the database, a change made
+by any process (the writer process, another worker, the retention job) is
+seen by all of them.
+
+A cached route's ETag is a hash of its URL and the versions of the sensors it
+shows, so a client presenting the current ETag in If-None-Match gets a 304
+without the route running, and the rendered body of a recent ETag is served
+from an in-memory LRU. Versions are read before the route queries, so a body
+is never older than its ETag.
+
+RESPONSE_CACHE_MB bounds the memory of each process's LRU (default 32, 0
+turns caching off).
+"""
+import collections
+import hashlib
+import os
+import threading
+
+RESPONSE_CACHE_BYTES = int(float(os.environ.get('RESPONSE_CACHE_MB', 32)) * 1024 * 1024)
+# A single body may take at most this share of the cache
+MAX_ENTRY_SHARE = 8
+
+
+def init_tables(c):
+    # Rows are kept when a sensor is deleted, so the total only ever grows
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS data_versions (
+            sensor_id INTEGER PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    ''')
+
+
+def bump(conn, sensor_ids):
+    """Mark the sensors' data as changed; call inside the transaction making the change"""
+    conn.executemany('''
+        INSERT INTO data_versions (sensor_id, version) VALUES (?, 1)
+        ON CONFLICT (sensor_id) DO UPDATE SET version = version + 1
+    ''', [(sensor_id,) for sensor_id in set(sensor_ids) if sensor_id is not None])
+
+
+def bump_all(conn):
+    """Mark every sensor's data as changed, after a job that touched many of them"""
+    conn.execute('UPDATE data_versions SET version = version + 1')
+    bump(conn, [row[0] for row in conn.execute('''
+        SELECT id FROM sensors WHERE id NOT IN (SELECT sensor_id FROM data_versions)
+    ''')])
+
+
+def versions(conn, sensor_ids=None):
+    """A value that changes whenever the data of sensor_ids changes; None means all sensors"""
+    if sensor_ids is None:
+        return tuple(conn.execute('SELECT COUNT(*), TOTAL(version) FROM data_versions').fetchone())
+    placeholders = ','.join('?' * len(sensor_ids))
+    found = dict(conn.execute(f'SELECT sensor_id, version FROM data_versions WHERE sensor_id IN ({placeholders})',
+                              list(sensor_ids)).fetchall())
+    return tuple((sensor_id, found.get(sensor_id, 0)) for sensor_id in sorted(set(sensor_ids)))
+
+
+def etag(key):
+    return hashlib.blake2b(repr(key).encode(), digest_size=12).hexdigest()
+
+
+class ResponseCache:
+    """LRU of rendered response bodies and headers by ETag, bounded by total body size"""
+
+    def __init__(self, max_bytes=RESPONSE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, tag):
+        with self._lock:
+            entry = self._entries.get(tag)
+            if entry is not None:
+                self._entries.move_to_end(tag)
+            return entry
+
+    def put(self, tag, body, headers):
+        size = len(body)
+        if size * MAX_ENTRY_SHARE > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(tag, None)
+            if old is not None:
+                self._bytes -= len(old[0])
+            self._entries[tag] = (body, headers)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "capacity_bytes": self.max_bytes}
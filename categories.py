@@ -0,0 +1,56 @@
+"""AQI categories stored as small integer codes.
+
+Readings keep a category_id into aqi_categories instead of repeating the zone
+name on every row. The six EPA categories have fixed codes 1 to 6. Other names
+sent by devices get a code on first use. Names match case-insensitively, so
+'good' and 'Good' share a code and read back as 'Good'.
+"""
+
+# The EPA categories in order of severity; a name's code is its position plus one
+NAMES = (
+    'Good',
+    'Moderate',
+    'Unhealthy for Sensitive Groups',
+    'Unhealthy',
+    'Very Unhealthy',
+    'Hazardous',
+)
+
+_CODES = {name.lower(): code for code, name in enumerate(NAMES, 1)}
+
+
+def init_tables(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS aqi_categories (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE COLLATE NOCASE
+        )
+    ''')
+    c.executemany('INSERT OR IGNORE INTO aqi_categories (id, name) VALUES (?, ?)',
+                  list(enumerate(NAMES, 1)))
+
+
+def codes(conn, names):
+    """{name: category_id} for category names, adding the new ones.
+
+    EPA names need no query; the others in one call are added with one insert
+    and looked up with one query. Call inside the transaction storing the
+    readings, so codes added for them are rolled back with them.
+    """
+    found = {}
+    other = []
+    for name in set(names):
+        if not name:
+            found[name] = None
+        elif name.lower() in _CODES:
+            found[name] = _CODES[name.lower()]
+        else:
+            other.append(name)
+    if other:
+        conn.executemany('INSERT OR IGNORE INTO aqi_categories (name) VALUES (?)', [(name,) for name in other])
+        placeholders = ','.join('?' * len(other))
+        stored = {name.lower(): code for code, name in conn.execute(
+            f'SELECT id, name FROM aqi_categories WHERE name IN ({placeholders})', other)}
+        for name in other:
+            found[name] = stored[name.lower()]
+    return found
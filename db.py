@@ -0,0 +1,181 @@
+import contextlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import telemetry
+
+# Database location, shared by the server and the offline tools
+DATABASE = os.environ.get('SENSOR_DB_PATH', 'sensor_data.db')
+
+# Connection tuning, overridable from the environment
+BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 16384))
+MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+STATEMENT_CACHE_SIZE = int(os.environ.get('SQLITE_STATEMENT_CACHE_SIZE', 256))
+POOL_MAX_IDLE = int(os.environ.get('SQLITE_POOL_MAX_IDLE', 16))
+
+
+telemetry.describe('sqlite_query_duration_seconds', 'histogram',
+                 'Time to execute a statement, up to its first row, by statement and table')
+telemetry.describe('sqlite_commit_duration_seconds', 'histogram', 'Time to commit a transaction')
+
+_STATEMENT = re.compile(r'\s*(\w+)')
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:\w+\.)?(\w+)', re.I)
+_MAX_LABELS = 1024
+_labels = {}
+
+
+def _query_labels(sql):
+    """(statement, table) labels of a query, cached by SQL text"""
+    labels = _labels.get(sql)
+    if labels is None:
+        statement = _STATEMENT.match(sql)
+        table = _TABLE.search(sql)
+        labels = (('statement', statement.group(1).upper() if statement else ''),
+                  ('table', table.group(1).lower() if table else ''))
+        # Queries built with a variable number of placeholders could fill the cache
+        if len(_labels) < _MAX_LABELS:
+            _labels[sql] = labels
+    return labels
+
+
+class Cursor(sqlite3.Cursor):
+    """Times every statement for the /metrics histograms"""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            telemetry.observe('sqlite_query_duration_seconds', _query_labels(sql),
+                              time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            telemetry.observe('sqlite_query_duration_seconds', _query_labels(sql),
+                              time.perf_counter() - started)
+
+    def executescript(self, sql_script):
+        started = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            telemetry.observe('sqlite_query_duration_seconds', _query_labels(sql_script),
+                              time.perf_counter() - started)
+
+
+class Connection(sqlite3.Connection):
+    """Connection whose statements and commits are timed.
+
+    sqlite3's own shortcuts bypass cursor() and commit(), so they are
+    overridden to go through the timed versions.
+    """
+
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        if not self.in_transaction:
+            return
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            telemetry.observe('sqlite_commit_duration_seconds', (), time.perf_counter() - started)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+def connect(path=None):
+    """Open a tuned connection to the sensor database.
+
+    WAL lets readers run alongside the writer, synchronous=NORMAL is durable
+    under WAL except for the last commits on power loss, and busy_timeout makes
+    concurrent writers wait for the lock instead of failing with
+    "database is locked".
+    """
+    conn = sqlite3.connect(path or DATABASE,
+                           timeout=BUSY_TIMEOUT_MS / 1000.0,
+                           cached_statements=STATEMENT_CACHE_SIZE,
+                           check_same_thread=False,
+                           factory=Connection,
+                           # Archived months are attached by file: URI, see shards.py
+                           uri=True)
+    conn.row_factory = sqlite3.Row
+    # Lets retention give freed pages back. It only takes effect on a new,
+    # empty database, and must come before switching it to WAL.
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+class ConnectionPool:
+    """Reuses open connections instead of connecting on every request.
+
+    A connection is checked out by one thread at a time and returned to the
+    pool afterwards. Up to max_idle connections are kept open between uses.
+    """
+
+    def __init__(self, path=None, max_idle=POOL_MAX_IDLE):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return connect(self.path)
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            conn.close()
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
@@ -0,0 +1,101 @@
+"""Recognising readings that a device sent more than once.
+
+Devices retry a POST that failed or timed out, and LoRa receivers can forward
+the same packet twice. A reading can therefore carry a key that identifies it
+among its sensor's readings:
+
+- seq: a sequence number the device never reuses, from 0 to 2**62 - 1. It
+  has to survive reboots, e.g. kept in flash.
+- message_id: any string unique to the reading, such as a random boot id
+  followed by a counter.
+- Otherwise, with INGEST_DEDUP_TIMESTAMPS=1, its device timestamp. This is
+  off by default: devices that send times to the second can take two
+  readings within one.
+
+Other readings have no key and are never duplicates.
+
+The key is stored in readings.dedup_key, under a unique index on (sensor_id,
+dedup_key). Each kind of key has its own range of integers, so they cannot
+collide with each other. The insert of a reading whose key is already stored
+does nothing (see main.insert_readings), so two processes storing the same
+reading at once keep one copy and neither fails. RecentKeys remembers the last INGEST_DEDUP_CACHE keys
+this process accepted, so most retries are turned away without touching the
+database, even while the first copy is still in the write-behind queue.
+Archived months are not checked.
+"""
+import collections
+import hashlib
+import os
+import threading
+
+import telemetry
+
+CACHE_SIZE = int(os.environ.get('INGEST_DEDUP_CACHE', 100000))
+USE_TIMESTAMPS = os.environ.get('INGEST_DEDUP_TIMESTAMPS', '0') == '1'
+
+MAX_SEQ = 2 ** 62 - 1
+# seq keys are 0 to MAX_SEQ, timestamp keys come after them and message_id
+# keys are negative
+_TIMESTAMP_BASE = 2 ** 62
+
+telemetry.describe('readings_duplicate_total', 'counter',
+                   'Readings dropped as duplicates, by where they were recognised')
+
+
+def reading_key(item, ts):
+    """dedup_key of a submitted reading, given its device timestamp in ms (or None).
+
+    Raises ValueError when seq or message_id is malformed.
+    """
+    seq = item.get('seq')
+    if seq is not None:
+        if isinstance(seq, bool) or not isinstance(seq, int) or not 0 <= seq <= MAX_SEQ:
+            raise ValueError(f"seq must be an integer from 0 to {MAX_SEQ}")
+        return seq
+    message_id = item.get('message_id')
+    if message_id is not None:
+        if not isinstance(message_id, str) or not message_id:
+            raise ValueError("message_id must be a non-empty string")
+        digest = hashlib.blake2b(message_id.encode(), digest_size=8).digest()
+        return -(int.from_bytes(digest, 'big') >> 1) - 1
+    if ts is not None and USE_TIMESTAMPS:
+        return _TIMESTAMP_BASE + ts
+    return None
+
+
+def row_keys(rows):
+    """(sensor_id, dedup_key) pairs of the keyed rows among rows"""
+    return [(row[0], row[5]) for row in rows if row[5] is not None]
+
+
+class RecentKeys:
+    """The most recently accepted (sensor_id, dedup_key) pairs, least recently seen first out"""
+
+    def __init__(self, capacity=CACHE_SIZE):
+        self.capacity = capacity
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def add(self, pair):
+        """Remember pair; returns False when it was already there"""
+        if self.capacity <= 0:
+            return True
+        with self._lock:
+            if pair in self._keys:
+                self._keys.move_to_end(pair)
+                self.hits += 1
+                return False
+            self._keys[pair] = None
+            if len(self._keys) > self.capacity:
+                self._keys.popitem(last=False)
+            return True
+
+    def discard(self, pairs):
+        """Forget pairs whose readings were not stored after all, so a retry gets through"""
+        with self._lock:
+            for pair in pairs:
+                self._keys.pop(pair, None)
+
+    def stats(self):
+        return {"capacity": self.capacity, "size": len(self._keys), "hits": self.hits}
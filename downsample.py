@@ -0,0 +1,92 @@
+"""Shape-preserving downsampling of time series for charts.
+
+Both methods take parallel numpy arrays of x (time) and y (value), ordered by
+x, and return the sorted indices of the points to keep, so callers can pick the
+matching rows from any other column.
+
+- lttb: Largest-Triangle-Three-Buckets keeps the point in each bucket that
+  forms the largest triangle with its neighbours. It follows the visual shape
+  of the line closely.
+- minmax: keeps the minimum and maximum of each bucket, so spikes are never
+  dropped.
+"""
+import numpy as np
+
+DEFAULT_METHOD = 'lttb'
+
+
+def _fill_missing(y):
+    """Replace NaNs (readings without this metric) with the series mean"""
+    missing = np.isnan(y)
+    if not missing.any():
+        return y
+    fill = y[~missing].mean() if (~missing).any() else 0.0
+    return np.where(missing, fill, y)
+
+
+def lttb(x, y, max_points):
+    n = len(x)
+    if max_points >= n:
+        return np.arange(n)
+    if max_points < 3:
+        return np.array([0, n - 1][:max_points], dtype=np.int64)
+    y = _fill_missing(y)
+    # Relative times keep the prefix sums below precise
+    x = x - x[0]
+
+    # Bucket i (of max_points - 2) covers points [edges[i], edges[i + 1]);
+    # the first and last points are always kept
+    every = (n - 2) / (max_points - 2)
+    edges = (np.arange(max_points - 1) * every).astype(np.int64) + 1
+    edges[-1] = n - 1
+
+    # Mean of every bucket at once from prefix sums; the last "bucket" is the final point
+    cx = np.concatenate(([0.0], np.cumsum(x)))
+    cy = np.concatenate(([0.0], np.cumsum(y)))
+    next_starts = edges[1:]
+    next_ends = np.append(edges[2:], n)
+    counts = next_ends - next_starts
+    avg_x = (cx[next_ends] - cx[next_starts]) / counts
+    avg_y = (cy[next_ends] - cy[next_starts]) / counts
+
+    keep = np.empty(max_points, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        ax, ay = x[a], y[a]
+        area = np.abs((ax - avg_x[i]) * (y[start:end] - ay) - (ax - x[start:end]) * (avg_y[i] - ay))
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+    return keep
+
+
+def minmax(x, y, max_points):
+    n = len(x)
+    if max_points >= n:
+        return np.arange(n)
+    y = _fill_missing(y)
+
+    buckets = max(max_points // 2, 1)
+    bucket = np.arange(n) * buckets // n
+    # Sort by bucket, then value: the first entry of each bucket is its minimum
+    # and the last is its maximum
+    order = np.lexsort((y, bucket))
+    firsts = np.flatnonzero(np.r_[True, bucket[order][1:] != bucket[order][:-1]])
+    lasts = np.r_[firsts[1:] - 1, n - 1]
+    return np.unique(np.concatenate((order[firsts], order[lasts])))
+
+
+METHODS = {
+    'lttb': lttb,
+    'minmax': minmax,
+}
+
+
+def downsample(x, y, max_points, method=DEFAULT_METHOD):
+    """Indices of at most max_points points of (x, y) chosen by method"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    return METHODS[method](x, y, max_points)
+
@@ -0,0 +1,225 @@
+"""Streaming export of readings as CSV, NDJSON or Parquet.
+
+Rows are read from the database in fixed-size chunks and encoded chunk by
+chunk, so memory use stays constant however large the export is. Parquet
+output needs the optional pyarrow package and is written one row group per
+chunk.
+
+Command line use:
+
+    python export.py --format csv --sensor 1 --from 2024-05-01 --to 2024-06-01 -o may.csv
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+
+import db
+import rollups
+import shards
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+COLUMNS = ['id', 'sensor_id', 'sensor_name', 'timestamp', 'aqi_value', 'co2_ppm', 'aqi_category']
+
+CHUNK_ROWS = 5000
+
+
+def iter_chunks(conn, start=None, end=None, sensor_ids=None, chunk_rows=CHUNK_ROWS):
+    """Yield lists of reading tuples (in COLUMNS order) for a time range.
+
+    start and end are epoch seconds; either may be None for an open range.
+    Without sensor_ids rows come in time order through the ts index. With
+    sensor_ids each sensor is read in turn through the (sensor_id, ts) index,
+    so no sort is ever needed. Timestamps are written out as ISO strings and
+    categories by name. Archived months are read
+    first, then the main database (see shards.tables).
+    """
+    bounds = ['r.ts IS NOT NULL']
+    params = []
+    if start is not None:
+        bounds.append('r.ts >= ?')
+        params.append(start * 1000)
+    if end is not None:
+        bounds.append('r.ts < ?')
+        params.append(end * 1000)
+
+    queries = []
+    if sensor_ids is None:
+        queries.append((f"WHERE {' AND '.join(bounds)}", params))
+    else:
+        for sensor_id in sensor_ids:
+            where = ' AND '.join(['r.sensor_id = ?'] + bounds)
+            queries.append((f'WHERE {where}', [sensor_id] + params))
+
+    for where, query_params in queries:
+        for table, _ in shards.tables(conn, start, end):
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(f'''
+                SELECT r.id, r.sensor_id, s.name, strftime('%Y-%m-%dT%H:%M:%f', r.ts / 1000.0, 'unixepoch'),
+                       r.aqi_value, r.co2_ppm, c.name
+                FROM {table} r
+                LEFT JOIN main.sensors s ON s.id = r.sensor_id
+                LEFT JOIN main.aqi_categories c ON c.id = r.category_id
+                {where}
+                ORDER BY r.ts, r.id
+            ''', query_params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_rows)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                # An archive can only be detached once its cursor is closed
+                cursor.close()
+
+
+def encode_csv(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def encode_ndjson(chunks):
+    dumps = json.JSONEncoder(separators=(',', ':')).encode
+    for rows in chunks:
+        yield ''.join(dumps(dict(zip(COLUMNS, row))) + '\n' for row in rows)
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands out what has been written so far.
+
+    Parquet writers need tell() to report the absolute offset for the file
+    metadata, so the position is tracked separately from the drained buffer.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def _parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('id', pa.int64()),
+        ('sensor_id', pa.int64()),
+        ('sensor_name', pa.string()),
+        ('timestamp', pa.string()),
+        ('aqi_value', pa.float64()),
+        ('co2_ppm', pa.float64()),
+        ('aqi_category', pa.string()),
+    ])
+
+
+def _parquet_table(rows, schema):
+    import pyarrow as pa
+    columns = list(zip(*rows))
+    return pa.Table.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, schema)],
+                                schema=schema)
+
+
+def encode_parquet(chunks):
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    try:
+        for rows in chunks:
+            writer.write_table(_parquet_table(rows, schema))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {
+    'csv': encode_csv,
+    'ndjson': encode_ndjson,
+    'parquet': encode_parquet,
+}
+
+
+def check_format(fmt):
+    """Raise ValueError for unknown formats, RuntimeError when parquet is unavailable"""
+    if fmt not in ENCODERS:
+        raise ValueError(f"format must be one of: {', '.join(ENCODERS)}")
+    if fmt == 'parquet':
+        try:
+            import pyarrow.parquet  # noqa: F401
+        except ImportError:
+            raise RuntimeError("Parquet export requires the pyarrow package")
+
+
+def stream(fmt, start=None, end=None, sensor_ids=None, path=None):
+    """Yield the encoded export, using its own connection for the whole stream"""
+    conn = db.connect(path)
+    try:
+        yield from ENCODERS[fmt](iter_chunks(conn, start, end, sensor_ids))
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export sensor readings')
+    parser.add_argument('--format', choices=list(ENCODERS), default='csv', help='Output format')
+    parser.add_argument('--sensor', type=int, action='append', help='Sensor ID to export (repeatable, default all)')
+    parser.add_argument('--from', dest='start', help='Start of the range (ISO timestamp or epoch seconds)')
+    parser.add_argument('--to', dest='end', help='End of the range, exclusive (ISO timestamp or epoch seconds)')
+    parser.add_argument('-o', '--output', help='Output file (default stdout)')
+    parser.add_argument('--db', default=db.DATABASE, help='Path to the SQLite database')
+
+    args = parser.parse_args()
+
+    try:
+        check_format(args.format)
+    except RuntimeError as e:
+        parser.error(str(e))
+    start = rollups.to_epoch(args.start) if args.start else None
+    end = rollups.to_epoch(args.end) if args.end else None
+    if (args.start and start is None) or (args.end and end is None):
+        parser.error("--from and --to must be ISO timestamps or epoch seconds")
+
+    binary = args.format == 'parquet'
+    if args.output:
+        out = open(args.output, 'wb' if binary else 'w', newline='' if not binary else None)
+    else:
+        out = sys.stdout.buffer if binary else sys.stdout
+    try:
+        for chunk in stream(args.format, start, end, args.sensor, args.db):
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
@@ -0,0 +1,218 @@
+"""Synthetic sensor data for testing and benchmarking at scale.
+
+Creates --sensors sensors named <prefix>-NNNNN and gives each a reading every
+--interval seconds over the last --days days (or as many days as --rows
+readings take). Each sensor has its own CO2 baseline and occupancy swing, an
+AQI baseline with morning and evening traffic peaks, a few slow random waves
+and noise; about half of them measure CO2 at all, like the AQI-only ESP32
+boards. Readings are generated a block of time steps at a time with numpy and
+inserted in time order, so that ids follow timestamps as they do for ingested
+readings.
+
+Going through the routes would take days for 100M rows, so the readings are
+bulk-loaded instead. During the load the readings indexes and the
+latest-reading trigger are dropped, the journal is a plain rollback journal
+with synchronous=OFF, and every --batch-rows readings are one transaction.
+Afterwards the indexes are rebuilt, sensor_latest and the rollups are filled
+in for the new sensors and the database goes back to WAL. The load is not
+crash-safe: if it is interrupted, start again from a fresh file.
+
+    python generate.py --db big.db --sensors 2000 --days 30 --interval 60   # 86.4M readings
+    python generate.py --db bench.db --sensors 100 --rows 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+
+import aqi
+import db
+import rollups
+
+DAY = 86400
+
+# Indexes on readings that are built once after the load instead of per row
+_READING_INDEXES = ['idx_readings_sensor_ts', 'idx_readings_ts']
+_LATEST_TRIGGER = 'readings_latest_insert'
+
+
+class SensorsExist(ValueError):
+    pass
+
+
+def sensor_profiles(rng, count):
+    """Per-sensor parameters of the generated series"""
+    return {
+        'offset': rng.uniform(0, 1, count),
+        'co2_base': rng.uniform(410, 520, count),
+        'co2_swing': rng.uniform(50, 900, count),
+        'has_co2': rng.random(count) < 0.5,
+        'aqi_base': rng.gamma(4.0, 10.0, count),
+        'aqi_swing': rng.uniform(5, 60, count),
+        # Slow waves standing in for weather, as (period in seconds, phase, amplitude)
+        'wave_period': rng.uniform(0.5 * DAY, 6 * DAY, (3, count)),
+        'wave_phase': rng.uniform(0, 2 * np.pi, (3, count)),
+        'wave_size': rng.uniform(0, 0.2, (3, count)),
+    }
+
+
+def generate_block(rng, profiles, epochs):
+    """AQI and CO2 arrays of shape (len(epochs), sensors) for reading times epochs"""
+    epochs = epochs[:, None]
+    hours = (epochs % DAY) / 3600.0
+    # Occupancy from about 8:00 to 18:00, traffic peaks at 8:00 and 18:00
+    occupancy = np.clip(np.sin((hours - 8) / 10 * np.pi), 0, None) ** 2
+    traffic = np.exp(-((hours - 8) ** 2) / 2) + np.exp(-((hours - 18) ** 2) / 2)
+
+    waves = 1.0
+    for period, phase, size in zip(profiles['wave_period'], profiles['wave_phase'], profiles['wave_size']):
+        waves = waves + size * np.sin(2 * np.pi * epochs / period + phase)
+
+    shape = (len(epochs), len(profiles['offset']))
+    co2 = profiles['co2_base'] + profiles['co2_swing'] * occupancy * waves + rng.normal(0, 15, shape)
+    co2 = np.round(np.clip(co2, 380, 5000), 1)
+    co2[:, ~profiles['has_co2']] = np.nan
+
+    aqi = (profiles['aqi_base'] + profiles['aqi_swing'] * traffic) * waves + rng.normal(0, 4, shape)
+    # Rare pollution episodes
+    aqi += (rng.random(shape) < 0.0005) * rng.uniform(50, 250, shape)
+    aqi = np.round(np.clip(aqi, 0, 500))
+    return aqi, co2
+
+
+def add_sensors(conn, prefix, count):
+    names = [f'{prefix}-{n:05d}' for n in range(count)]
+    placeholders = ','.join('?' * len(names))
+    taken = conn.execute(f'SELECT COUNT(*) FROM sensors WHERE name IN ({placeholders})', names).fetchone()[0]
+    if taken:
+        raise SensorsExist(f"{taken} sensors named {prefix}-NNNNN already exist; choose another --prefix")
+    with conn:
+        first = conn.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM sensors').fetchone()[0]
+        conn.executemany('INSERT INTO sensors (id, name, description) VALUES (?, ?, ?)',
+                         [(first + n, name, 'Synthetic readings') for n, name in enumerate(names)])
+    return np.arange(first, first + count)
+
+
+def load(conn, sensor_ids, start, end, interval, batch_rows, seed=0):
+    """Insert readings every interval seconds in [start, end); returns the rows inserted"""
+    rng = np.random.default_rng(seed)
+    profiles = sensor_profiles(rng, len(sensor_ids))
+    steps = int((end - start) // interval)
+    block_steps = max(1, batch_rows // len(sensor_ids))
+    # Readings of one sensor are interval apart, each sensor at its own offset
+    offsets = (profiles['offset'] * interval).astype(np.int64)
+    sensor_column = np.tile(sensor_ids, block_steps).tolist()
+
+    total = 0
+    started = time.perf_counter()
+    for first in range(0, steps, block_steps):
+        count = min(block_steps, steps - first)
+        base = start + np.arange(first, first + count, dtype=np.int64) * interval
+        aqi_values, co2 = generate_block(rng, profiles, base.astype(float))
+        timestamps = ((base[:, None] + offsets) * 1000).ravel().tolist()
+        # Generated AQI is never missing, so every reading gets a category
+        category_ids = aqi.classify(aqi_values).ravel().tolist()
+        # NaN is stored as NULL
+        rows = zip(sensor_column[:count * len(sensor_ids)], aqi_values.ravel().tolist(),
+                   co2.ravel().tolist(), category_ids, timestamps)
+        with conn:
+            conn.executemany('''
+                INSERT INTO readings (sensor_id, aqi_value, co2_ppm, category_id, ts)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+        total += len(timestamps)
+        elapsed = time.perf_counter() - started
+        print(f"Loaded {total:,} of {steps * len(sensor_ids):,} readings "
+              f"({total / elapsed * 60:,.0f} per minute)")
+    return total
+
+
+def relax(conn):
+    """Settings for the bulk load, undone by reopening the connection"""
+    conn.execute('PRAGMA journal_mode = DELETE')
+    conn.execute('PRAGMA synchronous = OFF')
+    conn.execute('PRAGMA locking_mode = EXCLUSIVE')
+    conn.execute('PRAGMA cache_size = -1048576')
+    for index in _READING_INDEXES:
+        conn.execute(f'DROP INDEX IF EXISTS {index}')
+    conn.execute(f'DROP TRIGGER IF EXISTS {_LATEST_TRIGGER}')
+    conn.commit()
+
+
+def restore(conn, sensor_ids):
+    """Rebuild what relax() dropped and fill in the derived tables for sensor_ids"""
+    import main
+    c = conn.cursor()
+    print("Building indexes...")
+    main.init_indexes(c)
+    conn.commit()
+    print("Filling in latest readings...")
+    with conn:
+        conn.execute(f'''
+            INSERT OR REPLACE INTO sensor_latest (sensor_id, reading_id, aqi_value, co2_ppm, category_id, ts)
+            SELECT r.sensor_id, r.id, r.aqi_value, r.co2_ppm, r.category_id, r.ts
+            FROM sensors s
+            JOIN readings r ON r.id = (
+                SELECT id FROM readings
+                WHERE sensor_id = s.id
+                ORDER BY ts DESC, id DESC LIMIT 1
+            )
+            WHERE s.id BETWEEN ? AND ?
+        ''', (int(sensor_ids[0]), int(sensor_ids[-1])))
+        main.init_latest_readings(c)
+    print("Building rollups...")
+    rollups.backfill(conn, sensor_ids.tolist())
+    conn.execute('ANALYZE')
+    conn.commit()
+
+
+def generate(path, sensors, days, interval=60, prefix='sim', batch_rows=1000000, seed=0, end=None):
+    """Create sensors with synthetic readings over the days before end; returns the rows inserted"""
+    # main owns the schema; imported here so that it uses the database given
+    db.DATABASE = path
+    import main
+    main.init_db()
+
+    end = int(end if end is not None else time.time())
+    start = end - int(days * DAY)
+    conn = db.connect(path)
+    try:
+        sensor_ids = add_sensors(conn, prefix, sensors)
+        relax(conn)
+        try:
+            started = time.perf_counter()
+            total = load(conn, sensor_ids, start, end, interval, batch_rows, seed)
+            print(f"Inserted {total:,} readings in {time.perf_counter() - started:.1f}s")
+        finally:
+            restore(conn, sensor_ids)
+    finally:
+        conn.close()
+    # Reopening puts the database back into WAL mode
+    db.connect(path).close()
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bulk-load synthetic sensors and readings')
+    parser.add_argument('--db', default=db.DATABASE, help='Path to the SQLite database')
+    parser.add_argument('--sensors', type=int, default=1000, help='Number of sensors to create')
+    parser.add_argument('--days', type=float, default=30, help='Days of readings, ending now')
+    parser.add_argument('--rows', type=int, help='Total readings to generate; sets --days')
+    parser.add_argument('--interval', type=int, default=60, help='Seconds between readings of a sensor')
+    parser.add_argument('--prefix', default='sim', help='Prefix of the new sensor names')
+    parser.add_argument('--batch-rows', type=int, default=1000000, help='Readings per transaction')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+    args = parser.parse_args()
+    if args.sensors < 1 or args.interval < 1:
+        parser.error("--sensors and --interval must be positive")
+    days = args.days
+    if args.rows:
+        days = args.rows * args.interval / (args.sensors * DAY)
+
+    started = time.perf_counter()
+    try:
+        total = generate(args.db, args.sensors, days, args.interval, args.prefix, args.batch_rows, args.seed)
+    except SensorsExist as e:
+        parser.error(str(e))
+    print(f"Done: {total:,} readings for {args.sensors} sensors in {time.perf_counter() - started:.1f}s")
@@ -0,0 +1,60 @@
+# Production server settings: gunicorn -c gunicorn.conf.py
+#
+# WEB_WORKERS pre-forked worker processes serve requests. The default
+# gthread workers run WEB_THREADS threads each. Set WEB_WORKER_CLASS=gevent
+# (needs `pip install gevent`) to serve each connection from a greenlet
+# instead, so thousands of slow sensor uploads and live streams don't each
+# hold a thread. Readings from all workers are committed by a single writer
+# process, see writer_process.py.
+import multiprocessing
+import os
+import secrets
+import shutil
+import signal
+import tempfile
+
+import writer_process
+
+wsgi_app = 'main:app'
+bind = os.environ.get('WEB_BIND', '0.0.0.0:9090')
+workers = int(os.environ.get('WEB_WORKERS', min(multiprocessing.cpu_count(), 4)))
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('WEB_THREADS', 8))
+worker_connections = int(os.environ.get('WEB_WORKER_CONNECTIONS', 1000))
+# Live streams stay open; the timeout only applies to stuck workers
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+graceful_timeout = 30
+keepalive = 5
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-')
+
+
+def on_starting(server):
+    # Every worker must sign sessions (flash messages) with the same key
+    os.environ.setdefault('SECRET_KEY', secrets.token_hex(32))
+    # Where each process saves its metrics for /metrics to add up; fresh on every start
+    server.metrics_dir = tempfile.mkdtemp(prefix='sensor-metrics-')
+    os.environ['METRICS_DIR'] = server.metrics_dir
+    # Started again by the master whenever it exits
+    server.writer = writer_process.Supervisor()
+
+
+def on_exit(server):
+    server.writer.stop()
+    shutil.rmtree(server.metrics_dir, ignore_errors=True)
+
+
+def post_worker_init(worker):
+    import main
+    # Stream the readings committed through any worker, and forget the keys
+    # of readings the writer process failed to store
+    main.writer_client.listen(main.hub.publish, main.recent_keys.discard)
+
+    # Close live streams on a graceful shutdown instead of waiting out graceful_timeout
+    handle_exit = signal.getsignal(signal.SIGTERM)
+
+    def handle_term(signum, frame):
+        main.hub.close()
+        handle_exit(signum, frame)
+
+    signal.signal(signal.SIGTERM, handle_term)
+    signal.siginterrupt(signal.SIGTERM, False)
@@ -0,0 +1,165 @@
+import collections
+import threading
+import time
+
+
+class QueueFullError(Exception):
+    """Raised when the write-behind queue has no room for a submission"""
+
+
+class WriteBehindWriter:
+    """Buffers readings in memory and group-commits them from a background thread.
+
+    Rows are handed to write_rows(rows) in groups of up to batch_rows, at least
+    every flush_interval seconds while anything is pending. The queue is bounded
+    by max_rows; submissions that do not fit raise QueueFullError so the caller
+    can apply backpressure. A group that write_rows fails on is dropped and
+    handed to on_failure(rows), if set.
+    """
+
+    def __init__(self, write_rows, max_rows=10000, batch_rows=500, flush_interval=0.05, on_failure=None):
+        self._write_rows = write_rows
+        self.on_failure = on_failure
+        self.max_rows = max_rows
+        self.batch_rows = batch_rows
+        self.flush_interval = flush_interval
+
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._flush_requested = False
+        self._in_flight = 0
+
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.rows_rejected = 0
+        self.commits = 0
+        self.commit_seconds_total = 0.0
+        self.commit_seconds_max = 0.0
+        self.last_commit_seconds = 0.0
+        self.last_error = None
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+            self._thread.start()
+
+    def submit(self, rows):
+        """Queue rows for writing, all or nothing"""
+        if self._thread is None or not self._thread.is_alive():
+            self.start()
+        with self._cond:
+            if len(self._pending) + len(rows) > self.max_rows:
+                self.rows_rejected += len(rows)
+                raise QueueFullError("Ingestion queue is full")
+            was_empty = not self._pending
+            self._pending.extend(rows)
+            if was_empty or len(self._pending) >= self.batch_rows:
+                self._cond.notify()
+
+    def flush(self, timeout=None):
+        """Block until everything submitted so far has been written"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._pending or self._in_flight:
+                if self._thread is None or not self._thread.is_alive():
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            if not self._pending and not self._in_flight:
+                self._flush_requested = False
+        if self._pending:
+            # No writer thread (e.g. during interpreter shutdown); write inline
+            self._write_batch(self._take(len(self._pending)))
+        return True
+
+    def stop(self, timeout=10):
+        """Flush pending rows and stop the writer thread"""
+        self.flush(timeout)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self):
+        commits = self.commits
+        return {
+            "queue_depth": self.depth,
+            "queue_capacity": self.max_rows,
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "rows_rejected": self.rows_rejected,
+            "commits": commits,
+            "commit_latency_ms": {
+                "last": round(self.last_commit_seconds * 1000, 3),
+                "avg": round(self.commit_seconds_total / commits * 1000, 3) if commits else 0.0,
+                "max": round(self.commit_seconds_max * 1000, 3)
+            },
+            "last_error": self.last_error
+        }
+
+    def _take(self, count):
+        return [self._pending.popleft() for _ in range(min(count, len(self._pending)))]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._pending and not self._stopping:
+                    self._cond.wait()
+                if self._stopping and not self._pending:
+                    return
+                # Give a partial group until flush_interval to fill up
+                deadline = time.monotonic() + self.flush_interval
+                while (len(self._pending) < self.batch_rows and not self._stopping
+                       and not self._flush_requested):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take(self.batch_rows)
+                if not self._pending:
+                    self._flush_requested = False
+                self._in_flight = len(batch)
+
+            self._write_batch(batch)
+
+            with self._cond:
+                self._in_flight = 0
+                self._cond.notify_all()
+
+    def _write_batch(self, batch):
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            self._write_rows(batch)
+        except Exception as e:
+            self.rows_failed += len(batch)
+            self.last_error = str(e)
+            print(f"Write-behind commit of {len(batch)} readings failed: {e}")
+            if self.on_failure is not None:
+                try:
+                    self.on_failure(batch)
+                except Exception as e:
+                    print(f"Write-behind failure handler failed: {e}")
+            return
+        elapsed = time.perf_counter() - started
+        self.rows_written += len(batch)
+        self.commits += 1
+        self.commit_seconds_total += elapsed
+        self.last_commit_seconds = elapsed
+        if elapsed > self.commit_seconds_max:
+            self.commit_seconds_max = elapsed
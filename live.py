@@ -0,0 +1,143 @@
+"""In-memory fan-out of newly stored readings to live subscribers.
+
+The ingestion paths publish every group of readings once it is committed. The
+hub keeps the latest reading of each sensor and hands each subscriber a
+bounded queue. A new subscriber first gets a snapshot of the latest readings
+of the sensors it asked for, taken from memory, and then only the new
+readings. The database is read once per process, to seed the latest readings,
+never per subscriber. A subscriber that falls MAX_PENDING batches behind is
+dropped rather than left to hold memory. It reconnects and starts again from
+a fresh snapshot.
+
+Under gunicorn the writer process relays every committed group to each
+worker's hub, so a worker streams the readings of all of them (see
+writer_process.py).
+"""
+import json
+import queue
+import threading
+
+import rollups
+
+MAX_PENDING = 256
+HEARTBEAT_SECONDS = 15
+# How often an idle stream checks whether the server is shutting down
+POLL_SECONDS = 1
+
+FIELDS = ('sensor_id', 'aqi_value', 'co2_ppm', 'aqi_category', 'timestamp')
+
+
+class Subscription:
+    def __init__(self, sensor_ids):
+        self.sensor_ids = sensor_ids
+        self.queue = queue.Queue(MAX_PENDING)
+        self.dropped = False
+
+
+class BroadcastHub:
+    def __init__(self, load_latest):
+        """load_latest() returns the stored latest reading of every sensor as FIELDS tuples"""
+        self._load_latest = load_latest
+        self._lock = threading.Lock()
+        self._latest = {}
+        self._loaded = False
+        self._subscribers = set()
+        self._listeners = []
+        self.closing = False
+
+    def _merge(self, rows):
+        # Readings can arrive out of order; keep the newest per sensor
+        latest = self._latest
+        for row in rows:
+            current = latest.get(row[0])
+            if current is None or (row[4] or 0) >= (current[4] or 0):
+                latest[row[0]] = tuple(row)
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        rows = self._load_latest()
+        with self._lock:
+            if not self._loaded:
+                self._merge(rows)
+                self._loaded = True
+
+    def publish(self, rows):
+        """Send committed readings, as (sensor_id, aqi_value, co2_ppm, aqi_category, ts) rows, to subscribers"""
+        with self._lock:
+            self._merge(rows)
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            if sub.sensor_ids is None:
+                batch = rows
+            else:
+                batch = [row for row in rows if row[0] in sub.sensor_ids]
+            if not batch:
+                continue
+            try:
+                sub.queue.put_nowait(batch)
+            except queue.Full:
+                sub.dropped = True
+                self.unsubscribe(sub)
+        for listener in self._listeners:
+            listener(rows)
+
+    def add_listener(self, callback):
+        """Also hand every published group to callback(rows), e.g. to relay it to other processes"""
+        self._listeners.append(callback)
+
+    def close(self):
+        """End every stream within POLL_SECONDS; only sets a flag, so safe in a signal handler"""
+        self.closing = True
+
+    def forget(self, sensor_id):
+        with self._lock:
+            self._latest.pop(sensor_id, None)
+
+    def subscribe(self, sensor_ids=None):
+        """Return (subscription, snapshot rows); sensor_ids None means every sensor"""
+        self._ensure_loaded()
+        sub = Subscription(set(sensor_ids) if sensor_ids is not None else None)
+        with self._lock:
+            self._subscribers.add(sub)
+            snapshot = [row for sensor_id, row in self._latest.items()
+                        if sub.sensor_ids is None or sensor_id in sub.sensor_ids]
+        return sub, snapshot
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+
+def _event(name, rows):
+    # Rows carry ts in epoch milliseconds; the stream shows it as an ISO timestamp
+    data = json.dumps([dict(zip(FIELDS, tuple(row[:4]) + (rollups.ms_to_iso(row[4]),))) for row in rows],
+                      separators=(',', ':'))
+    return f'event: {name}\ndata: {data}\n\n'
+
+
+def stream(hub, sensor_ids=None, heartbeat=HEARTBEAT_SECONDS):
+    """Yield Server-Sent Events: one "snapshot", then a "readings" event per new batch"""
+    sub, snapshot = hub.subscribe(sensor_ids)
+    try:
+        # Reconnect after 3 seconds if the connection drops
+        yield 'retry: 3000\n'
+        yield _event('snapshot', snapshot)
+        idle = 0.0
+        while not sub.dropped and not hub.closing:
+            try:
+                batch = sub.queue.get(timeout=min(POLL_SECONDS, heartbeat))
+            except queue.Empty:
+                idle += min(POLL_SECONDS, heartbeat)
+                if idle >= heartbeat:
+                    # Comment line; keeps proxies from closing an idle connection
+                    yield ': keepalive\n\n'
+                    idle = 0.0
+                continue
+            idle = 0.0
+            yield _event('readings', batch)
+    finally:
+        hub.unsubscribe(sub)
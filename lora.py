@@ -0,0 +1,248 @@
+"""Parsing of the payloads LoRa sensors send.
+
+Three payload forms are accepted, all returning (aqi_value, co2_ppm, zone):
+
+- Text, as sent by sender.ino: "CO2:812.4 ppm,AQI:90,Zone:Moderate". Fields may
+  come in any order and any case, separated by "," or ";", with ":" or "="
+  after the name and an optional "ppm" unit. Unknown fields are ignored.
+- Compact CSV: "812.4,90" or "812.4,90,Moderate", i.e. CO2 ppm, AQI and an
+  optional zone. A bare number is an AQI value, as before.
+- Binary frame: 5 bytes, big-endian. A version byte (1), CO2 in tenths of a
+  ppm (uint16) and the AQI (uint16). 0xFFFF marks a value that was not
+  measured. The zone is not sent and is left to the server.
+
+Each form is matched by a single precompiled pattern or struct, in one pass
+over the payload.
+
+Command line use:
+
+    python lora.py --bench          # parse throughput of each form on one core
+    python lora.py --fuzz 100000    # mutate the corpus and check every failure is a PayloadError
+"""
+import argparse
+import math
+import random
+import re
+import struct
+import time
+
+FRAME_VERSION = 1
+FRAME_MIMETYPE = 'application/octet-stream'
+MISSING = 0xFFFF
+
+_FRAME = struct.Struct('>BHH')
+FRAME_SIZE = _FRAME.size
+
+_NUMBER = r'[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?'
+
+# One "name: value" field of a text payload. Only the names we know start a
+# match, so "ppm" or other text before them is skipped over.
+_FIELD = re.compile(r'\b(?:(co2)|(aqi)|zone|category)\s*[:=]\s*([^,;\r\n]*)', re.IGNORECASE)
+
+_MEASUREMENT = re.compile(rf'({_NUMBER})\s*(?:ppm)?\s*', re.IGNORECASE)
+
+_CSV = re.compile(rf'\s*({_NUMBER})\s*,\s*({_NUMBER})\s*(?:,\s*([^,]*?)\s*)?')
+
+_BARE = re.compile(rf'\s*({_NUMBER})\s*')
+
+
+class PayloadError(ValueError):
+    pass
+
+
+def parse_frame(frame):
+    """Parse one binary frame into (aqi_value, co2_ppm, None)"""
+    if len(frame) != FRAME_SIZE:
+        raise PayloadError(f"Binary frame must be {FRAME_SIZE} bytes, got {len(frame)}")
+    version, co2_tenths, aqi = _FRAME.unpack(frame)
+    if version != FRAME_VERSION:
+        raise PayloadError(f"Unsupported frame version {version}")
+    if aqi == MISSING and co2_tenths == MISSING:
+        raise PayloadError("Frame carries neither AQI nor CO2")
+    return (None if aqi == MISSING else float(aqi),
+            None if co2_tenths == MISSING else co2_tenths / 10.0,
+            None)
+
+
+def split_frames(data):
+    """Split a request body of back-to-back binary frames"""
+    if not data or len(data) % FRAME_SIZE:
+        raise PayloadError(f"Body must be a whole number of {FRAME_SIZE}-byte frames")
+    return [data[i:i + FRAME_SIZE] for i in range(0, len(data), FRAME_SIZE)]
+
+
+def encode_frame(aqi_value=None, co2_ppm=None):
+    """Build a binary frame, e.g. for a sender or for testing"""
+    aqi = MISSING if aqi_value is None else int(round(aqi_value))
+    co2_tenths = MISSING if co2_ppm is None else int(round(co2_ppm * 10))
+    if not 0 <= aqi <= MISSING or not 0 <= co2_tenths <= MISSING:
+        raise PayloadError("Value out of range for a binary frame")
+    return _FRAME.pack(FRAME_VERSION, co2_tenths, aqi)
+
+
+def _number(text, name):
+    # The pattern only matches digits, but an exponent can still overflow to inf
+    value = float(text)
+    if not math.isfinite(value):
+        raise PayloadError(f"{name} value {text} is out of range")
+    return value
+
+
+def _parse_text(payload):
+    aqi_value = co2_ppm = zone = None
+    for match in _FIELD.finditer(payload):
+        is_co2, is_aqi, raw = match.groups()
+        if is_co2 or is_aqi:
+            number = _MEASUREMENT.fullmatch(raw)
+            if not number:
+                name = 'CO2' if is_co2 else 'AQI'
+                raise PayloadError(f"Invalid {name} value {raw.strip()!r}")
+            # The first occurrence of a field wins
+            if is_co2 and co2_ppm is None:
+                co2_ppm = _number(number.group(1), 'CO2')
+            elif is_aqi and aqi_value is None:
+                aqi_value = _number(number.group(1), 'AQI')
+        elif zone is None:
+            zone = raw.rstrip() or None
+    return aqi_value, co2_ppm, zone
+
+
+def parse(payload):
+    """Parse a text or binary payload into (aqi_value, co2_ppm, zone).
+
+    Raises PayloadError saying what was wrong when the payload holds neither
+    an AQI nor a CO2 value.
+    """
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return parse_frame(payload)
+    if not isinstance(payload, str):
+        raise PayloadError("Value must be a number or a LoRa payload string")
+
+    match = _BARE.fullmatch(payload)
+    if match:
+        return _number(match.group(1), 'AQI'), None, None
+
+    match = _CSV.fullmatch(payload)
+    if match:
+        co2, aqi, zone = match.groups()
+        return _number(aqi, 'AQI'), _number(co2, 'CO2'), zone or None
+
+    aqi_value, co2_ppm, zone = _parse_text(payload)
+    if aqi_value is None and co2_ppm is None:
+        raise PayloadError(f"Could not find an AQI or CO2 value in {payload[:80]!r}")
+    return aqi_value, co2_ppm, zone
+
+
+# Sample payloads and what they parse to; the seeds for --fuzz and --bench
+CORPUS = [
+    ("CO2:812.4 ppm,AQI:90,Zone:Moderate", (90.0, 812.4, 'Moderate')),
+    ("CO2: 412 ppm, AQI: 42, Zone: Good", (42.0, 412.0, 'Good')),
+    ("co2:412ppm,aqi:42,zone:Good", (42.0, 412.0, 'Good')),
+    ("AQI:160,CO2:1880.0 ppm,Zone:Unhealthy", (160.0, 1880.0, 'Unhealthy')),
+    ("ppm units; CO2=950.5; AQI=100; RSSI=-71; Zone=Moderate", (100.0, 950.5, 'Moderate')),
+    ("CO2:5000.0 ppm,AQI:500,Zone:Hazardous,SNR:9.5", (500.0, 5000.0, 'Hazardous')),
+    ("CO2:400.0 ppm", (None, 400.0, None)),
+    ("AQI:7", (7.0, None, None)),
+    ("AQI:120,Zone:Unhealthy for Sensitive Groups", (120.0, None, 'Unhealthy for Sensitive Groups')),
+    ("812.4,90", (90.0, 812.4, None)),
+    ("812.4,90,Moderate", (90.0, 812.4, 'Moderate')),
+    ("125", (125.0, None, None)),
+    (" 42.5 ", (42.5, None, None)),
+    (b'\x01\x1f\xbc\x00\x5a', (90.0, 812.4, None)),
+    (b'\x01\xff\xff\x00\x07', (7.0, None, None)),
+]
+
+INVALID = [
+    "", "Zone:Good", "CO2:abc ppm,AQI:90", "AQI:,CO2:", "nan", "inf",
+    "1e400", "-1e400", "AQI: 1e400", "CO2: 1e999 ppm, AQI: 40", "1e999,40",
+    "hello world", "1,2,3,4", b'', b'\x02\x1f\xbc\x00\x5a', b'\x01\xff\xff\xff\xff', b'\x01\x00',
+]
+
+
+def _mutate(rng, payload):
+    data = bytearray(payload if isinstance(payload, bytes) else payload.encode())
+    for _ in range(rng.randint(1, 4)):
+        op = rng.randrange(5)
+        pos = rng.randrange(len(data) + 1)
+        if op == 0 and data:
+            del data[min(pos, len(data) - 1)]
+        elif op == 1:
+            data.insert(pos, rng.randrange(256))
+        elif op == 2:
+            data.insert(pos, ord(rng.choice(':,;= .-eE')))
+        elif op == 3:
+            data = data[:pos]
+        elif data:
+            pos = min(pos, len(data) - 1)
+            data[pos] = ord(chr(data[pos]).swapcase()) if data[pos] < 128 else data[pos]
+    if isinstance(payload, bytes):
+        return bytes(data)
+    return data.decode('utf-8', errors='replace')
+
+
+def check_corpus():
+    for payload, expected in CORPUS:
+        got = parse(payload)
+        if got != expected:
+            raise AssertionError(f"{payload!r} parsed to {got}, expected {expected}")
+    for payload in INVALID:
+        try:
+            parse(payload)
+        except PayloadError:
+            continue
+        raise AssertionError(f"{payload!r} should have been rejected")
+
+
+def fuzz(iterations, seed=0):
+    """Parse mutated corpus payloads; anything other than a result or PayloadError is a bug"""
+    rng = random.Random(seed)
+    seeds = [payload for payload, _ in CORPUS] + INVALID
+    parsed = rejected = 0
+    for _ in range(iterations):
+        payload = _mutate(rng, rng.choice(seeds))
+        try:
+            parse(payload)
+            parsed += 1
+        except PayloadError:
+            rejected += 1
+    return parsed, rejected
+
+
+def bench(seconds=1.0):
+    """Parses per second on one core for each payload form"""
+    forms = {
+        'text': "CO2:812.4 ppm,AQI:90,Zone:Moderate",
+        'csv': "812.4,90,Moderate",
+        'binary': encode_frame(90, 812.4),
+    }
+    results = {}
+    for name, payload in forms.items():
+        count = 0
+        start = time.perf_counter()
+        elapsed = 0.0
+        while elapsed < seconds:
+            for _ in range(1000):
+                parse(payload)
+            count += 1000
+            elapsed = time.perf_counter() - start
+        results[name] = count / elapsed
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='LoRa payload parser checks')
+    parser.add_argument('--bench', action='store_true', help='Measure parse throughput per core')
+    parser.add_argument('--seconds', type=float, default=1.0, help='Benchmark time per payload form')
+    parser.add_argument('--fuzz', type=int, metavar='N', help='Parse N mutated corpus payloads')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for --fuzz')
+
+    args = parser.parse_args()
+
+    check_corpus()
+    print(f"Corpus OK: {len(CORPUS)} valid and {len(INVALID)} invalid payloads")
+    if args.fuzz:
+        parsed, rejected = fuzz(args.fuzz, args.seed)
+        print(f"Fuzzed {args.fuzz} payloads: {parsed} parsed, {rejected} rejected with PayloadError")
+    if args.bench:
+        for name, rate in bench(args.seconds).items():
+            print(f"{name:>8}: {rate:,.0f} parses/s ({1e6 / rate:.2f} us each)")
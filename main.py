@@ -1,148 +1,717 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for, flash
+from flask import Flask, Response, request, jsonify, render_template, redirect, url_for, flash, g, session, make_response
 import sqlite3
 import os
-import datetime
+import atexit
+import functools
+import math
+import time
+
+import numpy as np
+
+import alerts
+import aqi
+import cache
+import categories
+import db
+import dedup
+import downsample
+import export
+import ingest
+import live
+import lora
+import migrations
+import pagination
+import registry
+import retention
+import rollups
+import shards
+import telemetry
+import writer_process
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)  # For flash messages
+app.secret_key = os.environ.get('SECRET_KEY') or os.urandom(24)  # For flash messages
+
+# Write-behind ingestion: readings are acknowledged once validated and queued,
+# and a background thread group-commits them every INGEST_BATCH_ROWS rows or
+# INGEST_FLUSH_MS milliseconds. Set INGEST_WRITE_BEHIND=0 to commit per request.
+WRITE_BEHIND = os.environ.get('INGEST_WRITE_BEHIND', '1') != '0'
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 10000))
+INGEST_BATCH_ROWS = int(os.environ.get('INGEST_BATCH_ROWS', 500))
+INGEST_FLUSH_MS = int(os.environ.get('INGEST_FLUSH_MS', 50))
 
 # Initialize database
 def init_db():
-    conn = sqlite3.connect('sensor_data.db')
+    conn = db.connect()
+    # Versioned schema changes; large data rewrites continue in the background
+    migrations.upgrade(conn)
     c = conn.cursor()
-    
-    # Check if database exists and has the old schema
+
+    init_indexes(c)
+    init_latest_readings(c)
+    init_rollups(c)
+    retention.init_tables(c)
+    cache.init_tables(c)
+    conn.commit()
+    conn.close()
+
+def init_indexes(c):
+    # Per-sensor history and latest-reading lookups
+    c.execute('CREATE INDEX IF NOT EXISTS idx_readings_sensor_ts ON readings (sensor_id, ts)')
+    # Time-range scans across all sensors (dashboard)
+    c.execute('CREATE INDEX IF NOT EXISTS idx_readings_ts ON readings (ts)')
+    # Keys of readings that devices may send again; most readings have none
+    c.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_readings_dedup ON readings (sensor_id, dedup_key)
+        WHERE dedup_key IS NOT NULL
+    ''')
+    # Sensor names identify sensors to /api/sensor/register and the LoRa default
     try:
-        c.execute('SELECT * FROM readings LIMIT 1')
-        # If we get here, table exists. Let's check the columns
-        columns = [description[0] for description in c.description]
-        
-        # If we don't have the new columns, alter the table
-        if 'aqi_value' not in columns:
-            print("Upgrading database schema...")
-            # Rename old table
-            c.execute('ALTER TABLE readings RENAME TO readings_old')
-            
-            # Create new table with updated schema
+        c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_sensors_name ON sensors (name)')
+        c.execute('DROP INDEX IF EXISTS idx_sensors_name_lookup')
+    except sqlite3.IntegrityError:
+        duplicates = [row[0] for row in c.execute(
+            'SELECT name FROM sensors GROUP BY name HAVING COUNT(*) > 1')]
+        print(f"Sensor names are not unique ({', '.join(duplicates)}); "
+              "rename these sensors and restart to add the unique name index")
+        c.execute('CREATE INDEX IF NOT EXISTS idx_sensors_name_lookup ON sensors (name)')
+
+def init_rollups(c):
+    c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'readings_1m'")
+    existed = c.fetchone() is not None
+    rollups.init_tables(c)
+    if not existed:
+        c.execute('SELECT 1 FROM readings LIMIT 1')
+        if c.fetchone() is not None:
+            print("Rollup tables created; run `python rollups.py --backfill` to include existing readings")
+
+def init_latest_readings(c):
+    """Create the sensor_latest cache and the triggers that keep it current.
+
+    sensor_latest holds one row per sensor with its most recent reading, so the
+    overview page does a primary-key lookup per sensor instead of scanning
+    readings. Triggers maintain it for every insert, update and delete, whichever
+    code path makes the change. Existing databases are backfilled the first time.
+    """
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sensor_latest (
+            sensor_id INTEGER PRIMARY KEY,
+            reading_id INTEGER,
+            aqi_value REAL,
+            co2_ppm REAL,
+            category_id INTEGER,
+            ts INTEGER
+        )
+    ''')
+
+    # Newer readings replace the cached one; late, older readings leave it alone
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS readings_latest_insert AFTER INSERT ON readings
+        BEGIN
+            INSERT INTO sensor_latest (sensor_id, reading_id, aqi_value, co2_ppm, category_id, ts)
+            VALUES (NEW.sensor_id, NEW.id, NEW.aqi_value, NEW.co2_ppm, NEW.category_id, NEW.ts)
+            ON CONFLICT (sensor_id) DO UPDATE SET
+                reading_id = excluded.reading_id,
+                aqi_value = excluded.aqi_value,
+                co2_ppm = excluded.co2_ppm,
+                category_id = excluded.category_id,
+                ts = excluded.ts
+            WHERE sensor_latest.ts IS NULL OR excluded.ts >= sensor_latest.ts;
+        END
+    ''')
+
+    # Deleting the cached reading falls back to the next latest, found through the index
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS readings_latest_delete AFTER DELETE ON readings
+        WHEN OLD.id = (SELECT reading_id FROM sensor_latest WHERE sensor_id = OLD.sensor_id)
+        BEGIN
+            DELETE FROM sensor_latest WHERE sensor_id = OLD.sensor_id;
+            INSERT INTO sensor_latest (sensor_id, reading_id, aqi_value, co2_ppm, category_id, ts)
+            SELECT sensor_id, id, aqi_value, co2_ppm, category_id, ts
+            FROM readings WHERE sensor_id = OLD.sensor_id
+            ORDER BY ts DESC, id DESC LIMIT 1;
+        END
+    ''')
+
+    # Edits are rare; recompute both affected sensors. Rows converted by the
+    # timestamp migration (ts set, timestamp cleared) were seen already.
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS readings_latest_update
+        AFTER UPDATE OF sensor_id, aqi_value, co2_ppm, category_id, ts ON readings
+        WHEN OLD.ts IS NOT NULL OR NEW.timestamp IS NOT NULL
+        BEGIN
+            DELETE FROM sensor_latest WHERE sensor_id IN (OLD.sensor_id, NEW.sensor_id);
+            INSERT INTO sensor_latest (sensor_id, reading_id, aqi_value, co2_ppm, category_id, ts)
+            SELECT sensor_id, id, aqi_value, co2_ppm, category_id, ts
+            FROM readings WHERE sensor_id = OLD.sensor_id
+            ORDER BY ts DESC, id DESC LIMIT 1;
+            INSERT OR REPLACE INTO sensor_latest (sensor_id, reading_id, aqi_value, co2_ppm, category_id, ts)
+            SELECT sensor_id, id, aqi_value, co2_ppm, category_id, ts
+            FROM readings WHERE sensor_id = NEW.sensor_id
+            ORDER BY ts DESC, id DESC LIMIT 1;
+        END
+    ''')
+
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS sensors_latest_delete AFTER DELETE ON sensors
+        BEGIN
+            DELETE FROM sensor_latest WHERE sensor_id = OLD.id;
+        END
+    ''')
+
+    # Migration for databases created before sensor_latest existed
+    c.execute('SELECT 1 FROM sensor_latest LIMIT 1')
+    if c.fetchone() is None:
+        c.execute('SELECT 1 FROM readings LIMIT 1')
+        if c.fetchone() is not None:
+            print("Building latest-reading cache...")
             c.execute('''
-                CREATE TABLE readings (
-                    id INTEGER PRIMARY KEY,
-                    sensor_id INTEGER,
-                    aqi_value REAL,
-                    co2_ppm REAL,
-                    aqi_category TEXT,
-                    timestamp DATETIME,
-                    FOREIGN KEY (sensor_id) REFERENCES sensors (id)
+                INSERT INTO sensor_latest (sensor_id, reading_id, aqi_value, co2_ppm, category_id, ts)
+                SELECT r.sensor_id, r.id, r.aqi_value, r.co2_ppm, r.category_id, r.ts
+                FROM (SELECT DISTINCT sensor_id FROM readings) s
+                JOIN readings r ON r.id = (
+                    SELECT id FROM readings
+                    WHERE sensor_id = s.sensor_id
+                    ORDER BY ts DESC, id DESC LIMIT 1
                 )
             ''')
-            
-            # Migrate old data
-            c.execute('''
-                INSERT INTO readings (id, sensor_id, aqi_value, timestamp)
-                SELECT id, sensor_id, value, timestamp FROM readings_old
-            ''')
-            
-            # Drop old table
-            c.execute('DROP TABLE readings_old')
-            
-            conn.commit()
-            print("Database schema upgraded successfully")
-    except sqlite3.OperationalError:
-        # Table doesn't exist, create from scratch
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS sensors (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                description TEXT
-            )
-        ''')
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS readings (
-                id INTEGER PRIMARY KEY,
-                sensor_id INTEGER,
-                aqi_value REAL,
-                co2_ppm REAL,
-                aqi_category TEXT,
-                timestamp DATETIME,
-                FOREIGN KEY (sensor_id) REFERENCES sensors (id)
-            )
-        ''')
-        
-        # Add a default AQI sensor if not exists
-        c.execute('INSERT OR IGNORE INTO sensors (name, description) VALUES (?, ?)', 
-                  ('Default AQI Sensor', 'Automatically created AQI sensor'))
-        
-        conn.commit()
-        print("Database initialized with new schema")
-    
-    conn.close()
+
+# Connections are shared between requests through the pool. A request checks one
+# out on first use and returns it when the app context is torn down.
+pool = db.ConnectionPool()
+sensors_cache = registry.SensorRegistry()
 
 def get_db_connection():
-    conn = sqlite3.connect('sensor_data.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    if 'db' not in g:
+        g.db = pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        pool.release(conn)
+
+telemetry.describe('http_request_duration_seconds', 'histogram', 'Time to build the response, by route')
+telemetry.describe('http_requests_total', 'counter', 'Requests answered, by route and status')
+telemetry.describe('readings_ingested_total', 'counter', 'Readings accepted, by route and sensor')
+telemetry.describe('readings_rejected_total', 'counter', 'Readings refused, by route and HTTP status')
+# Under gunicorn each process saves its metrics for the others to serve
+telemetry.start_dumping()
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+    started = g.get('request_started')
+    if started is not None:
+        route = (('route', request.endpoint or 'unmatched'), ('method', request.method))
+        telemetry.observe('http_request_duration_seconds', route, time.perf_counter() - started)
+        telemetry.inc('http_requests_total', route + (('status', str(response.status_code)),))
+    return response
+
+# Polled read routes are answered from the response cache while their data is unchanged
+response_cache = cache.ResponseCache()
+
+telemetry.describe('response_cache_requests_total', 'counter',
+                   'Cached routes answered, by route and result (hit, miss or not_modified)')
+telemetry.describe('response_cache_bytes', 'gauge', 'Size of the bodies held by the response cache')
+
+@telemetry.gauge
+def response_cache_gauges():
+    return [('response_cache_bytes', (), response_cache.stats()['bytes'])]
+
+def cached_response(versions):
+    """Serve a GET route through the response cache.
+
+    versions(conn, **view_args) returns what the response depends on besides
+    its URL, normally cache.versions() of the sensors it shows, or None to
+    run the route uncached.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**view_args):
+            # Pages with pending flash messages have to render them
+            if not response_cache.enabled or session.get('_flashes'):
+                return view(**view_args)
+            state = versions(get_db_connection(), **view_args)
+            if state is None:
+                return view(**view_args)
+            tag = cache.etag((request.path, sorted(request.args.items(multi=True)), state))
+            route = (('route', request.endpoint),)
+
+            if request.if_none_match.contains_weak(tag):
+                result = 'not_modified'
+                response = Response(status=304)
+            else:
+                entry = response_cache.get(tag)
+                if entry is not None:
+                    result = 'hit'
+                    response = Response(entry[0], headers=entry[1])
+                else:
+                    result = 'miss'
+                    response = make_response(view(**view_args))
+                    if response.status_code != 200:
+                        return response
+                    response_cache.put(tag, response.get_data(), list(response.headers))
+            telemetry.inc('response_cache_requests_total', route + (('result', result),))
+            response.set_etag(tag)
+            # Browsers may keep the body but must revalidate it on every use
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def all_sensor_versions(conn):
+    return cache.versions(conn)
+
+def sensor_versions(conn, sensor_id):
+    return cache.versions(conn, [sensor_id])
+
+# A cached dashboard over the default range, which ends now, moves on this often
+DASHBOARD_WINDOW_STEP = 60
+
+def dashboard_versions(conn):
+    try:
+        sensor_ids = get_int_list_arg('sensors')
+    except ValueError:
+        return None
+    return moving_window_versions(cache.versions(conn, sensor_ids))
+
+def derived_versions(conn, sensor_id):
+    return moving_window_versions(cache.versions(conn, [sensor_id]))
+
+def moving_window_versions(state):
+    if not request.args.get('to'):
+        state = (state, rollups.now_epoch() // DASHBOARD_WINDOW_STEP)
+    return state
+
+DEFAULT_SENSOR_NAME = 'Default AQI Sensor'
+DEFAULT_SENSOR_DESCRIPTION = 'Automatically created AQI sensor'
+
+class ReadingError(ValueError):
+    """A submitted reading that failed validation, with the HTTP status to report"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+def finite_number(value, name):
+    """value as a float; NaN, Infinity and numbers too large for a float are rejected"""
+    try:
+        number = float(value)
+    except (TypeError, ValueError, OverflowError):
+        raise ReadingError(f"{name} must be a number")
+    if not math.isfinite(number):
+        raise ReadingError(f"{name} must be a finite number")
+    return number
+
+def parse_reading_value(value):
+    """Parse a reading value into (aqi_value, co2_ppm, aqi_category)"""
+    if isinstance(value, bool):
+        raise ReadingError("Value must be a number or a LoRa payload string")
+
+    # A direct numeric value is the AQI
+    if isinstance(value, (int, float)):
+        return finite_number(value, "Value"), None, None
 
-def get_aqi_category(aqi):
     try:
-        aqi_value = float(aqi)
-        if aqi_value <= 50:
-            return "Good", "good"
-        elif aqi_value <= 100:
-            return "Moderate", "moderate"
-        elif aqi_value <= 150:
-            return "Unhealthy for Sensitive Groups", "unhealthy-sensitive"
-        elif aqi_value <= 200:
-            return "Unhealthy", "unhealthy"
-        elif aqi_value <= 300:
-            return "Very Unhealthy", "very-unhealthy"
+        return lora.parse(value)
+    except lora.PayloadError as e:
+        raise ReadingError(str(e))
+
+def prepare_reading(item, require_sensor_id, now):
+    """Validate one submitted reading and return its row for the readings table"""
+    if not isinstance(item, dict):
+        raise ReadingError("Each reading must be a JSON object")
+
+    sensor_id = item.get('sensor_id')
+    # Only the LoRa route falls back to the default sensor; an empty
+    # ?sensor_id= on a binary upload counts as leaving it out
+    if sensor_id == '' and not require_sensor_id:
+        sensor_id = None
+    if require_sensor_id:
+        if sensor_id is None or 'value' not in item:
+            raise ReadingError("Sensor ID and value are required")
+    elif 'value' not in item:
+        raise ReadingError("Value is required")
+
+    if sensor_id is not None:
+        if isinstance(sensor_id, bool):
+            raise ReadingError("Sensor ID must be an integer")
+        try:
+            sensor_id = int(sensor_id)
+        except (TypeError, ValueError):
+            raise ReadingError("Sensor ID must be an integer")
+
+    aqi_value, co2_ppm, aqi_category = parse_reading_value(item['value'])
+    if item.get('co2_ppm') is not None and co2_ppm is None:
+        if isinstance(item['co2_ppm'], bool):
+            raise ReadingError("co2_ppm must be a number")
+        co2_ppm = finite_number(item['co2_ppm'], "co2_ppm")
+
+    timestamp = item.get('timestamp')
+    ts = None
+    if timestamp:
+        ts = rollups.to_ms(timestamp)
+        if ts is None:
+            raise ReadingError("timestamp must be an ISO timestamp or epoch seconds or milliseconds, in the years 1 to 9999")
+    try:
+        key = dedup.reading_key(item, ts)
+    except ValueError as e:
+        raise ReadingError(str(e))
+    return [sensor_id, aqi_value, co2_ppm, aqi_category, ts if ts is not None else now, key]
+
+def insert_readings(conn, rows):
+    """Store rows of (sensor_id, aqi_value, co2_ppm, aqi_category, ts[, dedup_key]), category by name.
+
+    Rows whose dedup_key is already stored are skipped. Returns the rows stored.
+    """
+    stored = []
+    plain = []
+    codes = categories.codes(conn, [row[3] for row in rows])
+
+    def flush():
+        if not plain:
+            return
+        conn.executemany('''
+            INSERT INTO readings (sensor_id, aqi_value, co2_ppm, category_id, ts)
+            VALUES (?, ?, ?, ?, ?)
+        ''', [(row[0], row[1], row[2], codes[row[3]], row[4]) for row in plain])
+        stored.extend(plain)
+        plain.clear()
+
+    for row in rows:
+        if len(row) <= 5 or row[5] is None:
+            plain.append(row)
+            continue
+        flush()
+        # Another process may have stored the same key since it was checked,
+        # so the conflict is skipped here rather than looked up beforehand
+        cursor = conn.execute('''
+            INSERT INTO readings (sensor_id, aqi_value, co2_ppm, category_id, ts, dedup_key)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (sensor_id, dedup_key) WHERE dedup_key IS NOT NULL DO NOTHING
+        ''', (row[0], row[1], row[2], codes[row[3]], row[4], row[5]))
+        if cursor.rowcount:
+            stored.append(row)
+    flush()
+
+    if len(stored) < len(rows):
+        telemetry.inc('readings_duplicate_total', (('stage', 'database'),), len(rows) - len(stored))
+    rollups.apply(conn, stored)
+    cache.bump(conn, [row[0] for row in stored])
+    return stored
+
+def load_latest_readings():
+    with pool.connection() as conn:
+        return conn.execute('''
+            SELECT l.sensor_id, l.aqi_value, l.co2_ppm, c.name, l.ts FROM sensor_latest l
+            LEFT JOIN aqi_categories c ON c.id = l.category_id
+        ''').fetchall()
+
+# Under gunicorn, readings are committed by the single writer process
+writer_client = writer_process.WriterClient()
+# Live subscribers are sent each group of readings once it is committed
+hub = live.BroadcastHub(load_latest_readings)
+# Alert rules see the readings committed by this process (under gunicorn, the
+# writer process sees all of them), see alerts.py
+alerter = alerts.AlertEngine()
+atexit.register(alerter.stop)
+
+def readings_committed(rows):
+    """Hand committed readings to the live streams and the alert rules"""
+    if not rows:
+        return
+    if writer_client.enabled:
+        # Under gunicorn the writer process does both, once for all workers
+        try:
+            writer_client.committed(rows)
+            return
+        except OSError as e:
+            print(f"Writer process unreachable, only this worker streams {len(rows)} readings: {e}")
+    hub.publish(rows)
+    alerter.observe(rows)
+
+def write_readings(rows):
+    """Commit a group of readings; called from the write-behind thread"""
+    with pool.connection() as conn:
+        with conn:
+            rows = insert_readings(conn, rows)
+    readings_committed(rows)
+
+def forward_readings(rows):
+    try:
+        writer_client.send(rows)
+    except OSError as e:
+        # The writer process is down until the gunicorn master starts it
+        # again; the readings were already accepted, so store them here
+        print(f"Writer process unreachable, committing {len(rows)} readings in this worker: {e}")
+        write_readings(rows)
+
+def readings_failed(rows):
+    """Forget the keys of readings that were not stored, so the device's retry is not taken for a copy"""
+    recent_keys.discard(dedup.row_keys(rows))
+
+writer = ingest.WriteBehindWriter(forward_readings if writer_client.enabled else write_readings,
+                                  max_rows=INGEST_QUEUE_SIZE,
+                                  batch_rows=INGEST_BATCH_ROWS,
+                                  flush_interval=INGEST_FLUSH_MS / 1000.0,
+                                  on_failure=readings_failed)
+# Flush anything still queued when the server shuts down
+atexit.register(writer.stop)
+
+telemetry.describe('ingest_queue_depth', 'gauge', 'Readings waiting in the write-behind queue')
+telemetry.describe('ingest_queue_capacity', 'gauge', 'Size of the write-behind queue')
+telemetry.describe('ingest_rows_written_total', 'counter', 'Readings written by the write-behind thread')
+telemetry.describe('ingest_rows_failed_total', 'counter', 'Readings the write-behind thread failed to write')
+telemetry.describe('ingest_commits_total', 'counter', 'Groups written by the write-behind thread')
+telemetry.describe('live_subscribers', 'gauge', 'Open live streams')
+
+@telemetry.gauge
+def writer_gauges():
+    # Workers forward their groups to the writer process, which commits them
+    mode = (('mode', 'forward' if writer_client.enabled else 'commit'),)
+    stats = writer.stats()
+    return [
+        ('ingest_queue_depth', mode, stats['queue_depth']),
+        ('ingest_queue_capacity', mode, stats['queue_capacity']),
+        ('ingest_rows_written_total', mode, stats['rows_written']),
+        ('ingest_rows_failed_total', mode, stats['rows_failed']),
+        ('ingest_commits_total', mode, stats['commits']),
+        ('live_subscribers', (), hub.subscriber_count()),
+    ]
+
+# Keys of the readings this process accepted lately, to turn retries away early
+recent_keys = dedup.RecentKeys()
+
+# Readings accepted into the write-behind queue are not on disk yet
+ACCEPTED_STATUS = 202 if WRITE_BEHIND else 201
+RETRY_AFTER = {'Retry-After': '1'}
+
+def get_default_sensor_id(conn):
+    """Return the id of the default LoRa sensor, creating it if needed"""
+    sensor_id = sensors_cache.id_for_name(conn, DEFAULT_SENSOR_NAME)
+    if sensor_id is not None:
+        return sensor_id
+    cursor = conn.execute('INSERT INTO sensors (name, description) VALUES (?, ?)',
+                          (DEFAULT_SENSOR_NAME, DEFAULT_SENSOR_DESCRIPTION))
+    cache.bump(conn, [cursor.lastrowid])
+    sensors_cache.add(cursor.lastrowid, DEFAULT_SENSOR_NAME)
+    return cursor.lastrowid
+
+def ingest_readings(items, require_sensor_id=True):
+    """Validate a list of readings and store the valid ones in one transaction.
+
+    Returns one result per item, in order. Successful results carry the stored
+    row under "stored_data"; failed ones carry "error" and the HTTP "code".
+    A reading already received is answered as a success marked "duplicate"
+    and not stored again (see dedup).
+    """
+    now = rollups.now_ms()
+    results = [None] * len(items)
+    rows = []
+    row_indexes = []
+
+    for index, item in enumerate(items):
+        try:
+            rows.append(prepare_reading(item, require_sensor_id, now))
+            row_indexes.append(index)
+        except ReadingError as e:
+            results[index] = {"index": index, "status": "error", "error": e.message, "code": e.status}
+
+    if not rows:
+        return results
+
+    conn = get_db_connection()
+    new_keys = []
+    try:
+        with conn:
+            # Resolve the default sensor and check every referenced sensor once per batch
+            if any(row[0] is None for row in rows):
+                default_id = get_default_sensor_id(conn)
+                for row in rows:
+                    if row[0] is None:
+                        row[0] = default_id
+
+            known = sensors_cache.known_ids(conn, {row[0] for row in rows})
+
+            valid_rows = []
+            valid_indexes = []
+            duplicates = 0
+            for index, row in zip(row_indexes, rows):
+                if row[0] not in known:
+                    results[index] = {"index": index, "status": "error",
+                                      "error": "Sensor not found", "code": 404}
+                    continue
+                results[index] = {
+                    "index": index,
+                    "status": "success",
+                    "stored_data": {
+                        "sensor_id": row[0],
+                        "aqi_value": row[1],
+                        "co2_ppm": row[2],
+                        "aqi_category": row[3],
+                        "timestamp": rollups.ms_to_iso(row[4])
+                    }
+                }
+                if row[5] is not None:
+                    pair = (row[0], row[5])
+                    if not recent_keys.add(pair):
+                        results[index]["duplicate"] = True
+                        duplicates += 1
+                        continue
+                    new_keys.append(pair)
+                valid_rows.append(row)
+                valid_indexes.append(index)
+            if duplicates:
+                telemetry.inc('readings_duplicate_total', (('stage', 'memory'),), duplicates)
+
+            if not WRITE_BEHIND:
+                stored = insert_readings(conn, valid_rows)
+                if len(stored) < len(valid_rows):
+                    stored_ids = {id(row) for row in stored}
+                    for index, row in zip(valid_indexes, valid_rows):
+                        if id(row) not in stored_ids:
+                            results[index]["duplicate"] = True
+                    valid_rows = stored
+    except sqlite3.Error as e:
+        # A default sensor created in the rolled back transaction may be cached
+        sensors_cache.invalidate()
+        recent_keys.discard(new_keys)
+        for index in row_indexes:
+            results[index] = {"index": index, "status": "error",
+                              "error": f"Database error: {str(e)}", "code": 500}
+        return results
+
+    if not WRITE_BEHIND and valid_rows:
+        readings_committed(valid_rows)
+    if WRITE_BEHIND and valid_rows:
+        try:
+            writer.submit(valid_rows)
+        except ingest.QueueFullError as e:
+            recent_keys.discard(new_keys)
+            for index in valid_indexes:
+                results[index] = {"index": index, "status": "error", "error": str(e), "code": 503}
+
+    return results
+
+def count_ingested(results):
+    """Add a batch's outcome to the ingestion counters, per sensor and per refusal status"""
+    route = ('route', request.endpoint)
+    accepted = {}
+    refused = {}
+    for result in results:
+        if result.get('duplicate'):
+            continue
+        if result['status'] == 'success':
+            sensor_id = result['stored_data']['sensor_id']
+            accepted[sensor_id] = accepted.get(sensor_id, 0) + 1
         else:
-            return "Hazardous", "hazardous"
-    except:
-        return "Unknown", ""
+            refused[result['code']] = refused.get(result['code'], 0) + 1
+    for sensor_id, count in accepted.items():
+        telemetry.inc('readings_ingested_total', (route, ('sensor_id', str(sensor_id))), count)
+    for code, count in refused.items():
+        telemetry.inc('readings_rejected_total', (route, ('status', str(code))), count)
+
+def batch_response(results):
+    """Build the JSON response for a batch of ingestion results"""
+    stored = sum(1 for r in results if r['status'] == 'success')
+    body = {"status": "success", "stored": stored, "results": results}
+    if stored == len(results):
+        return jsonify(body), ACCEPTED_STATUS
+    if stored:
+        body['status'] = "partial"
+        return jsonify(body), 207
+    body['status'] = "error"
+    if any(r['code'] == 503 for r in results):
+        return jsonify(body), 503, RETRY_AFTER
+    return jsonify(body), 400
+
+def handle_ingest_request(require_sensor_id, single_response):
+    """Shared body of the sensor and LoRa data routes.
+
+    A JSON array is treated as a batch. A single object goes through the same
+    path as a batch of one and is answered with the body from single_response(result).
+    A body of binary LoRa frames is a batch of readings for the sensor_id query
+    parameter.
+    """
+    if request.mimetype == lora.FRAME_MIMETYPE:
+        try:
+            frames = lora.split_frames(request.get_data())
+        except lora.PayloadError as e:
+            return jsonify({"error": str(e)}), 400
+        sensor_id = request.args.get('sensor_id')
+        data = [{'sensor_id': sensor_id, 'value': frame} for frame in frames]
+        if len(data) == 1:
+            data = data[0]
+    else:
+        data = request.get_json(silent=True)
+
+    if isinstance(data, list):
+        if not data:
+            return jsonify({"error": "At least one reading is required"}), 400
+        results = ingest_readings(data, require_sensor_id)
+        count_ingested(results)
+        return batch_response(results)
+
+    result = ingest_readings([data or {}], require_sensor_id)[0]
+    count_ingested([result])
+    if result['status'] != 'success':
+        if result['code'] == 503:
+            return jsonify({"error": result['error']}), 503, RETRY_AFTER
+        return jsonify({"error": result['error']}), result['code']
+    body = single_response(result)
+    if result.get('duplicate'):
+        body['duplicate'] = True
+    return jsonify(body), ACCEPTED_STATUS
 
 # Frontend routes
 @app.route('/')
+@cached_response(all_sensor_versions)
 def index():
     conn = get_db_connection()
-    # Get latest reading from each sensor
+    # Latest reading of each sensor, from the trigger-maintained cache
     latest_readings = conn.execute('''
         SELECT s.id, s.name, s.description, 
-               r.aqi_value as value, r.co2_ppm, r.aqi_category, r.timestamp
+               l.aqi_value as value, l.co2_ppm, c.name as aqi_category, l.ts
         FROM sensors s
-        LEFT JOIN (
-            SELECT sensor_id, aqi_value, co2_ppm, aqi_category, timestamp
-            FROM readings r1
-            WHERE timestamp = (
-                SELECT MAX(timestamp) FROM readings r2 WHERE r2.sensor_id = r1.sensor_id
-            )
-        ) r ON s.id = r.sensor_id
+        LEFT JOIN sensor_latest l ON l.sensor_id = s.id
+        LEFT JOIN aqi_categories c ON c.id = l.category_id
         ORDER BY s.name
     ''').fetchall()
     
-    # Process data for display
-    sensors_data = []
-    for reading in latest_readings:
-        category, class_name = get_aqi_category(reading['value'] if reading['value'] else 0)
-        sensors_data.append({
-            'id': reading['id'],
-            'name': reading['name'],
-            'description': reading['description'],
-            'value': reading['value'],
-            'co2_ppm': reading['co2_ppm'] if 'co2_ppm' in reading.keys() else None,
-            'timestamp': reading['timestamp'],
-            'category': reading['aqi_category'] if reading['aqi_category'] else category,
-            'class_name': class_name
-        })
+    # Process data for display, classifying every sensor's value at once
+    names, classes = aqi.labels([reading['value'] for reading in latest_readings])
+    sensors_data = [{
+        'id': reading['id'],
+        'name': reading['name'],
+        'description': reading['description'],
+        'value': reading['value'],
+        'co2_ppm': reading['co2_ppm'],
+        'timestamp': rollups.ms_to_iso(reading['ts']),
+        'category': reading['aqi_category'] or category,
+        'class_name': class_name
+    } for reading, category, class_name in zip(latest_readings, names, classes)]
     
-    conn.close()
     return render_template('index.html', sensors=sensors_data)
 
 @app.route('/sensors')
 def list_sensors():
     conn = get_db_connection()
-    sensors = conn.execute('SELECT id, name, description FROM sensors').fetchall()
-    conn.close()
-    return render_template('sensors.html', sensors=sensors)
+    sensors = conn.execute('SELECT id, name, description, retention_days FROM sensors').fetchall()
+    return render_template('sensors.html', sensors=sensors, default_retention_days=retention.RAW_DAYS)
+
+def get_retention_days(form):
+    """Parse the optional retention field of the sensor form; blank means the default"""
+    value = form.get('retention_days', '').strip()
+    if not value:
+        return None
+    days = float(value)
+    if days < 0:
+        raise ValueError
+    return days
 
 @app.route('/sensors/add', methods=['GET', 'POST'])
 def add_sensor():
@@ -154,11 +723,23 @@ def add_sensor():
             flash('Sensor name is required!')
             return redirect(url_for('add_sensor'))
         
+        try:
+            retention_days = get_retention_days(request.form)
+        except ValueError:
+            flash('Retention must be a number of days, or blank for the default!')
+            return redirect(url_for('add_sensor'))
+        
         conn = get_db_connection()
-        conn.execute('INSERT INTO sensors (name, description) VALUES (?, ?)', 
-                    (name, description))
-        conn.commit()
-        conn.close()
+        try:
+            cursor = conn.execute('INSERT INTO sensors (name, description, retention_days) VALUES (?, ?, ?)', 
+                                  (name, description, retention_days))
+            cache.bump(conn, [cursor.lastrowid])
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            flash(f'A sensor named "{name}" already exists!')
+            return redirect(url_for('add_sensor'))
+        sensors_cache.invalidate()
         
         flash(f'Sensor "{name}" was added successfully!')
         return redirect(url_for('list_sensors'))
@@ -168,10 +749,10 @@ def add_sensor():
 @app.route('/sensors/<int:id>/edit', methods=['GET', 'POST'])
 def edit_sensor(id):
     conn = get_db_connection()
-    sensor = conn.execute('SELECT id, name, description FROM sensors WHERE id = ?', (id,)).fetchone()
+    sensor = conn.execute('SELECT id, name, description, retention_days FROM sensors WHERE id = ?',
+                          (id,)).fetchone()
     
     if sensor is None:
-        conn.close()
         flash('Sensor not found!')
         return redirect(url_for('list_sensors'))
     
@@ -183,15 +764,26 @@ def edit_sensor(id):
             flash('Sensor name is required!')
             return redirect(url_for('edit_sensor', id=id))
         
-        conn.execute('UPDATE sensors SET name = ?, description = ? WHERE id = ?', 
-                    (name, description, id))
-        conn.commit()
-        conn.close()
+        try:
+            retention_days = get_retention_days(request.form)
+        except ValueError:
+            flash('Retention must be a number of days, or blank for the default!')
+            return redirect(url_for('edit_sensor', id=id))
+        
+        try:
+            conn.execute('UPDATE sensors SET name = ?, description = ?, retention_days = ? WHERE id = ?', 
+                        (name, description, retention_days, id))
+            cache.bump(conn, [id])
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            flash(f'A sensor named "{name}" already exists!')
+            return redirect(url_for('edit_sensor', id=id))
+        sensors_cache.invalidate()
         
         flash(f'Sensor "{name}" was updated successfully!')
         return redirect(url_for('list_sensors'))
     
-    conn.close()
     return render_template('sensor_form.html', sensor=sensor)
 
 @app.route('/sensors/<int:id>/delete', methods=['POST'])
@@ -200,16 +792,22 @@ def delete_sensor(id):
     sensor = conn.execute('SELECT name FROM sensors WHERE id = ?', (id,)).fetchone()
     
     if sensor is None:
-        conn.close()
         flash('Sensor not found!')
         return redirect(url_for('list_sensors'))
     
-    # First delete all readings for this sensor
-    conn.execute('DELETE FROM readings WHERE sensor_id = ?', (id,))
+    # First delete all readings for this sensor: those in archived months by
+    # rewriting the months' files, the others in chunks so ingestion is not
+    # locked out while a long history is removed
+    shards.delete_sensor(conn, id)
+    retention.delete_sensor_readings(conn, id)
+    rollups.delete_sensor(conn, id)
     # Then delete the sensor
     conn.execute('DELETE FROM sensors WHERE id = ?', (id,))
+    cache.bump(conn, [id])
     conn.commit()
-    conn.close()
+    sensors_cache.invalidate()
+    hub.forget(id)
+    alerter.forget(id)
     
     flash(f'Sensor "{sensor["name"]}" and all its readings were deleted!')
     return redirect(url_for('list_sensors'))
@@ -220,33 +818,65 @@ def sensor_readings(id):
     sensor = conn.execute('SELECT id, name, description FROM sensors WHERE id = ?', (id,)).fetchone()
     
     if sensor is None:
-        conn.close()
         flash('Sensor not found!')
         return redirect(url_for('list_sensors'))
     
-    readings = conn.execute('''
-        SELECT id, aqi_value as value, co2_ppm, aqi_category, timestamp
-        FROM readings
-        WHERE sensor_id = ?
-        ORDER BY timestamp DESC
-        LIMIT 100
-    ''', (id,)).fetchall()
+    try:
+        readings, next_cursor, prev_cursor = pagination.fetch_page(
+            conn, 'r.id, r.aqi_value as value, r.co2_ppm, c.name as aqi_category, r.ts',
+            id, cursor=request.args.get('cursor'), limit=100,
+            joins='LEFT JOIN aqi_categories c ON c.id = r.category_id')
+    except pagination.InvalidCursor:
+        return redirect(url_for('sensor_readings', id=id))
     
     # Process data to include AQI categories
-    processed_readings = []
-    for reading in readings:
-        category, class_name = get_aqi_category(reading['value'])
-        processed_readings.append({
-            'id': reading['id'],
-            'value': reading['value'],
-            'co2_ppm': reading['co2_ppm'] if 'co2_ppm' in reading.keys() else None,
-            'timestamp': reading['timestamp'],
-            'category': reading['aqi_category'] if reading['aqi_category'] else category,
-            'class_name': class_name
-        })
+    names, classes = aqi.labels([reading['value'] for reading in readings])
+    processed_readings = [{
+        'id': reading['id'],
+        'value': reading['value'],
+        'co2_ppm': reading['co2_ppm'],
+        'timestamp': rollups.ms_to_iso(reading['ts']),
+        'category': reading['aqi_category'] or category,
+        'class_name': class_name,
+        'archived': reading['archived']
+    } for reading, category, class_name in zip(readings, names, classes)]
     
-    conn.close()
-    return render_template('readings.html', sensor=sensor, readings=processed_readings)
+    return render_template('readings.html', sensor=sensor, readings=processed_readings,
+                           next_cursor=next_cursor, prev_cursor=prev_cursor)
+
+def reading_missing_message(conn, id):
+    """Why reading id cannot be edited or deleted: it was archived, or it does not exist"""
+    archives = shards.archived(conn)
+    try:
+        for table, _ in archives:
+            if conn.execute(f'SELECT 1 FROM {table} WHERE id = ?', (id,)).fetchone():
+                return 'Reading is archived and can no longer be changed!'
+    finally:
+        archives.close()
+    return 'Reading not found!'
+
+def parse_reading_form(form, sensors):
+    """(sensor_id, value, ts) from a reading form, or an error message to flash"""
+    try:
+        sensor_id = int(form.get('sensor_id', ''))
+    except ValueError:
+        sensor_id = None
+    if sensor_id not in {sensor['id'] for sensor in sensors}:
+        return 'Sensor not found!'
+    value = form.get('value', '').strip()
+    if not value:
+        return 'Value is required!'
+    try:
+        value = float(value)
+    except ValueError:
+        return 'Value must be a number!'
+    if not math.isfinite(value):
+        return 'Value must be a number!'
+    timestamp = form.get('timestamp')
+    ts = rollups.to_ms(timestamp) if timestamp else rollups.now_ms()
+    if ts is None:
+        return 'Timestamp is not a valid date and time!'
+    return sensor_id, value, ts
 
 @app.route('/readings/add', methods=['GET', 'POST'])
 def add_reading():
@@ -254,82 +884,83 @@ def add_reading():
     sensors = conn.execute('SELECT id, name FROM sensors').fetchall()
     
     if not sensors:
-        conn.close()
         flash('You need to add a sensor first!')
         return redirect(url_for('add_sensor'))
     
     if request.method == 'POST':
-        sensor_id = request.form['sensor_id']
-        value = request.form['value']
-        timestamp = request.form.get('timestamp', datetime.datetime.now().isoformat())
-        
-        if not value:
-            flash('Value is required!')
+        parsed = parse_reading_form(request.form, sensors)
+        if isinstance(parsed, str):
+            flash(parsed)
             return redirect(url_for('add_reading'))
+        sensor_id, value, ts = parsed
         
-        conn.execute('INSERT INTO readings (sensor_id, value, timestamp) VALUES (?, ?, ?)', 
-                    (sensor_id, value, timestamp))
+        rows = [(sensor_id, value, None, None, ts)]
+        insert_readings(conn, rows)
         conn.commit()
-        conn.close()
+        readings_committed(rows)
+        telemetry.inc('readings_ingested_total', (('route', request.endpoint), ('sensor_id', str(rows[0][0]))))
         
         flash('Reading was added successfully!')
         return redirect(url_for('sensor_readings', id=sensor_id))
     
-    conn.close()
     return render_template('reading_form.html', sensors=sensors, reading=None)
 
 @app.route('/readings/<int:id>/edit', methods=['GET', 'POST'])
 def edit_reading(id):
     conn = get_db_connection()
     reading = conn.execute('''
-        SELECT r.id, r.sensor_id, r.value, r.timestamp, s.name as sensor_name
+        SELECT r.id, r.sensor_id, r.aqi_value as value, r.ts, s.name as sensor_name
         FROM readings r
         JOIN sensors s ON r.sensor_id = s.id
         WHERE r.id = ?
     ''', (id,)).fetchone()
     
     if reading is None:
-        conn.close()
-        flash('Reading not found!')
+        flash(reading_missing_message(conn, id))
         return redirect(url_for('index'))
+    reading = dict(reading, timestamp=rollups.ms_to_iso(reading['ts']) or '')
     
     sensors = conn.execute('SELECT id, name FROM sensors').fetchall()
     
     if request.method == 'POST':
-        sensor_id = request.form['sensor_id']
-        value = request.form['value']
-        timestamp = request.form['timestamp']
-        
-        if not value:
-            flash('Value is required!')
+        # An empty timestamp is not "now" here; the form shows the stored one
+        if not request.form.get('timestamp'):
+            flash('Timestamp is not a valid date and time!')
             return redirect(url_for('edit_reading', id=id))
+        parsed = parse_reading_form(request.form, sensors)
+        if isinstance(parsed, str):
+            flash(parsed)
+            return redirect(url_for('edit_reading', id=id))
+        sensor_id, value, ts = parsed
         
-        conn.execute('UPDATE readings SET sensor_id = ?, value = ?, timestamp = ? WHERE id = ?', 
-                    (sensor_id, value, timestamp, id))
+        conn.execute('UPDATE readings SET sensor_id = ?, aqi_value = ?, ts = ? WHERE id = ?', 
+                    (sensor_id, value, ts, id))
+        # Recompute the rollup buckets the reading moved out of and into
+        rollups.refresh(conn, reading['sensor_id'], [reading['ts']])
+        rollups.refresh(conn, sensor_id, [ts])
+        cache.bump(conn, [reading['sensor_id'], sensor_id])
         conn.commit()
-        conn.close()
         
         flash('Reading was updated successfully!')
         return redirect(url_for('sensor_readings', id=sensor_id))
     
-    conn.close()
     return render_template('reading_form.html', sensors=sensors, reading=reading)
 
 @app.route('/readings/<int:id>/delete', methods=['POST'])
 def delete_reading(id):
     conn = get_db_connection()
-    reading = conn.execute('SELECT sensor_id FROM readings WHERE id = ?', (id,)).fetchone()
+    reading = conn.execute('SELECT sensor_id, ts FROM readings WHERE id = ?', (id,)).fetchone()
     
     if reading is None:
-        conn.close()
-        flash('Reading not found!')
+        flash(reading_missing_message(conn, id))
         return redirect(url_for('index'))
     
     sensor_id = reading['sensor_id']
     
     conn.execute('DELETE FROM readings WHERE id = ?', (id,))
+    rollups.refresh(conn, sensor_id, [reading['ts']])
+    cache.bump(conn, [sensor_id])
     conn.commit()
-    conn.close()
     
     flash('Reading was deleted!')
     return redirect(url_for('sensor_readings', id=sensor_id))
@@ -338,34 +969,185 @@ def delete_reading(id):
 def dashboard():
     return render_template('dashboard.html')
 
+def get_downsample_args():
+    """Read the points/max_points and downsample query parameters.
+
+    Returns (max_points, method); max_points is None when no limit was asked for.
+    """
+    max_points = request.args.get('max_points', request.args.get('points'))
+    method = request.args.get('downsample', downsample.DEFAULT_METHOD)
+    if method not in downsample.METHODS:
+        raise ValueError(f"downsample must be one of: {', '.join(downsample.METHODS)}")
+    if max_points in (None, ''):
+        return None, method
+    try:
+        max_points = int(max_points)
+    except ValueError:
+        raise ValueError("points must be an integer")
+    if max_points < 2:
+        raise ValueError("points must be at least 2")
+    return max_points, method
+
+# Metrics the dashboard API can return, with their rollup average column
+DASHBOARD_METRICS = {
+    'aqi_value': 3,
+    'co2_ppm': 6,
+}
+
+def get_time_range_args(default_hours=24):
+    """Read the from/to query parameters as epoch seconds.
+
+    Missing bounds default to the last default_hours hours, or stay None (an
+    open range) when default_hours is None.
+    """
+    error = "from and to must be ISO timestamps or epoch seconds"
+    end = request.args.get('to')
+    if end:
+        end = rollups.to_epoch(end)
+        if end is None:
+            raise ValueError(error)
+    elif default_hours is not None:
+        end = rollups.now_epoch() + 1
+    else:
+        end = None
+    start = request.args.get('from')
+    if start:
+        start = rollups.to_epoch(start)
+        if start is None:
+            raise ValueError(error)
+    elif default_hours is not None:
+        start = end - default_hours * 3600
+    else:
+        start = None
+    return start, end
+
+def get_int_list_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return [int(item) for item in value.split(',') if item.strip()]
+    except ValueError:
+        raise ValueError(f"{name} must be a comma-separated list of integers")
+
+def get_metrics_arg():
+    value = request.args.get('metrics')
+    if not value:
+        return ['aqi_value']
+    metrics = [m.strip() for m in value.split(',') if m.strip()]
+    unknown = [m for m in metrics if m not in DASHBOARD_METRICS]
+    if unknown or not metrics:
+        raise ValueError(f"metrics must be chosen from: {', '.join(DASHBOARD_METRICS)}")
+    return metrics
+
+def downsample_series(series, metrics, max_points, method):
+    """Cap every series at max_points, choosing points by the first metric"""
+    for columns in series.values():
+        timestamps = columns['timestamps']
+        if max_points is None or len(timestamps) <= max_points:
+            continue
+        keep = downsample.downsample(np.array(timestamps, dtype=float),
+                                     np.array(columns[metrics[0]], dtype=float),
+                                     max_points, method).tolist()
+        for key in ['timestamps'] + metrics:
+            column = columns[key]
+            columns[key] = [column[i] for i in keep]
+
 @app.route('/dashboard/data')
+@cached_response(dashboard_versions)
 def dashboard_data():
+    """Columnar time series for the analytics dashboard.
+
+    Query parameters: from/to (ISO or epoch seconds, default the last 24
+    hours), sensors (comma-separated IDs, default all), metrics (aqi_value
+    and/or co2_ppm, default aqi_value), resolution (bucket averages from the
+    rollups) and points/downsample (see get_downsample_args).
+
+    Each sensor gets parallel arrays: "timestamps" in epoch milliseconds and
+    one array per metric.
+    """
+    try:
+        start, end = get_time_range_args()
+        sensor_ids = get_int_list_arg('sensors')
+        metrics = get_metrics_arg()
+        resolution = rollups.parse_resolution(request.args.get('resolution'))
+        max_points, method = get_downsample_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
     conn = get_db_connection()
-    
-    # Get data for all sensors in the last 24 hours
-    readings = conn.execute('''
-        SELECT r.sensor_id, s.name, r.value, r.timestamp
-        FROM readings r
-        JOIN sensors s ON r.sensor_id = s.id
-        WHERE r.timestamp >= datetime('now', '-1 day')
-        ORDER BY r.timestamp
-    ''').fetchall()
-    
-    # Format data for charts
-    sensors = {}
-    for reading in readings:
-        sensor_id = reading['sensor_id']
-        if sensor_id not in sensors:
-            sensors[sensor_id] = {
-                'name': reading['name'],
-                'values': [],
-                'timestamps': []
-            }
-        sensors[sensor_id]['values'].append(float(reading['value']))
-        sensors[sensor_id]['timestamps'].append(reading['timestamp'])
-    
-    conn.close()
-    return jsonify(sensors)
+    if sensor_ids is None:
+        names = {row['id']: row['name'] for row in conn.execute('SELECT id, name FROM sensors')}
+    else:
+        placeholders = ','.join('?' * len(sensor_ids))
+        names = {row['id']: row['name'] for row in conn.execute(
+            f'SELECT id, name FROM sensors WHERE id IN ({placeholders})', sensor_ids)}
+
+    series = {}
+    response = {
+        "from": start * 1000,
+        "to": end * 1000,
+        "metrics": metrics,
+        "resolution": resolution,
+        "sensors": series
+    }
+    if not names:
+        return jsonify(response)
+
+    def columns_for(sensor_id):
+        columns = series.get(sensor_id)
+        if columns is None:
+            columns = series[sensor_id] = {'name': names[sensor_id], 'timestamps': []}
+            for metric in metrics:
+                columns[metric] = []
+        return columns
+
+    if resolution:
+        # Bucket averages from the coarsest rollup that fits the resolution
+        positions = [DASHBOARD_METRICS[m] for m in metrics]
+        for row in rollups.query(conn, resolution, start, end, list(names)):
+            columns = columns_for(row[0])
+            columns['timestamps'].append(row[1] * 1000)
+            for metric, position in zip(metrics, positions):
+                columns[metric].append(row[position])
+    else:
+        # Rows are streamed from the cursor as plain tuples
+        sensor_filter = ''
+        params = [start * 1000, end * 1000]
+        if sensor_ids is not None:
+            sensor_filter = f"AND sensor_id IN ({','.join('?' * len(names))})"
+            params.extend(names)
+        present = ' OR '.join(f'{m} IS NOT NULL' for m in metrics)
+        sources = 0
+        for readings, _ in shards.tables(conn, start, end):
+            cursor = conn.cursor()
+            cursor.row_factory = None
+            cursor.execute(f'''
+                SELECT sensor_id, ts, {', '.join(metrics)}
+                FROM {readings}
+                WHERE ts >= ? AND ts < ? {sensor_filter} AND ({present})
+                ORDER BY ts
+            ''', params)
+            for row in cursor:
+                sensor_id = row[0]
+                if sensor_id not in names:
+                    continue
+                columns = columns_for(sensor_id)
+                columns['timestamps'].append(row[1])
+                for i, metric in enumerate(metrics, 2):
+                    columns[metric].append(row[i])
+            cursor.close()
+            sources += 1
+        if sources > 1:
+            # The main database can hold late readings of archived months
+            for columns in series.values():
+                order = sorted(range(len(columns['timestamps'])), key=columns['timestamps'].__getitem__)
+                for key in ['timestamps'] + metrics:
+                    columns[key] = [columns[key][i] for i in order]
+
+    downsample_series(series, metrics, max_points, method)
+
+    return jsonify(response)
 
 # API routes (original)
 @app.route('/api/sensor/register', methods=['POST'])
@@ -381,170 +1163,280 @@ def register_sensor():
     conn = get_db_connection()
     
     # Check if sensor already exists
-    existing = conn.execute('SELECT id FROM sensors WHERE name = ?', (name,)).fetchone()
+    sensor_id = sensors_cache.id_for_name(conn, name)
     
-    if existing:
-        sensor_id = existing['id']
-    else:
-        cursor = conn.execute('INSERT INTO sensors (name, description) VALUES (?, ?)', 
-                 (name, description))
-        sensor_id = cursor.lastrowid
-    
-    conn.commit()
-    conn.close()
+    if sensor_id is None:
+        try:
+            cursor = conn.execute('INSERT INTO sensors (name, description) VALUES (?, ?)', 
+                     (name, description))
+            sensor_id = cursor.lastrowid
+            cache.bump(conn, [sensor_id])
+            conn.commit()
+            sensors_cache.add(sensor_id, name)
+        except sqlite3.IntegrityError:
+            # Registered concurrently by another request or process
+            conn.rollback()
+            sensor_id = sensors_cache.id_for_name(conn, name)
     
     return jsonify({"status": "success", "sensor_id": sensor_id}), 201
 
 @app.route('/api/sensor/data', methods=['POST'])
 def add_sensor_data():
-    data = request.get_json()
-    
-    if not data or 'sensor_id' not in data or 'value' not in data:
-        return jsonify({"error": "Sensor ID and value are required"}), 400
-    
-    sensor_id = data['sensor_id']
-    value = data['value']
-    timestamp = data.get('timestamp', datetime.datetime.now().isoformat())
-    
-    conn = get_db_connection()
-    
-    # Check if sensor exists
-    sensor = conn.execute('SELECT id FROM sensors WHERE id = ?', (sensor_id,)).fetchone()
-    if not sensor:
-        conn.close()
-        return jsonify({"error": "Sensor not found"}), 404
-    
-    conn.execute('INSERT INTO readings (sensor_id, value, timestamp) VALUES (?, ?, ?)', 
-             (sensor_id, value, timestamp))
-    
-    conn.commit()
-    conn.close()
-    
-    return jsonify({"status": "success"}), 201
+    return handle_ingest_request(
+        require_sensor_id=True,
+        single_response=lambda result: {"status": "success"}
+    )
 
 @app.route('/api/sensor/data/<int:sensor_id>', methods=['GET'])
+@cached_response(sensor_versions)
 def get_sensor_data(sensor_id):
     limit = request.args.get('limit', 100, type=int)
+    try:
+        max_points, method = get_downsample_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
     conn = get_db_connection()
     
-    readings = conn.execute('''
-        SELECT r.id, r.value, r.timestamp, s.name 
-        FROM readings r
-        JOIN sensors s ON r.sensor_id = s.id
-        WHERE r.sensor_id = ?
-        ORDER BY r.timestamp DESC
-        LIMIT ?
-    ''', (sensor_id, limit)).fetchall()
+    try:
+        readings, next_cursor, prev_cursor = pagination.fetch_page(
+            conn,
+            'r.id, r.aqi_value as value, r.co2_ppm, r.ts, s.name',
+            sensor_id, cursor=request.args.get('cursor'), limit=limit,
+            joins='JOIN sensors s ON r.sensor_id = s.id')
+    except pagination.InvalidCursor as e:
+        return jsonify({"error": str(e)}), 400
     
-    result = [dict(reading) for reading in readings]
-    conn.close()
+    if max_points is not None and len(readings) > max_points:
+        columns = list(zip(*readings))
+        values = np.array(columns[1], dtype=float)
+        epochs = np.array(columns[3], dtype=float)
+        # Downsample oldest-first so the chosen points follow the time axis
+        keep = downsample.downsample(epochs[::-1], values[::-1], max_points, method)
+        readings = [readings[len(readings) - 1 - i] for i in keep[::-1]]
+    
+    result = [{'id': reading['id'], 'value': reading['value'], 'co2_ppm': reading['co2_ppm'],
+               'timestamp': rollups.ms_to_iso(reading['ts']), 'name': reading['name']}
+              for reading in readings]
     
+    # The body stays a plain list; page cursors travel in headers
+    response = jsonify(result)
+    links = []
+    for rel, cursor in (('next', next_cursor), ('prev', prev_cursor)):
+        if cursor:
+            response.headers[f'X-{rel.capitalize()}-Cursor'] = cursor
+            url = url_for('get_sensor_data', sensor_id=sensor_id, limit=limit, cursor=cursor)
+            links.append(f'<{url}>; rel="{rel}"')
+    if links:
+        response.headers['Link'] = ', '.join(links)
+    return response
+
+@app.route('/api/sensor/data/<int:sensor_id>/rollup', methods=['GET'])
+def get_sensor_rollup(sensor_id):
+    try:
+        resolution = rollups.parse_resolution(request.args.get('resolution', '1h'))
+        start, end = get_time_range_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = get_db_connection()
+    result = [{
+        'timestamp': rollups.to_iso(row[1]),
+        'count': row[2],
+        'aqi_avg': row[3],
+        'aqi_min': row[4],
+        'aqi_max': row[5],
+        'co2_avg': row[6],
+        'co2_min': row[7],
+        'co2_max': row[8]
+    } for row in rollups.query(conn, resolution, start, end, [sensor_id])]
+
     return jsonify(result)
 
+# Trailing averages the derived metrics API returns unless windows is given
+DEFAULT_WINDOWS = '8h,24h'
+
+def get_windows_arg():
+    windows = []
+    for value in request.args.get('windows', DEFAULT_WINDOWS).split(','):
+        if value.strip():
+            windows.append((value.strip(), rollups.parse_resolution(value)))
+    return windows
+
+@app.route('/api/sensor/data/<int:sensor_id>/derived', methods=['GET'])
+@cached_response(derived_versions)
+def get_sensor_derived(sensor_id):
+    """Columnar metrics derived from a sensor's raw readings.
+
+    Query parameters: from/to (ISO or epoch seconds, default the last 24
+    hours), windows (trailing averages, comma-separated like resolution,
+    default 8h,24h) and points/downsample (see get_downsample_args).
+
+    "aqi" is the stored AQI, or the AQI of the CO2 reading where the device
+    sent none, and "category" its EPA category. aqi_avg_<window> and
+    co2_avg_<window> average the readings in the window ending at each
+    reading, including those before from.
+    """
+    try:
+        start, end = get_time_range_args()
+        windows = get_windows_arg()
+        max_points, method = get_downsample_args()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    conn = get_db_connection()
+    sensor = conn.execute('SELECT name FROM sensors WHERE id = ?', (sensor_id,)).fetchone()
+    if sensor is None:
+        return jsonify({"error": "Sensor not found"}), 404
+
+    # Read back far enough to fill the longest window at the first reading
+    lead = max([seconds for _, seconds in windows], default=0)
+    rows = []
+    for readings, _ in shards.tables(conn, start - lead, end):
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows.extend(cursor.execute(f'''
+            SELECT ts, aqi_value, co2_ppm FROM {readings}
+            WHERE sensor_id = ? AND ts >= ? AND ts < ?
+            ORDER BY ts
+        ''', (sensor_id, (start - lead) * 1000, end * 1000)).fetchall())
+        cursor.close()
+    rows.sort(key=lambda row: row[0])
+
+    # Missing values become NaN
+    series = np.array(rows, dtype=float).reshape(-1, 3)
+    ts, aqi_values, co2 = series[:, 0], series[:, 1], series[:, 2]
+    values = np.where(np.isnan(aqi_values), aqi.from_co2(co2), aqi_values)
+    window_ms = [seconds * 1000 for _, seconds in windows]
+    averages = aqi.rolling_means(ts, values, window_ms) + aqi.rolling_means(ts, co2, window_ms)
+    shown = ts >= start * 1000
+
+    names = ['aqi', 'co2_ppm'] + [f'aqi_avg_{w}' for w, _ in windows] + [f'co2_avg_{w}' for w, _ in windows]
+    columns = {'timestamps': ts[shown].astype(np.int64).tolist()}
+    for name, column in zip(names, [values, co2] + averages):
+        # NaN becomes null in the JSON
+        column = column[shown]
+        columns[name] = np.where(np.isnan(column), None, np.round(column, 2)).tolist()
+    columns['category'] = aqi.labels(values[shown])[0]
+    downsample_series({sensor_id: columns}, names + ['category'], max_points, method)
+
+    return jsonify({
+        "sensor_id": sensor_id,
+        "name": sensor[0],
+        "from": start * 1000,
+        "to": end * 1000,
+        "windows": [w for w, _ in windows],
+        **columns
+    })
+
+@app.route('/api/export', methods=['GET'])
+def export_readings():
+    fmt = request.args.get('format', 'csv')
+    try:
+        export.check_format(fmt)
+        sensor_ids = get_int_list_arg('sensors')
+        start, end = get_time_range_args(default_hours=None)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 501
+
+    # Rows are read and encoded chunk by chunk while the response is sent
+    return Response(export.stream(fmt, start, end, sensor_ids),
+                    mimetype=export.FORMATS[fmt],
+                    headers={'Content-Disposition': f'attachment; filename=readings.{fmt}'})
+
 @app.route('/api/sensors', methods=['GET'])
+@cached_response(all_sensor_versions)
 def get_all_sensors():
     conn = get_db_connection()
     
     sensors = conn.execute('SELECT id, name, description FROM sensors').fetchall()
     result = [dict(sensor) for sensor in sensors]
-    conn.close()
     
     return jsonify(result)
 
 # Special API route for LoRa devices
 @app.route('/api/lora/data', methods=['POST'])
 def add_lora_data():
-    data = request.get_json()
-    
-    if not data or 'value' not in data:
-        return jsonify({"error": "Value is required"}), 400
-    
-    # Parse the value string to extract CO2 and AQI
-    value_str = str(data['value'])
-    co2_ppm = None
-    aqi_value = None
-    aqi_category = None
-    
+    def single_response(result):
+        stored = dict(result['stored_data'])
+        del stored['sensor_id']
+        return {"status": "success", "stored_data": stored}
+
+    return handle_ingest_request(require_sensor_id=False, single_response=single_response)
+
+@app.route('/api/stream', methods=['GET'])
+def stream_readings():
+    """Server-Sent Events stream of new readings.
+
+    Starts with a "snapshot" event holding each sensor's latest reading, then
+    sends a "readings" event for every committed group of new readings.
+    sensors (comma-separated IDs) limits the stream to those sensors.
+    """
     try:
-        if isinstance(data['value'], (int, float)):
-            # If direct numeric value, treat as AQI
-            aqi_value = float(data['value'])
-        else:
-            # Parse the string format: "CO2: X ppm, AQI: Y, Zone: Z"
-            if "CO2:" in value_str and "AQI:" in value_str:
-                # Parse CO2
-                co2_start = value_str.find("CO2:") + 4
-                co2_end = value_str.find("ppm")
-                if co2_start > 3 and co2_end > co2_start:
-                    co2_str = value_str[co2_start:co2_end].strip()
-                    co2_ppm = float(co2_str)
-                
-                # Parse AQI
-                aqi_start = value_str.find("AQI:") + 4
-                aqi_end = value_str.find(",", aqi_start)
-                if aqi_start > 3:
-                    if aqi_end == -1:
-                        aqi_str = value_str[aqi_start:].strip()
-                    else:
-                        aqi_str = value_str[aqi_start:aqi_end].strip()
-                    aqi_value = float(aqi_str)
-                
-                # Parse Zone
-                if "Zone:" in value_str:
-                    zone_start = value_str.find("Zone:") + 5
-                    aqi_category = value_str[zone_start:].strip()
-            else:
-                # Try to parse as direct AQI value
-                aqi_value = float(value_str)
-    except (ValueError, IndexError) as e:
-        return jsonify({"error": f"Failed to parse value: {str(e)}"}), 400
-    
-    if aqi_value is None and co2_ppm is None:
-        return jsonify({"error": "Could not parse either AQI or CO2 values"}), 400
-    
-    timestamp = data.get('timestamp', datetime.datetime.now().isoformat())
-    
-    # Either use provided sensor_id or get default sensor
-    if 'sensor_id' in data and data['sensor_id']:
-        sensor_id = data['sensor_id']
-    else:
-        conn = get_db_connection()
-        sensor = conn.execute('SELECT id FROM sensors WHERE name = ?', 
-                            ('Default AQI Sensor',)).fetchone()
-        
-        if sensor:
-            sensor_id = sensor['id']
-        else:
-            cursor = conn.execute('INSERT INTO sensors (name, description) VALUES (?, ?)', 
-                     ('Default AQI Sensor', 'Automatically created AQI sensor'))
-            sensor_id = cursor.lastrowid
-            conn.commit()
-        conn.close()
-    
-    # Store the reading
+        sensor_ids = get_int_list_arg('sensors')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(live.stream(hub, sensor_ids), mimetype='text/event-stream', headers=headers)
+
+@app.route('/api/retention', methods=['GET'])
+def retention_status():
     conn = get_db_connection()
-    try:
-        conn.execute('''
-            INSERT INTO readings (sensor_id, aqi_value, co2_ppm, aqi_category, timestamp) 
-            VALUES (?, ?, ?, ?, ?)
-        ''', (sensor_id, aqi_value, co2_ppm, aqi_category, timestamp))
-        conn.commit()
-        
-        return jsonify({
-            "status": "success",
-            "stored_data": {
-                "aqi_value": aqi_value,
-                "co2_ppm": co2_ppm,
-                "aqi_category": aqi_category,
-                "timestamp": timestamp
-            }
-        }), 201
-    except sqlite3.Error as e:
-        return jsonify({"error": f"Database error: {str(e)}"}), 500
-    finally:
-        conn.close()
+    overrides = conn.execute('''
+        SELECT id, name, retention_days FROM sensors WHERE retention_days IS NOT NULL
+    ''').fetchall()
+    return jsonify({
+        "raw_days": retention.RAW_DAYS,
+        "rollup_days": retention.ROLLUP_DAYS,
+        "sensor_raw_days": {row['id']: row['retention_days'] for row in overrides},
+        "incremental_vacuum": conn.execute('PRAGMA auto_vacuum').fetchone()[0] == retention.AUTO_VACUUM_INCREMENTAL,
+        "archive_after_months": shards.ARCHIVE_AFTER_MONTHS,
+        "archived_months": shards.list_months(conn),
+        "last_runs": retention.last_runs(conn)
+    })
+
+@app.route('/api/migrations', methods=['GET'])
+def migration_status():
+    return jsonify(migrations.status(get_db_connection()))
+
+@app.route('/api/ingest/stats', methods=['GET'])
+def ingest_stats():
+    stats = writer.stats()
+    stats['write_behind'] = WRITE_BEHIND
+    stats['live_subscribers'] = hub.subscriber_count()
+    stats['recent_keys'] = recent_keys.stats()
+    return jsonify(stats)
+
+telemetry.describe('database_size_bytes', 'gauge', 'Size of the database files')
+telemetry.describe('sensor_readings', 'gauge', 'Readings per sensor, from the daily rollup')
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    totals = telemetry.collect()
+    conn = get_db_connection()
+    # Whole-database figures are read here rather than summed over processes
+    sizes = {'main': db.DATABASE, 'wal': db.DATABASE + '-wal'}
+    sizes.update({f'archive-{month}': shards.shard_path(conn, month) for month in shards.list_months(conn)})
+    for name, path in sizes.items():
+        try:
+            totals[('database_size_bytes', (('file', name),))] = os.path.getsize(path)
+        except OSError:
+            pass
+    for row in conn.execute('''
+        SELECT r.sensor_id, s.name, SUM(r.count) FROM readings_1d r
+        JOIN sensors s ON s.id = r.sensor_id
+        GROUP BY r.sensor_id
+    '''):
+        totals[('sensor_readings', (('sensor_id', str(row[0])), ('sensor', row[1])))] = row[2]
+    return Response(telemetry.render(totals), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
     init_db()
+    # With the debug reloader, only the child process that serves requests runs the jobs
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        migrations.start()
+        retention.start()
     app.run(host='0.0.0.0', port=9090, debug=True)
@@ -0,0 +1,314 @@
+"""Versioned schema migrations.
+
+MIGRATIONS lists every schema change in order. Each applied migration is
+recorded in the schema_version table, and init_db applies the pending ones at
+startup, each in its own transaction. A migration's apply(c) must be quick:
+creating tables, adding columns. When existing rows also need rewriting, apply
+returns an UPDATE over an id range ("id > ? AND id <= ?") instead of running
+it, possibly after other statements over the same range separated by
+semicolons, each taking the range as its two parameters. The backfill is then
+applied in the background in batches of MIGRATION_BATCH_ROWS rows, newest
+rows first, each batch committed on its own while the server keeps ingesting. Rows written after the migration was applied
+are already in the new format and are never revisited. The position reached
+is saved with every batch, so a restart resumes where it stopped.
+
+Progress is shown by GET /api/migrations. Command line use:
+
+    python migrations.py --status  # applied migrations and backfill progress
+    python migrations.py --run     # apply pending migrations and finish backfills now
+"""
+import argparse
+import os
+import threading
+import time
+
+import cache
+import categories
+import db
+import rollups
+
+BATCH_ROWS = int(os.environ.get('MIGRATION_BATCH_ROWS', 2000))
+# Pause between batches so queued writes get the lock in between
+BATCH_PAUSE_SECONDS = 0.01
+RETRY_SECONDS = 60
+
+
+def _columns(c, table):
+    return [row[1] for row in c.execute(f'PRAGMA table_info({table})')]
+
+
+def create_tables(c):
+    if _columns(c, 'readings'):
+        return None
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS sensors (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE readings (
+            id INTEGER PRIMARY KEY,
+            sensor_id INTEGER,
+            aqi_value REAL,
+            co2_ppm REAL,
+            aqi_category TEXT,
+            timestamp DATETIME,
+            FOREIGN KEY (sensor_id) REFERENCES sensors (id)
+        )
+    ''')
+    # Add a default AQI sensor
+    c.execute('INSERT INTO sensors (name, description) VALUES (?, ?)',
+              ('Default AQI Sensor', 'Automatically created AQI sensor'))
+    print("Database initialized with new schema")
+    return None
+
+
+def split_reading_value(c):
+    """Readings of the first schema kept their only measurement in value.
+
+    The new columns are added in place, which is instant, rather than copying
+    the table. value is left behind unused.
+    """
+    columns = _columns(c, 'readings')
+    for column, kind in (('aqi_value', 'REAL'), ('co2_ppm', 'REAL'), ('aqi_category', 'TEXT')):
+        if column not in columns:
+            c.execute(f'ALTER TABLE readings ADD COLUMN {column} {kind}')
+    if 'value' not in columns:
+        return None
+    return '''
+        UPDATE readings SET aqi_value = value
+        WHERE id > ? AND id <= ? AND aqi_value IS NULL AND value IS NOT NULL
+    '''
+
+
+def compact_timestamps_and_categories(c):
+    """Readings kept their time as text, in whatever format the device sent,
+    and their zone name in full on every row.
+
+    ts holds the time as epoch milliseconds, naive times read as UTC, and
+    category_id a code from aqi_categories (see categories). Readings are
+    converted newest first and only appear in time-range reads once
+    converted. Converted rows have timestamp and aqi_category cleared; the
+    columns are left behind, like value. A timestamp that cannot be parsed
+    stays where it is, with ts NULL. The indexes and triggers on the old
+    columns are dropped for init_db to build again on ts.
+
+    sensor_latest is small and is converted here. Each batch then picks the
+    latest reading again for the sensors it touched, which also corrects
+    entries chosen by comparing timestamps of different formats as text.
+    """
+    categories.init_tables(c)
+    for table in ('readings', 'sensor_latest'):
+        columns = _columns(c, table)
+        for column in ('ts', 'category_id'):
+            if columns and column not in columns:
+                c.execute(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER')
+    for trigger in ('readings_latest_insert', 'readings_latest_delete', 'readings_latest_update'):
+        c.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    for index in ('idx_readings_sensor_time', 'idx_readings_time'):
+        c.execute(f'DROP INDEX IF EXISTS {index}')
+
+    if 'aqi_category' in _columns(c, 'sensor_latest'):
+        c.execute('''
+            INSERT OR IGNORE INTO aqi_categories (name)
+            SELECT DISTINCT aqi_category FROM sensor_latest WHERE aqi_category != ''
+        ''')
+        c.execute(f'''
+            UPDATE sensor_latest SET
+                ts = {rollups.ms_sql('timestamp')},
+                category_id = (SELECT id FROM aqi_categories WHERE name = aqi_category),
+                timestamp = NULL,
+                aqi_category = NULL
+            WHERE ts IS NULL
+        ''')
+    return f'''
+        INSERT OR IGNORE INTO aqi_categories (name)
+        SELECT DISTINCT aqi_category FROM readings
+        WHERE id > ? AND id <= ? AND aqi_category != '';
+        UPDATE readings SET
+            ts = {rollups.ms_sql('timestamp')},
+            category_id = (SELECT id FROM aqi_categories WHERE name = aqi_category),
+            timestamp = CASE WHEN {rollups.ms_sql('timestamp')} IS NULL THEN timestamp END,
+            aqi_category = NULL
+        WHERE id > ? AND id <= ? AND ts IS NULL;
+        INSERT OR REPLACE INTO sensor_latest (sensor_id, reading_id, aqi_value, co2_ppm, category_id, ts)
+        SELECT r.sensor_id, r.id, r.aqi_value, r.co2_ppm, r.category_id, r.ts
+        FROM (SELECT DISTINCT sensor_id FROM readings WHERE id > ? AND id <= ?) s
+        JOIN readings r ON r.id = (
+            SELECT id FROM readings
+            WHERE sensor_id = s.sensor_id
+            ORDER BY ts DESC, id DESC LIMIT 1
+        )
+    '''
+
+
+def add_reading_keys(c):
+    """Readings may carry a key that makes retried submissions recognisable
+    (see dedup). Existing readings have none."""
+    if 'dedup_key' not in _columns(c, 'readings'):
+        c.execute('ALTER TABLE readings ADD COLUMN dedup_key INTEGER')
+    return None
+
+
+# (version, name, apply) in the order they are applied
+MIGRATIONS = [
+    (1, 'create sensors and readings', create_tables),
+    (2, 'split reading value into aqi_value, co2_ppm and aqi_category', split_reading_value),
+    (3, 'store timestamps as epoch milliseconds and categories as codes', compact_timestamps_and_categories),
+    (4, 'add dedup_key to readings', add_reading_keys),
+]
+
+
+def init_tables(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at DATETIME NOT NULL,
+            backfill_sql TEXT,
+            backfill_low INTEGER,
+            backfill_high INTEGER,
+            backfill_next INTEGER,
+            finished_at DATETIME
+        )
+    ''')
+
+
+def current_version(conn):
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def upgrade(conn):
+    """Apply pending migrations; their backfills are left to run_backfills()"""
+    init_tables(conn)
+    conn.commit()
+    applied = {row[0] for row in conn.execute('SELECT version FROM schema_version')}
+    for version, name, apply in MIGRATIONS:
+        if version in applied:
+            continue
+        # IMMEDIATE takes the write lock first, so a concurrent startup waits here
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone():
+                conn.rollback()
+                continue
+            now = time.strftime('%Y-%m-%dT%H:%M:%S')
+            backfill_sql = apply(conn.cursor())
+            low = high = None
+            if backfill_sql:
+                low, high = conn.execute('SELECT MIN(id) - 1, MAX(id) FROM readings').fetchone()
+                if high is None:
+                    backfill_sql = None
+            conn.execute('''
+                INSERT INTO schema_version (version, name, applied_at, backfill_sql,
+                                            backfill_low, backfill_high, backfill_next, finished_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (version, name, now, backfill_sql, low, high, high, None if backfill_sql else now))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if backfill_sql:
+            print(f"Migration {version} applied ({name}); {high - low} rows are rewritten in the background")
+        elif applied:
+            # Only worth reporting on a database that was already versioned
+            print(f"Migration {version} applied ({name})")
+
+    latest = MIGRATIONS[-1][0]
+    version = current_version(conn)
+    if version > latest:
+        print(f"Database schema version {version} is newer than this code ({latest})")
+
+
+def pending(conn):
+    return conn.execute('''
+        SELECT version, name, backfill_sql, backfill_low, backfill_next
+        FROM schema_version WHERE finished_at IS NULL ORDER BY version
+    ''').fetchall()
+
+
+def run_backfills(conn, batch_rows=BATCH_ROWS):
+    """Work through every unfinished backfill, one batch per transaction"""
+    for version, name, sql, low, position in pending(conn):
+        started = time.monotonic()
+        print(f"Migration {version}: rewriting rows {low + 1} to {position}")
+        while position > low:
+            lower = max(position - batch_rows, low)
+            with conn:
+                for statement in sql.split(';'):
+                    conn.execute(statement, (lower, position))
+                conn.execute('UPDATE schema_version SET backfill_next = ? WHERE version = ?',
+                             (lower, version))
+                cache.bump_all(conn)
+            position = lower
+            time.sleep(BATCH_PAUSE_SECONDS)
+        with conn:
+            conn.execute('UPDATE schema_version SET finished_at = ? WHERE version = ?',
+                         (time.strftime('%Y-%m-%dT%H:%M:%S'), version))
+        print(f"Migration {version} finished ({name}) in {time.monotonic() - started:.1f}s")
+
+
+def status(conn):
+    rows = conn.execute('''
+        SELECT version, name, applied_at, finished_at, backfill_low, backfill_high, backfill_next
+        FROM schema_version ORDER BY version
+    ''').fetchall()
+    migrations = []
+    for version, name, applied_at, finished_at, low, high, position in rows:
+        progress = 1.0
+        if finished_at is None and high is not None and high > low:
+            progress = round((high - position) / (high - low), 4)
+        migrations.append({
+            "version": version,
+            "name": name,
+            "applied_at": applied_at,
+            "finished_at": finished_at,
+            "progress": progress,
+        })
+    return {"version": current_version(conn), "migrations": migrations}
+
+
+def start(path=None):
+    """Run pending backfills on a daemon thread, retrying after a failure"""
+    def loop():
+        while True:
+            conn = db.connect(path)
+            try:
+                run_backfills(conn)
+                return
+            except Exception as e:
+                print(f"Migration backfill failed: {e}")
+            finally:
+                conn.close()
+            time.sleep(RETRY_SECONDS)
+
+    thread = threading.Thread(target=loop, name='migrations', daemon=True)
+    thread.start()
+    return thread
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply schema migrations to the sensor database')
+    parser.add_argument('--status', action='store_true', help='Show applied migrations and backfill progress')
+    parser.add_argument('--run', action='store_true', help='Apply pending migrations and finish their backfills')
+    parser.add_argument('--db', default=db.DATABASE, help='Path to the SQLite database')
+
+    args = parser.parse_args()
+    if not args.status and not args.run:
+        parser.error("nothing to do; pass --status or --run")
+
+    conn = db.connect(args.db)
+    try:
+        if args.run:
+            upgrade(conn)
+            cache.init_tables(conn)
+            run_backfills(conn)
+        if args.status:
+            init_tables(conn)
+            for migration in status(conn)['migrations']:
+                state = 'done' if migration['finished_at'] else f"{migration['progress']:.1%}"
+                print(f"{migration['version']:>4}  {state:>7}  {migration['name']}")
+    finally:
+        conn.close()
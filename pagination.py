@@ -0,0 +1,102 @@
+"""Keyset pagination over a sensor's readings, newest first.
+
+Pages are addressed by opaque cursors holding the (ts, id) of the row at the
+page edge. Each page is fetched with a row-value comparison against that key,
+which the (sensor_id, ts) index (with the implicit rowid)
+serves directly. Every page therefore costs the same wherever it falls in the
+history, unlike OFFSET. Archived months are only read once the page reaches
+back into them.
+"""
+import base64
+import contextlib
+import json
+
+import shards
+
+MAX_PAGE_SIZE = 1000
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(direction, ts, row_id):
+    raw = json.dumps([direction, ts, row_id], separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (direction, ts, id) from a cursor made by encode_cursor"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, ts, row_id = json.loads(raw)
+    except (ValueError, TypeError):
+        raise InvalidCursor("Invalid cursor")
+    # Cursors from before timestamps were stored as numbers hold a string
+    if direction not in ('next', 'prev') or not isinstance(row_id, int) or not isinstance(ts, int):
+        raise InvalidCursor("Invalid cursor")
+    return direction, ts, row_id
+
+
+def fetch_page(conn, columns, sensor_id, cursor=None, limit=100, joins=''):
+    """Fetch one newest-first page of a sensor's readings.
+
+    columns is the SELECT list and must include the readings alias r's ts and
+    id as "ts" and "id". Each row also gets an "archived" column, 1 for
+    readings read from an archived month. Returns (rows, next_cursor,
+    prev_cursor). next_cursor leads to older readings and prev_cursor to newer
+    ones; each is None at that end of the history.
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    direction = None
+    params = [sensor_id]
+    keyset = ''
+    start = end = None
+    if cursor:
+        direction, ts, row_id = decode_cursor(cursor)
+        keyset = 'AND (r.ts, r.id) < (?, ?)' if direction == 'next' else 'AND (r.ts, r.id) > (?, ?)'
+        params.extend([ts, row_id])
+        epoch = ts // 1000
+        start, end = (None, epoch + 1) if direction == 'next' else (epoch, None)
+    newest_first = direction != 'prev'
+    order = 'DESC' if newest_first else 'ASC'
+    sql = f'''
+        SELECT {columns}, {{archived}} AS archived
+        FROM {{table}} r
+        {joins}
+        WHERE r.sensor_id = ? AND r.ts IS NOT NULL {keyset}
+        ORDER BY r.ts {order}, r.id {order}
+        LIMIT ?
+    '''
+
+    rows = conn.execute(sql.format(table='readings', archived=0), params + [limit + 1]).fetchall()
+    # Each archive holds a single month, so stop merging them in once the page
+    # is full of readings that come before anything in the next archive
+    with contextlib.closing(shards.archived(conn, start, end, newest_first)) as archives:
+        for table, month in archives:
+            if len(rows) > limit:
+                edge = rows[limit]['ts']
+                month_start, month_end = shards.month_bounds(month)
+                if (edge >= month_end) if newest_first else (edge < month_start):
+                    break
+            rows.extend(conn.execute(sql.format(table=table, archived=1), params + [limit + 1]).fetchall())
+            rows.sort(key=lambda row: (row['ts'], row['id']), reverse=newest_first)
+            del rows[limit + 1:]
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+
+    next_cursor = prev_cursor = None
+    if rows:
+        first, last = rows[0], rows[-1]
+        # The extra row tells whether there is more in the direction we moved;
+        # the direction we came from always has more
+        has_older = more if direction != 'prev' else True
+        has_newer = more if direction == 'prev' else direction == 'next'
+        if has_older:
+            next_cursor = encode_cursor('next', last['ts'], last['id'])
+        if has_newer:
+            prev_cursor = encode_cursor('prev', first['ts'], first['id'])
+    return rows, next_cursor, prev_cursor
@@ -77,6 +77,12 @@ String getTime() {
     return String(timeString);
 }
 
+// True once NTP has set the clock; doesn't wait for it
+bool timeIsSet() {
+    struct tm timeinfo;
+    return getLocalTime(&timeinfo, 0);
+}
+
 bool registerSensor() {
     HTTPClient http;
     String url = String(serverUrl) + "/api/sensor/register";
@@ -125,7 +131,10 @@ bool sendDataToServer(const String& rawData, float co2_ppm, int aqi, const Strin
     StaticJsonDocument<300> doc;
     doc["sensor_id"] = sensorId;
     doc["value"] = rawData;
-    doc["timestamp"] = getTime();
+    // Until the clock is set the server stamps the reading on arrival
+    if (timeIsSet()) {
+        doc["timestamp"] = getTime();
+    }
 
     String requestBody;
     serializeJson(doc, requestBody);
@@ -133,10 +142,13 @@ bool sendDataToServer(const String& rawData, float co2_ppm, int aqi, const Strin
     int httpResponseCode = http.POST(requestBody);
     bool success = false;
 
-    if (httpResponseCode > 0) {
+    if (httpResponseCode >= 200 && httpResponseCode < 300) {
         String response = http.getString();
         Serial.printf("📡 Server Response: %s\n", response.c_str());
         success = true;
+    } else if (httpResponseCode > 0) {
+        String response = http.getString();
+        Serial.printf("❌ Reading rejected: %d %s\n", httpResponseCode, response.c_str());
     } else {
         Serial.printf("❌ API Error: %d\n", httpResponseCode);
     }
@@ -0,0 +1,73 @@
+"""In-process cache of the sensors table, keyed by id and by name.
+
+Ingestion checks every reading's sensor and resolves the default sensor by
+name. With the registry both are dictionary lookups instead of queries. The
+whole table (id and name only) is loaded on first use and reloaded after
+SENSOR_CACHE_TTL seconds, so changes made by other processes show up. The
+sensor routes of this process invalidate it as soon as they change a sensor.
+An id or name the cache has not seen yet is looked up individually through
+the primary key or the name index, then remembered.
+"""
+import os
+import threading
+import time
+
+SENSOR_CACHE_TTL = float(os.environ.get('SENSOR_CACHE_TTL', 60))
+
+
+class SensorRegistry:
+    def __init__(self, ttl=SENSOR_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._by_id = None
+        self._by_name = {}
+        self._loaded_at = 0.0
+
+    def _load(self, conn):
+        if self._by_id is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        with self._lock:
+            if self._by_id is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return
+            by_id = {}
+            by_name = {}
+            for sensor_id, name in conn.execute('SELECT id, name FROM sensors ORDER BY id'):
+                by_id[sensor_id] = name
+                # Older databases may still have duplicate names; the lowest id wins
+                by_name.setdefault(name, sensor_id)
+            self._by_id, self._by_name = by_id, by_name
+            self._loaded_at = time.monotonic()
+
+    def add(self, sensor_id, name):
+        with self._lock:
+            if self._by_id is not None:
+                self._by_id[sensor_id] = name
+                self._by_name.setdefault(name, sensor_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._by_id = None
+            self._by_name = {}
+
+    def known_ids(self, conn, sensor_ids):
+        """The subset of sensor_ids that exist"""
+        self._load(conn)
+        by_id = self._by_id or {}
+        known = {sensor_id for sensor_id in sensor_ids if sensor_id in by_id}
+        for sensor_id in set(sensor_ids) - known:
+            row = conn.execute('SELECT id, name FROM sensors WHERE id = ?', (sensor_id,)).fetchone()
+            if row is not None:
+                self.add(row[0], row[1])
+                known.add(sensor_id)
+        return known
+
+    def id_for_name(self, conn, name):
+        """The id of the sensor called name, or None"""
+        self._load(conn)
+        sensor_id = self._by_name.get(name)
+        if sensor_id is None:
+            row = conn.execute('SELECT id FROM sensors WHERE name = ? ORDER BY id LIMIT 1', (name,)).fetchone()
+            if row is not None:
+                sensor_id = row[0]
+                self.add(sensor_id, name)
+        return sensor_id
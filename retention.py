@@ -0,0 +1,292 @@
+"""Retention of raw readings and rollups.
+
+A background job deletes raw readings older than their sensor's retention,
+and rollup rows older than their table's retention. Rollups are usually kept
+much longer, so old history stays available at coarser resolution. Deletes run
+in chunks of RETENTION_CHUNK_ROWS rows, each committed on its own, so
+ingestion never waits long for the write lock. Freed pages are then returned
+to the filesystem with incremental vacuum, and each run's totals are recorded
+in retention_log.
+
+Retention is given in days, and 0 keeps data forever (the default):
+
+- RETENTION_RAW_DAYS: raw readings. A sensor's retention_days overrides it.
+- RETENTION_1M_DAYS, RETENTION_1H_DAYS, RETENTION_1D_DAYS: the rollup tables.
+
+The same job moves old months of raw readings into archive files when
+ARCHIVE_AFTER_MONTHS is set (see shards.py). An archived month is dropped
+whole, by unlinking its file, once it is older than the longest raw
+retention of any sensor.
+
+Command line use:
+
+    python retention.py --run                        # one pass now
+    python retention.py --enable-incremental-vacuum  # one-off VACUUM of an older database
+"""
+import argparse
+import os
+import threading
+import time
+
+import cache
+import db
+import migrations
+import rollups
+import shards
+
+RAW_DAYS = float(os.environ.get('RETENTION_RAW_DAYS', 0))
+ROLLUP_DAYS = {
+    'readings_1m': float(os.environ.get('RETENTION_1M_DAYS', 0)),
+    'readings_1h': float(os.environ.get('RETENTION_1H_DAYS', 0)),
+    'readings_1d': float(os.environ.get('RETENTION_1D_DAYS', 0)),
+}
+CHUNK_ROWS = int(os.environ.get('RETENTION_CHUNK_ROWS', 1000))
+INTERVAL_SECONDS = int(os.environ.get('RETENTION_INTERVAL_SECONDS', 3600))
+# Pause between chunks so queued writes get the lock in between
+CHUNK_PAUSE_SECONDS = 0.01
+VACUUM_PAGES = 1000
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def init_tables(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS retention_log (
+            id INTEGER PRIMARY KEY,
+            started_at DATETIME,
+            seconds REAL,
+            readings_deleted INTEGER,
+            rollups_deleted INTEGER,
+            bytes_reclaimed INTEGER,
+            free_bytes INTEGER
+        )
+    ''')
+    columns = [row[1] for row in c.execute('PRAGMA table_info(retention_log)')]
+    if 'readings_archived' not in columns:
+        c.execute('ALTER TABLE retention_log ADD COLUMN readings_archived INTEGER')
+        c.execute('ALTER TABLE retention_log ADD COLUMN months_dropped TEXT')
+    columns = [row[1] for row in c.execute('PRAGMA table_info(sensors)')]
+    if 'retention_days' not in columns:
+        c.execute('ALTER TABLE sensors ADD COLUMN retention_days REAL')
+
+    enabled = RAW_DAYS > 0 or any(days > 0 for days in ROLLUP_DAYS.values())
+    c.execute('PRAGMA auto_vacuum')
+    if enabled and c.fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        print("Incremental vacuum is off for this database, so retention cannot shrink the file; "
+              "run `python retention.py --enable-incremental-vacuum` once while the server is stopped")
+
+
+def delete_in_chunks(conn, sql, params, chunk_rows=CHUNK_ROWS):
+    """Run a DELETE ending in "LIMIT ?" until it removes fewer than chunk_rows rows.
+
+    Each chunk is its own transaction. Returns the number of rows deleted.
+    """
+    total = 0
+    while True:
+        with conn:
+            deleted = conn.execute(sql, list(params) + [chunk_rows]).rowcount
+        total += deleted
+        if deleted < chunk_rows:
+            return total
+        time.sleep(CHUNK_PAUSE_SECONDS)
+
+
+def delete_sensor_readings(conn, sensor_id, before=None):
+    """Delete a sensor's readings (older than ts before, if given) in chunks"""
+    condition = 'sensor_id = ?' if before is None else 'sensor_id = ? AND ts < ?'
+    params = [sensor_id] if before is None else [sensor_id, before]
+    return delete_in_chunks(conn, f'''
+        DELETE FROM readings WHERE id IN (
+            SELECT id FROM readings WHERE {condition} ORDER BY ts LIMIT ?
+        )
+    ''', params)
+
+
+def expire_readings(conn, now):
+    deleted = 0
+    sensors = conn.execute('SELECT id, retention_days FROM sensors').fetchall()
+    for sensor_id, days in sensors:
+        days = RAW_DAYS if days is None else days
+        if days > 0:
+            deleted += delete_sensor_readings(conn, sensor_id, int((now - days * 86400) * 1000))
+    return deleted
+
+
+def expire_rollups(conn, now):
+    deleted = 0
+    for table, _ in rollups.ROLLUPS:
+        days = ROLLUP_DAYS[table]
+        if days > 0:
+            deleted += delete_in_chunks(conn, f'''
+                DELETE FROM {table} WHERE (sensor_id, bucket) IN (
+                    SELECT sensor_id, bucket FROM {table} WHERE bucket < ? LIMIT ?
+                )
+            ''', [int(now - days * 86400)])
+    return deleted
+
+
+def archive_readings(conn, now):
+    """Move the readings of months due for archiving into their archive files.
+
+    Only rows found in the month's archive are deleted from the main database,
+    so readings that arrived after the archive was written stay where they are.
+    Archive files of an older layout are rewritten first.
+    """
+    if migrations.pending(conn):
+        # Archive files are never rewritten, so wait for rows still being migrated
+        return 0
+    converted = shards.convert(conn)
+    if converted:
+        # Readings of these months were hidden until now
+        with conn:
+            cache.bump_all(conn)
+        print(f"Retention: rewrote archived months [{','.join(converted)}] in the current layout")
+    archived = 0
+    for month in shards.months_due(conn, now):
+        shards.archive_month(conn, month)
+        if not os.path.exists(shards.shard_path(conn, month)):
+            continue
+        schema = shards.attach(conn, month)
+        try:
+            archived += delete_in_chunks(conn, f'''
+                DELETE FROM main.readings WHERE id IN (
+                    SELECT r.id FROM main.readings r
+                    WHERE r.ts >= ? AND r.ts < ?
+                      AND EXISTS (SELECT 1 FROM {schema}.readings a WHERE a.id = r.id)
+                    LIMIT ?
+                )
+            ''', shards.month_bounds(month))
+        finally:
+            shards.detach(conn, schema)
+    return archived
+
+
+def drop_archives(conn, now):
+    """Unlink archived months older than every sensor's raw retention"""
+    days = [RAW_DAYS if d is None else d for d, in conn.execute('SELECT retention_days FROM sensors')]
+    if not days or min(days) <= 0:
+        # Some sensor keeps its readings forever
+        return []
+    return shards.drop_before(conn, now - max(days) * 86400)
+
+
+def _database_bytes(conn):
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return page_count * page_size, free_pages * page_size
+
+
+def incremental_vacuum(conn):
+    """Release free pages a few at a time; a no-op unless auto_vacuum is INCREMENTAL"""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+        return
+    while conn.execute('PRAGMA freelist_count').fetchone()[0]:
+        # execute() would stop after the first freed page; a script runs the pragma to the end
+        conn.executescript(f'PRAGMA incremental_vacuum({VACUUM_PAGES});')
+        time.sleep(CHUNK_PAUSE_SECONDS)
+    # Move the vacuumed pages out of the WAL so the file itself shrinks
+    conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+
+def run(conn):
+    """One retention pass; returns and logs what it deleted and reclaimed"""
+    started = time.monotonic()
+    started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    size_before, _ = _database_bytes(conn)
+    now = rollups.now_epoch()
+
+    readings_deleted = expire_readings(conn, now)
+    readings_archived = archive_readings(conn, now)
+    months_dropped = drop_archives(conn, now)
+    rollups_deleted = expire_rollups(conn, now)
+    changed = readings_deleted or readings_archived or months_dropped or rollups_deleted
+    if readings_deleted or readings_archived or rollups_deleted:
+        incremental_vacuum(conn)
+
+    size_after, free_bytes = _database_bytes(conn)
+    report = {
+        "started_at": started_at,
+        "seconds": round(time.monotonic() - started, 3),
+        "readings_deleted": readings_deleted,
+        "readings_archived": readings_archived,
+        "months_dropped": ','.join(months_dropped),
+        "rollups_deleted": rollups_deleted,
+        "bytes_reclaimed": max(size_before - size_after, 0),
+        "free_bytes": free_bytes,
+    }
+    if not changed:
+        return report
+    with conn:
+        conn.execute('''
+            INSERT INTO retention_log (started_at, seconds, readings_deleted, readings_archived,
+                                       months_dropped, rollups_deleted, bytes_reclaimed, free_bytes)
+            VALUES (:started_at, :seconds, :readings_deleted, :readings_archived,
+                    :months_dropped, :rollups_deleted, :bytes_reclaimed, :free_bytes)
+        ''', report)
+        cache.bump_all(conn)
+    print(f"Retention: deleted {readings_deleted} readings and {rollups_deleted} rollup rows, "
+          f"archived {readings_archived} readings, dropped archived months [{report['months_dropped']}], "
+          f"reclaimed {report['bytes_reclaimed']} bytes in {report['seconds']}s")
+    return report
+
+
+def last_runs(conn, limit=10):
+    rows = conn.execute('''
+        SELECT started_at, seconds, readings_deleted, readings_archived, months_dropped,
+               rollups_deleted, bytes_reclaimed, free_bytes
+        FROM retention_log ORDER BY id DESC LIMIT ?
+    ''', (limit,)).fetchall()
+    return [dict(row) for row in rows]
+
+
+def start(interval=INTERVAL_SECONDS, path=None):
+    """Run retention every interval seconds on a daemon thread"""
+    def loop():
+        while True:
+            conn = db.connect(path)
+            try:
+                run(conn)
+            except Exception as e:
+                print(f"Retention run failed: {e}")
+            finally:
+                conn.close()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=loop, name='retention', daemon=True)
+    thread.start()
+    return thread
+
+
+def enable_incremental_vacuum(conn):
+    """Switch an existing database to incremental auto-vacuum; rewrites the whole file"""
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    conn.execute('VACUUM')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Apply retention to sensor readings and rollups')
+    parser.add_argument('--run', action='store_true', help='Run one retention pass now')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='VACUUM the database once so retention can shrink the file')
+    parser.add_argument('--db', default=db.DATABASE, help='Path to the SQLite database')
+
+    args = parser.parse_args()
+    if not args.run and not args.enable_incremental_vacuum:
+        parser.error("nothing to do; pass --run or --enable-incremental-vacuum")
+
+    conn = db.connect(args.db)
+    try:
+        if args.enable_incremental_vacuum:
+            enable_incremental_vacuum(conn)
+            print("Incremental vacuum enabled")
+        if args.run:
+            # The database may not have been opened by this version of the server yet
+            migrations.init_tables(conn.cursor())
+            rollups.init_tables(conn.cursor())
+            init_tables(conn.cursor())
+            cache.init_tables(conn.cursor())
+            conn.commit()
+            run(conn)
+    finally:
+        conn.close()
@@ -0,0 +1,414 @@
+"""Per-sensor time-bucketed aggregates of readings.
+
+readings_1m, readings_1h and readings_1d hold the count, sum, min and max of
+aqi_value and co2_ppm for each sensor and bucket. Buckets are keyed by their
+start as Unix epoch seconds, bucketing the readings' ts (epoch milliseconds,
+see to_ms) by whole seconds. Sums and counts are stored instead of averages so that
+buckets can be merged. Ingestion merges each committed batch in with apply().
+Edits and deletes recompute the buckets they touch with refresh().
+
+Run this module to backfill rollups for data stored before they existed:
+
+    python rollups.py --backfill
+"""
+import argparse
+import datetime
+import math
+import time
+
+import cache
+import db
+import shards
+
+# Rollup tables from finest to coarsest, with their bucket size in seconds
+ROLLUPS = [
+    ('readings_1m', 60),
+    ('readings_1h', 3600),
+    ('readings_1d', 86400),
+]
+
+RESOLUTION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+# Epoch numbers from here up are milliseconds: 1e11 seconds is in the year
+# 5138, 1e11 milliseconds in 1973
+MS_THRESHOLD = 10 ** 11
+# The range datetime, and so ms_to_iso, can show
+_MIN_MS = -62135596800000
+_MAX_MS = 253402300799999
+
+_AGGREGATE_COLUMNS = '''count, aqi_count, aqi_sum, aqi_min, aqi_max,
+                        co2_count, co2_sum, co2_min, co2_max'''
+
+# Aggregates of a set of raw readings, in _AGGREGATE_COLUMNS order
+_RAW_AGGREGATES = '''COUNT(*), COUNT(aqi_value), SUM(aqi_value), MIN(aqi_value), MAX(aqi_value),
+                     COUNT(co2_ppm), SUM(co2_ppm), MIN(co2_ppm), MAX(co2_ppm)'''
+
+# Aggregates of a set of finer rollup rows, in _AGGREGATE_COLUMNS order
+_ROLLUP_AGGREGATES = '''SUM(count), SUM(aqi_count), SUM(aqi_sum), MIN(aqi_min), MAX(aqi_max),
+                        SUM(co2_count), SUM(co2_sum), MIN(co2_min), MAX(co2_max)'''
+
+_RAW_BUCKET = 'ts / 1000'
+
+
+def init_tables(c):
+    for table, _ in ROLLUPS:
+        c.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                sensor_id INTEGER NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                aqi_count INTEGER NOT NULL,
+                aqi_sum REAL,
+                aqi_min REAL,
+                aqi_max REAL,
+                co2_count INTEGER NOT NULL,
+                co2_sum REAL,
+                co2_min REAL,
+                co2_max REAL,
+                PRIMARY KEY (sensor_id, bucket)
+            ) WITHOUT ROWID
+        ''')
+
+
+def parse_resolution(value):
+    """Parse a resolution such as '90', '15m', '1h' or '1d' into seconds"""
+    if value is None or value == '':
+        return None
+    value = str(value).strip().lower()
+    unit = RESOLUTION_UNITS.get(value[-1])
+    number = value[:-1] if unit else value
+    try:
+        seconds = int(float(number) * (unit or 1))
+    except ValueError:
+        raise ValueError(f"Invalid resolution: {value}")
+    if seconds <= 0:
+        raise ValueError("Resolution must be positive")
+    return seconds
+
+
+def choose_rollup(resolution):
+    """Return the coarsest (table, bucket_seconds) that can serve a resolution.
+
+    A rollup can serve a resolution when its buckets divide it evenly, so that
+    its rows can be merged into the requested buckets exactly. Returns None when
+    only the raw readings are fine enough.
+    """
+    chosen = None
+    for table, seconds in ROLLUPS:
+        if resolution >= seconds and resolution % seconds == 0:
+            chosen = (table, seconds)
+    return chosen
+
+
+def to_epoch(timestamp):
+    """Epoch seconds of an ISO timestamp (naive values read as UTC) or epoch number (see to_ms), or None"""
+    if isinstance(timestamp, bool):
+        return None
+    if isinstance(timestamp, (int, float)) or isinstance(timestamp, str) and timestamp.isdigit():
+        ms = _number_ms(timestamp)
+        return None if ms is None else ms // 1000
+    try:
+        dt = datetime.datetime.fromisoformat(str(timestamp))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+
+def to_ms(timestamp):
+    """Epoch milliseconds of an ISO timestamp or epoch number, as stored in readings.ts, or None.
+
+    Numbers are epoch seconds, or epoch milliseconds from MS_THRESHOLD up.
+    Numbers outside the years 1 to 9999 give None.
+    """
+    if isinstance(timestamp, bool):
+        return None
+    if isinstance(timestamp, (int, float)) or isinstance(timestamp, str) and timestamp.isdigit():
+        return _number_ms(timestamp)
+    try:
+        dt = datetime.datetime.fromisoformat(str(timestamp))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    delta = dt - _EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + delta.microseconds // 1000
+
+
+def _number_ms(number):
+    """to_ms of an epoch number, or of a string of digits"""
+    if isinstance(number, str):
+        # Longer strings are out of range anyway
+        if len(number) > 20:
+            return None
+        try:
+            number = int(number)
+        except ValueError:
+            return None
+    if isinstance(number, float) and not math.isfinite(number):
+        return None
+    ms = round(number) if abs(number) >= MS_THRESHOLD else round(number * 1000)
+    return ms if _MIN_MS <= ms <= _MAX_MS else None
+
+
+def now_epoch():
+    """The current time in epoch seconds, whatever the host's time zone"""
+    return int(time.time())
+
+
+def now_ms():
+    """The current time in epoch milliseconds, the stamp of readings sent without a time"""
+    return int(time.time() * 1000)
+
+
+def to_iso(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def ms_to_iso(ms):
+    """ISO timestamp of epoch milliseconds, as the API shows readings.ts"""
+    if ms is None:
+        return None
+    return (_EPOCH + datetime.timedelta(milliseconds=ms)).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+
+
+def ms_sql(column):
+    """SQL converting a column of ISO text or epoch seconds, as readings.timestamp held, to ts"""
+    return f'''CASE
+        WHEN typeof({column}) IN ('integer', 'real') THEN CAST(ROUND({column} * 1000) AS INTEGER)
+        WHEN {column} != '' AND {column} NOT GLOB '*[^0-9]*' THEN CAST({column} AS INTEGER) * 1000
+        ELSE CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)
+    END'''
+
+
+# Merges an inserted aggregate row into an existing bucket
+_ON_CONFLICT = '''
+    ON CONFLICT (sensor_id, bucket) DO UPDATE SET
+        count = count + excluded.count,
+        aqi_count = aqi_count + excluded.aqi_count,
+        aqi_sum = coalesce(aqi_sum + excluded.aqi_sum, aqi_sum, excluded.aqi_sum),
+        aqi_min = min(coalesce(aqi_min, excluded.aqi_min), coalesce(excluded.aqi_min, aqi_min)),
+        aqi_max = max(coalesce(aqi_max, excluded.aqi_max), coalesce(excluded.aqi_max, aqi_max)),
+        co2_count = co2_count + excluded.co2_count,
+        co2_sum = coalesce(co2_sum + excluded.co2_sum, co2_sum, excluded.co2_sum),
+        co2_min = min(coalesce(co2_min, excluded.co2_min), coalesce(excluded.co2_min, co2_min)),
+        co2_max = max(coalesce(co2_max, excluded.co2_max), coalesce(excluded.co2_max, co2_max))
+'''
+
+
+def _merge_sql(table):
+    return f'''
+        INSERT INTO {table} (sensor_id, bucket, {_AGGREGATE_COLUMNS})
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        {_ON_CONFLICT}
+    '''
+
+
+def _add(agg, value, offset):
+    if value is None:
+        return
+    agg[offset] += 1
+    agg[offset + 1] = value if agg[offset + 1] is None else agg[offset + 1] + value
+    if agg[offset + 2] is None or value < agg[offset + 2]:
+        agg[offset + 2] = value
+    if agg[offset + 3] is None or value > agg[offset + 3]:
+        agg[offset + 3] = value
+
+
+def _combine(agg, other):
+    """Merge one row of aggregates, in _AGGREGATE_COLUMNS order, into another"""
+    agg[0] += other[0]
+    for offset in (1, 5):
+        if not other[offset]:
+            continue
+        agg[offset] += other[offset]
+        agg[offset + 1] = other[offset + 1] if agg[offset + 1] is None else agg[offset + 1] + other[offset + 1]
+        if agg[offset + 2] is None or other[offset + 2] < agg[offset + 2]:
+            agg[offset + 2] = other[offset + 2]
+        if agg[offset + 3] is None or other[offset + 3] > agg[offset + 3]:
+            agg[offset + 3] = other[offset + 3]
+
+
+def apply(conn, rows):
+    """Merge newly inserted readings into every rollup.
+
+    rows are (sensor_id, aqi_value, co2_ppm, aqi_category, ts, ...) as inserted.
+    The batch is aggregated in memory first, so each rollup table gets one
+    upsert per touched bucket rather than one per reading.
+    """
+    for table, seconds in ROLLUPS:
+        buckets = {}
+        for sensor_id, aqi_value, co2_ppm, _, ts, *_ in rows:
+            epoch = ts // 1000
+            key = (sensor_id, epoch - epoch % seconds)
+            agg = buckets.get(key)
+            if agg is None:
+                agg = buckets[key] = [0, 0, None, None, None, 0, None, None, None]
+            agg[0] += 1
+            _add(agg, aqi_value, 1)
+            _add(agg, co2_ppm, 5)
+        conn.executemany(_merge_sql(table), [key + tuple(agg) for key, agg in buckets.items()])
+
+
+def refresh(conn, sensor_id, timestamps):
+    """Recompute the buckets of one sensor that contain the given ts values"""
+    epochs = {t // 1000 for t in timestamps if t is not None}
+    source = None
+    for table, seconds in ROLLUPS:
+        for bucket in {e - e % seconds for e in epochs}:
+            conn.execute(f'DELETE FROM {table} WHERE sensor_id = ? AND bucket = ?', (sensor_id, bucket))
+            if source is None:
+                for readings, _ in shards.tables(conn, bucket, bucket + seconds):
+                    conn.execute(f'''
+                        INSERT INTO {table} (sensor_id, bucket, {_AGGREGATE_COLUMNS})
+                        SELECT sensor_id, ?, {_RAW_AGGREGATES}
+                        FROM {readings}
+                        WHERE sensor_id = ? AND ts >= ? AND ts < ?
+                        GROUP BY sensor_id
+                        {_ON_CONFLICT}
+                    ''', (bucket, sensor_id, bucket * 1000, (bucket + seconds) * 1000))
+            else:
+                conn.execute(f'''
+                    INSERT INTO {table} (sensor_id, bucket, {_AGGREGATE_COLUMNS})
+                    SELECT sensor_id, ?, {_ROLLUP_AGGREGATES}
+                    FROM {source}
+                    WHERE sensor_id = ? AND bucket >= ? AND bucket < ?
+                    GROUP BY sensor_id
+                ''', (bucket, sensor_id, bucket, bucket + seconds))
+        source = table
+
+
+def delete_sensor(conn, sensor_id):
+    for table, _ in ROLLUPS:
+        conn.execute(f'DELETE FROM {table} WHERE sensor_id = ?', (sensor_id,))
+
+
+def query(conn, resolution, start, end, sensor_ids=None):
+    """Aggregate readings into resolution-second buckets over [start, end).
+
+    start and end are epoch seconds. Reads the coarsest rollup that can serve
+    the resolution, falling back to raw readings below one minute. From a
+    rollup, the bucket holding start is returned whole, including readings
+    just before start, as the rollup cannot split it. Returns rows
+    of (sensor_id, bucket, count, aqi_avg, aqi_min, aqi_max, co2_avg, co2_min,
+    co2_max) ordered by sensor and bucket.
+    """
+    named = {'res': resolution, 'start': start, 'end': end,
+             'start_ms': start * 1000, 'end_ms': end * 1000,
+             'first_bucket': start // resolution * resolution}
+    sensor_filter = ''
+    if sensor_ids is not None:
+        placeholders = []
+        for i, sensor_id in enumerate(sensor_ids):
+            named[f's{i}'] = sensor_id
+            placeholders.append(f':s{i}')
+        if not placeholders:
+            return []
+        sensor_filter = f"AND sensor_id IN ({','.join(placeholders)})"
+
+    rollup = choose_rollup(resolution)
+    if rollup is None:
+        # Raw readings may be spread over archived months; a bucket's
+        # aggregates from each table are merged before averaging
+        buckets = {}
+        for readings, _ in shards.tables(conn, start, end):
+            for row in conn.execute(f'''
+                SELECT sensor_id, {_RAW_BUCKET} / :res * :res AS b, {_RAW_AGGREGATES}
+                FROM {readings}
+                WHERE ts >= :start_ms AND ts < :end_ms {sensor_filter}
+                GROUP BY sensor_id, b
+            ''', named):
+                agg = buckets.get((row[0], row[1]))
+                if agg is None:
+                    buckets[(row[0], row[1])] = list(row[2:])
+                else:
+                    _combine(agg, row[2:])
+        return [(sensor_id, bucket, agg[0],
+                 agg[2] / agg[1] if agg[1] else None, agg[3], agg[4],
+                 agg[6] / agg[5] if agg[5] else None, agg[7], agg[8])
+                for (sensor_id, bucket), agg in sorted(buckets.items())]
+
+    table, _ = rollup
+    return conn.execute(f'''
+        SELECT sensor_id, bucket / :res * :res AS b,
+               SUM(count), SUM(aqi_sum) / NULLIF(SUM(aqi_count), 0), MIN(aqi_min), MAX(aqi_max),
+               SUM(co2_sum) / NULLIF(SUM(co2_count), 0), MIN(co2_min), MAX(co2_max)
+        FROM {table}
+        WHERE bucket >= :first_bucket AND bucket < :end {sensor_filter}
+        GROUP BY sensor_id, b
+        ORDER BY sensor_id, b
+    ''', named).fetchall()
+
+
+def backfill(conn, sensor_ids=None):
+    """Rebuild every rollup from the raw readings, one sensor at a time.
+
+    A sensor's rollups are rebuilt from the main database in one transaction,
+    then each archived month is merged in with a transaction of its own.
+    """
+    if sensor_ids is None:
+        sensor_ids = [row[0] for row in conn.execute('SELECT id FROM sensors ORDER BY id')]
+
+    total = 0
+    for sensor_id in sensor_ids:
+        with conn:
+            source = None
+            for table, seconds in ROLLUPS:
+                conn.execute(f'DELETE FROM {table} WHERE sensor_id = ?', (sensor_id,))
+                if source is None:
+                    conn.execute(f'''
+                        INSERT INTO {table} (sensor_id, bucket, {_AGGREGATE_COLUMNS})
+                        SELECT sensor_id, {_RAW_BUCKET} / {seconds} * {seconds} AS b, {_RAW_AGGREGATES}
+                        FROM readings
+                        WHERE sensor_id = ? AND ts IS NOT NULL
+                        GROUP BY b
+                    ''', (sensor_id,))
+                else:
+                    conn.execute(f'''
+                        INSERT INTO {table} (sensor_id, bucket, {_AGGREGATE_COLUMNS})
+                        SELECT sensor_id, bucket / {seconds} * {seconds} AS b, {_ROLLUP_AGGREGATES}
+                        FROM {source}
+                        WHERE sensor_id = ?
+                        GROUP BY b
+                    ''', (sensor_id,))
+                source = table
+        for readings, _ in shards.archived(conn):
+            with conn:
+                for table, seconds in ROLLUPS:
+                    conn.execute(f'''
+                        INSERT INTO {table} (sensor_id, bucket, {_AGGREGATE_COLUMNS})
+                        SELECT sensor_id, {_RAW_BUCKET} / {seconds} * {seconds} AS b, {_RAW_AGGREGATES}
+                        FROM {readings}
+                        WHERE sensor_id = ? AND ts IS NOT NULL
+                        GROUP BY b
+                        {_ON_CONFLICT}
+                    ''', (sensor_id,))
+        with conn:
+            cache.bump(conn, [sensor_id])
+        count = conn.execute('SELECT COALESCE(SUM(count), 0) FROM readings_1d WHERE sensor_id = ?',
+                             (sensor_id,)).fetchone()[0]
+        total += count
+        print(f"Sensor {sensor_id}: {count} readings rolled up")
+    return total
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the readings rollup tables')
+    parser.add_argument('--backfill', action='store_true', help='Rebuild rollups from the raw readings')
+    parser.add_argument('--sensor', type=int, action='append', help='Only backfill this sensor ID (repeatable)')
+    parser.add_argument('--db', default=db.DATABASE, help='Path to the SQLite database')
+
+    args = parser.parse_args()
+
+    if args.backfill:
+        conn = db.connect(args.db)
+        init_tables(conn)
+        cache.init_tables(conn)
+        started = time.perf_counter()
+        total = backfill(conn, args.sensor)
+        conn.close()
+        print(f"Backfilled {total} readings in {time.perf_counter() - started:.1f}s")
+    else:
+        parser.print_help()
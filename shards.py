@@ -0,0 +1,353 @@
+"""Monthly archive files of old raw readings.
+
+The main database keeps recent readings. Once a month is ARCHIVE_AFTER_MONTHS
+whole months old, the retention job copies its readings into a file of their
+own, <SHARD_DIR>/readings-YYYY-MM.db, and deletes them from the main database.
+The main file, its backups and its migrations then scale with recent data
+rather than with the whole history. Dropping an archived month is a file
+unlink.
+
+Archive files are never written again, except to be rewritten once when
+their layout changes (see convert) or when a sensor is deleted (see
+delete_sensor). They are made read-only and are attached
+as immutable, memory-mapped databases, so reading them takes no locks. Readers go through tables(), which yields the main readings table and
+the archived months overlapping the requested time range, attaching one
+archive at a time. Readings that arrive for a month after it was archived,
+and each sensor's latest reading, stay in the main database.
+
+Set ARCHIVE_AFTER_MONTHS (default 0, never archive) to enable archiving.
+SHARD_DIR defaults to a directory next to the database.
+
+Command line use:
+
+    python shards.py --list
+"""
+import argparse
+import datetime
+import os
+import re
+import urllib.parse
+
+import db
+
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('ARCHIVE_AFTER_MONTHS', 0))
+SHARD_DIR = os.environ.get('SHARD_DIR')
+
+_FILE = re.compile(r'readings-(\d{4}-\d{2})\.db')
+_SCHEMA_PREFIX = 'archive_'
+
+# Archive files record their layout in user_version; files of an older layout
+# are skipped by readers until the retention job rewrites them (see convert)
+FORMAT = 2
+_CREATE_TABLE = '''
+    CREATE TABLE {schema}.readings (
+        id INTEGER PRIMARY KEY,
+        sensor_id INTEGER,
+        aqi_value REAL,
+        co2_ppm REAL,
+        category_id INTEGER,
+        ts INTEGER
+    )
+'''
+_CREATE_INDEXES = [
+    'CREATE INDEX {schema}.idx_readings_sensor_ts ON readings (sensor_id, ts)',
+    'CREATE INDEX {schema}.idx_readings_ts ON readings (ts)',
+]
+
+
+def month_of(epoch):
+    """'YYYY-MM' of epoch seconds, read as UTC like the rest of the timestamps"""
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime('%Y-%m')
+
+
+def next_month(month):
+    year, number = int(month[:4]), int(month[5:7])
+    return f'{year + number // 12:04d}-{number % 12 + 1:02d}'
+
+
+def month_start(month):
+    """Epoch seconds at the start of a 'YYYY-MM' month"""
+    return int(datetime.datetime(int(month[:4]), int(month[5:7]), 1,
+                                 tzinfo=datetime.timezone.utc).timestamp())
+
+
+def month_bounds(month):
+    """Bounds of a month for "ts >= ? AND ts < ?", in epoch milliseconds"""
+    return month_start(month) * 1000, month_start(next_month(month)) * 1000
+
+
+def shard_dir(conn):
+    """Directory of the connection's archive files, or None for an in-memory database"""
+    if SHARD_DIR:
+        return SHARD_DIR
+    for _, name, path in conn.execute('PRAGMA database_list'):
+        if name == 'main':
+            return os.path.splitext(path)[0] + '-archive' if path else None
+    return None
+
+
+def shard_path(conn, month):
+    return os.path.join(shard_dir(conn), f'readings-{month}.db')
+
+
+def list_months(conn):
+    """Archived months, oldest first"""
+    directory = shard_dir(conn)
+    try:
+        names = os.listdir(directory) if directory else []
+    except FileNotFoundError:
+        return []
+    return sorted(m.group(1) for m in map(_FILE.fullmatch, names) if m)
+
+
+def _format(conn, schema):
+    return conn.execute(f'PRAGMA {schema}.user_version').fetchone()[0]
+
+
+def _attached(conn):
+    return {row[1] for row in conn.execute('PRAGMA database_list')}
+
+
+def attach(conn, month):
+    """Attach an archived month read-only and return its schema name"""
+    schema = _SCHEMA_PREFIX + month.replace('-', '_')
+    if schema not in _attached(conn):
+        path = os.path.abspath(shard_path(conn, month))
+        conn.execute(f'ATTACH DATABASE ? AS {schema}',
+                     (f'file:{urllib.parse.quote(path)}?mode=ro&immutable=1',))
+        conn.execute(f'PRAGMA {schema}.mmap_size = {db.MMAP_SIZE}')
+    return schema
+
+
+def detach(conn, schema):
+    # SQLite refuses to detach a database read by the open transaction; it is
+    # then left attached, to be reused or detached by the next reader
+    if not conn.in_transaction:
+        conn.execute(f'DETACH DATABASE {schema}')
+
+
+def archived(conn, start=None, end=None, newest_first=False):
+    """Yield (table, month) for each archived month overlapping [start, end).
+
+    start and end are epoch seconds, either may be None. Each month is attached
+    just before it is yielded and detached when the caller moves on; close the
+    generator when stopping early.
+    """
+    if not conn.in_transaction:
+        for schema in _attached(conn):
+            if schema.startswith(_SCHEMA_PREFIX):
+                conn.execute(f'DETACH DATABASE {schema}')
+
+    months = [month for month in list_months(conn)
+              if (start is None or month_start(next_month(month)) > start)
+              and (end is None or month_start(month) < end)]
+    if newest_first:
+        months.reverse()
+    for month in months:
+        schema = attach(conn, month)
+        try:
+            if _format(conn, schema) == FORMAT:
+                yield f'{schema}.readings', month
+        finally:
+            detach(conn, schema)
+
+
+def tables(conn, start=None, end=None, newest_first=False):
+    """Yield (table, month) for every readings table overlapping [start, end).
+
+    The main database's table comes with month None, after the archives in
+    oldest-first order and before them in newest-first order. It is always
+    included, as it can hold readings of any month.
+    """
+    if newest_first:
+        yield 'readings', None
+    yield from archived(conn, start, end, newest_first)
+    if not newest_first:
+        yield 'readings', None
+
+
+def months_due(conn, now):
+    """Months with readings in the main database that are old enough to archive"""
+    if ARCHIVE_AFTER_MONTHS <= 0 or shard_dir(conn) is None:
+        return []
+    oldest = conn.execute('SELECT MIN(ts) FROM readings').fetchone()[0]
+    if oldest is None:
+        return []
+    cutoff = month_of(now)
+    for _ in range(ARCHIVE_AFTER_MONTHS):
+        cutoff = month_of(month_start(cutoff) - 1)
+
+    months = []
+    month = month_of(oldest // 1000)
+    while month < cutoff:
+        months.append(month)
+        month = next_month(month)
+    return months
+
+
+def _write(conn, path, fill):
+    """Build an archive file at path; fill(schema) copies rows into schema.readings.
+
+    The file is built under a temporary name and renamed into place once
+    complete, so an archive file is always whole. Returns the rows copied;
+    nothing is written when there are none.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    building = path + '.tmp'
+    if os.path.exists(building):
+        os.unlink(building)
+
+    conn.execute('ATTACH DATABASE ? AS archive_new', (building,))
+    try:
+        # A standalone file with no WAL, synced once before the rename
+        conn.execute('PRAGMA archive_new.journal_mode = DELETE')
+        conn.execute('PRAGMA archive_new.synchronous = OFF')
+        with conn:
+            conn.execute(_CREATE_TABLE.format(schema='archive_new'))
+            copied = fill('archive_new')
+            for sql in _CREATE_INDEXES:
+                conn.execute(sql.format(schema='archive_new'))
+            conn.execute(f'PRAGMA archive_new.user_version = {FORMAT}')
+    finally:
+        conn.execute('DETACH DATABASE archive_new')
+
+    if not copied:
+        os.unlink(building)
+        return 0
+    fd = os.open(building, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.chmod(building, 0o444)
+    os.replace(building, path)
+    return copied
+
+
+def archive_month(conn, month):
+    """Copy a month's readings into its archive file; returns the rows copied.
+
+    Does nothing if the month is already archived. Deleting the copied rows
+    from the main database is left to the caller (see
+    retention.archive_readings).
+    """
+    path = shard_path(conn, month)
+    if os.path.exists(path):
+        return 0
+
+    def fill(schema):
+        # Latest readings stay behind for the sensor_latest triggers
+        return conn.execute(f'''
+            INSERT INTO {schema}.readings
+            SELECT id, sensor_id, aqi_value, co2_ppm, category_id, ts
+            FROM main.readings
+            WHERE ts >= ? AND ts < ?
+              AND id NOT IN (SELECT reading_id FROM main.sensor_latest)
+            ORDER BY ts, id
+        ''', month_bounds(month)).rowcount
+
+    return _write(conn, path, fill)
+
+
+def convert(conn):
+    """Rewrite archive files of an older layout in the current one; returns the months rewritten.
+
+    Files written before timestamps and categories were stored as numbers
+    (migration 3) are converted the same way as the main database's rows.
+    """
+    # Imported here, as rollups reads the archives through this module
+    import rollups
+    converted = []
+    for month in list_months(conn):
+        schema = attach(conn, month)
+        try:
+            if _format(conn, schema) == FORMAT:
+                continue
+
+            def fill(target):
+                conn.execute(f'''
+                    INSERT OR IGNORE INTO main.aqi_categories (name)
+                    SELECT DISTINCT aqi_category FROM {schema}.readings WHERE aqi_category != ''
+                ''')
+                return conn.execute(f'''
+                    INSERT INTO {target}.readings
+                    SELECT id, sensor_id, aqi_value, co2_ppm,
+                           (SELECT id FROM main.aqi_categories WHERE name = aqi_category),
+                           {rollups.ms_sql('timestamp')}
+                    FROM {schema}.readings
+                    ORDER BY id
+                ''').rowcount
+
+            path = shard_path(conn, month)
+            if not _write(conn, path, fill):
+                # An empty month is not written again
+                os.unlink(path)
+            converted.append(month)
+        finally:
+            detach(conn, schema)
+    return converted
+
+
+def delete_sensor(conn, sensor_id):
+    """Rewrite the archived months holding readings of sensor_id without them; returns the months rewritten.
+
+    Otherwise a deleted sensor's history would stay in its archives, to be
+    exported, rolled up again and inherited by a new sensor given its id.
+    """
+    # Files of an older layout would bring the readings back when converted
+    convert(conn)
+    rewritten = []
+    for month in list_months(conn):
+        schema = attach(conn, month)
+        try:
+            if not conn.execute(f'SELECT 1 FROM {schema}.readings WHERE sensor_id = ? LIMIT 1',
+                                (sensor_id,)).fetchone():
+                continue
+
+            def fill(target):
+                return conn.execute(f'''
+                    INSERT INTO {target}.readings
+                    SELECT id, sensor_id, aqi_value, co2_ppm, category_id, ts
+                    FROM {schema}.readings
+                    WHERE sensor_id != ?
+                    ORDER BY ts, id
+                ''', (sensor_id,)).rowcount
+
+            path = shard_path(conn, month)
+            if not _write(conn, path, fill):
+                # The month held no other readings
+                os.unlink(path)
+            rewritten.append(month)
+        finally:
+            detach(conn, schema)
+    return rewritten
+
+
+def drop_before(conn, cutoff):
+    """Unlink archived months that end before epoch seconds cutoff; returns the months dropped"""
+    dropped = []
+    for month in list_months(conn):
+        if month_start(next_month(month)) <= cutoff:
+            os.unlink(shard_path(conn, month))
+            dropped.append(month)
+    return dropped
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='List the archived months of readings')
+    parser.add_argument('--list', action='store_true', help='List archived months with their size')
+    parser.add_argument('--db', default=db.DATABASE, help='Path to the SQLite database')
+
+    args = parser.parse_args()
+    if not args.list:
+        parser.print_help()
+    else:
+        conn = db.connect(args.db)
+        try:
+            print(f"Archive directory: {shard_dir(conn)}")
+            for table, month in archived(conn):
+                count = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                size = os.path.getsize(shard_path(conn, month))
+                print(f"{month}: {count} readings, {size} bytes")
+        finally:
+            conn.close()
@@ -0,0 +1,238 @@
+"""Prometheus metrics for GET /metrics.
+
+Counters and histograms are recorded into a store owned by the calling
+thread, so recording a value takes no lock and costs a few dictionary
+operations. The stores are only added up when the metrics are scraped. When a
+thread ends, its store is folded into a shared total, so a server that starts
+a thread per request keeps a store per running thread. Gauges are callbacks,
+read at scrape time.
+
+Under gunicorn each process keeps its own metrics. Every process, the workers
+and the writer process, saves its totals to METRICS_DIR every DUMP_SECONDS.
+The worker answering /metrics adds them to its own, so the counts cover the
+whole server. Counters of processes that have exited are kept, so they never
+go backwards; their gauges are dropped.
+"""
+import atexit
+import bisect
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+DUMP_SECONDS = float(os.environ.get('METRICS_DUMP_SECONDS', 5))
+
+# Latency histogram bounds in seconds; SQLite statements are mostly well under a millisecond
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_descriptions = {}
+_gauges = []
+# Store number -> {(name, labels): count, or histogram [bucket counts..., overflow, sum]}
+_stores = {}
+# Totals of the stores of threads that have ended
+_retired = {}
+_stores_lock = threading.Lock()
+_store_numbers = itertools.count()
+_local = threading.local()
+
+
+def describe(name, kind, help_text):
+    """Declare a metric's type ('counter', 'gauge' or 'histogram') and help text"""
+    _descriptions[name] = (kind, help_text)
+
+
+def gauge(callback):
+    """Register callback() -> iterable of (name, labels, value), read on every scrape and dump"""
+    _gauges.append(callback)
+    return callback
+
+
+class _Owner:
+    """Kept in a thread's locals only; freed when the thread ends"""
+    __slots__ = ('store', '__weakref__')
+
+
+def _store():
+    # Under gevent's monkey patching threading.local is per greenlet, so each
+    # greenlet gets a store, retired when it finishes
+    try:
+        return _local.owner.store
+    except AttributeError:
+        pass
+    owner = _Owner()
+    owner.store = {}
+    number = next(_store_numbers)
+    with _stores_lock:
+        _stores[number] = owner.store
+    weakref.finalize(owner, _retire, number)
+    _local.owner = owner
+    return owner.store
+
+
+def _retire(number):
+    with _stores_lock:
+        store = _stores.pop(number, None)
+        for key, value in (store or {}).items():
+            _add(_retired, key, value)
+
+
+def inc(name, labels=(), amount=1):
+    """Add to a counter; labels is a tuple of (label, value) pairs"""
+    store = _store()
+    key = (name, labels)
+    store[key] = store.get(key, 0) + amount
+
+
+def observe(name, labels, seconds):
+    """Record a duration into a histogram"""
+    store = _store()
+    key = (name, labels)
+    histogram = store.get(key)
+    if histogram is None:
+        histogram = store[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+    histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+    histogram[-1] += seconds
+
+
+def _add(totals, key, value):
+    current = totals.get(key)
+    if current is None:
+        totals[key] = list(value) if isinstance(value, list) else value
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            current[i] += v
+    else:
+        totals[key] = current + value
+
+
+def snapshot():
+    """This process's metrics as {(name, labels): value}"""
+    totals = {}
+    with _stores_lock:
+        stores = list(_stores.values())
+        for key, value in _retired.items():
+            _add(totals, key, value)
+    for store in stores:
+        # copy() is a single C call, safe against the owning thread adding keys
+        for key, value in store.copy().items():
+            _add(totals, key, value)
+    for callback in _gauges:
+        try:
+            for name, labels, value in callback():
+                _add(totals, (name, labels), value)
+        except Exception as e:
+            print(f"Metrics gauge failed: {e}")
+    return totals
+
+
+def _dump_path(pid):
+    return os.path.join(METRICS_DIR, f'{pid}.json')
+
+
+def dump():
+    """Save this process's totals for the other processes to read"""
+    entries = [[name, list(labels), value] for (name, labels), value in snapshot().items()]
+    path = _dump_path(os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(entries, f, separators=(',', ':'))
+    os.replace(path + '.tmp', path)
+
+
+def start_dumping():
+    """Save totals every DUMP_SECONDS and at exit; a no-op unless METRICS_DIR is set"""
+    if not METRICS_DIR:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(DUMP_SECONDS)
+            try:
+                dump()
+            except OSError as e:
+                print(f"Metrics dump failed: {e}")
+
+    atexit.register(dump)
+    thread = threading.Thread(target=loop, name='metrics', daemon=True)
+    thread.start()
+    return thread
+
+
+def collect():
+    """Totals of this process plus those saved by the other server processes"""
+    totals = snapshot()
+    if not METRICS_DIR:
+        return totals
+    own = os.path.basename(_dump_path(os.getpid()))
+    for filename in os.listdir(METRICS_DIR):
+        if not filename.endswith('.json') or filename == own:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            continue
+        alive = _alive(int(filename[:-len('.json')]))
+        for name, labels, value in entries:
+            # A gauge only means something while its process is running
+            if not alive and _descriptions.get(name, ('',))[0] == 'gauge':
+                continue
+            _add(totals, (name, tuple(tuple(pair) for pair in labels)), value)
+    return totals
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render(totals):
+    """Prometheus text exposition format (version 0.0.4)"""
+    by_name = {}
+    for (name, labels), value in totals.items():
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(by_name):
+        kind, help_text = _descriptions.get(name, ('untyped', None))
+        if help_text:
+            lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name[name], key=lambda item: item[0]):
+            if not isinstance(value, list):
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, value):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels, [("le", bound)])} {cumulative}')
+            cumulative += value[len(BUCKETS)]
+            lines.append(f'{name}_bucket{_labels(labels, [("le", "+Inf")])} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(value[-1])}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
@@ -1,82 +1,207 @@
-import sqlite3
-import matplotlib.pyplot as plt
-import pandas as pd
-import datetime
+"""Offline charts of sensor readings.
+
+Renders one chart per sensor, AQI above CO2, as PNG or SVG files over a time
+window. Sensors are rendered in parallel by a pool of processes, each with
+its own connection and matplotlib's headless Agg backend. Short
+windows plot the raw readings; longer ones plot bucket averages, with their
+min/max range shaded, from the rollups (see rollups.py).
+
+matplotlib and numpy are only imported by the rendering processes, so --list
+does not wait for them.
+
+Command line use:
+
+    python visualize.py --list
+    python visualize.py --sensor 1 --from 2024-05-01 --to 2024-06-01
+    python visualize.py --all --format svg --output reports/
+"""
 import argparse
+import datetime
+import os
 
-def get_sensor_data(sensor_id, limit=100):
-    """Fetch sensor data from the database for visualization"""
-    conn = sqlite3.connect('sensor_data.db')
-    
-    query = f"""
-    SELECT r.value, r.timestamp, s.name 
-    FROM readings r
-    JOIN sensors s ON r.sensor_id = s.id
-    WHERE r.sensor_id = {sensor_id}
-    ORDER BY r.timestamp ASC
-    LIMIT {limit}
-    """
-    
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    
-    # Convert timestamp string to datetime
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    
-    return df
-
-def list_sensors():
+import db
+import rollups
+import shards
+
+FORMATS = ('png', 'svg')
+
+# Windows longer than this are read from the rollups unless --resolution is given
+RAW_MAX_HOURS = float(os.environ.get('VISUALIZE_RAW_MAX_HOURS', 48))
+# About as many buckets as a chart is pixels wide
+MAX_BUCKETS = 1200
+
+# Chart size in inches, at 100 dpi
+FIGURE_SIZE = (12, 6)
+
+
+def list_sensors(path=None):
     """List all sensors in the database"""
-    conn = sqlite3.connect('sensor_data.db')
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT id, name, description FROM sensors")
-    sensors = cursor.fetchall()
-    
-    conn.close()
-    
+    conn = db.connect(path)
+    try:
+        sensors = conn.execute('SELECT id, name, description FROM sensors ORDER BY id').fetchall()
+    finally:
+        conn.close()
+
     print("Available sensors:")
     for sensor in sensors:
         print(f"ID: {sensor[0]}, Name: {sensor[1]}, Description: {sensor[2]}")
 
-def plot_sensor_data(sensor_id, limit=100):
-    """Plot sensor data as a time series"""
-    df = get_sensor_data(sensor_id, limit)
-    
-    if df.empty:
-        print(f"No data found for sensor ID {sensor_id}")
-        return
-    
-    sensor_name = df['name'].iloc[0]
-    
-    plt.figure(figsize=(12, 6))
-    plt.plot(df['timestamp'], df['value'], marker='o', linestyle='-')
-    plt.title(f'Sensor Data: {sensor_name} (ID: {sensor_id})')
-    plt.xlabel('Time')
-    plt.ylabel('Value')
-    plt.grid(True)
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    
-    # Save plot
-    filename = f"sensor_{sensor_id}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.png"
-    plt.savefig(filename)
-    print(f"Plot saved as {filename}")
-    
-    # Show plot
-    plt.show()
+
+def auto_resolution(start, end):
+    """Bucket size in seconds for a window, or None to plot raw readings.
+
+    Buckets are whole multiples of the coarsest rollup below the window's
+    share of MAX_BUCKETS, so one rollup table serves them.
+    """
+    span = end - start
+    if span <= RAW_MAX_HOURS * 3600:
+        return None
+    target = span / MAX_BUCKETS
+    unit = rollups.ROLLUPS[0][1]
+    for _, seconds in rollups.ROLLUPS:
+        if seconds <= target:
+            unit = seconds
+    return max(1, -(-int(target) // unit)) * unit
+
+
+def read_raw(conn, sensor_id, start, end):
+    """(ts, aqi_value, co2_ppm) rows of one sensor over [start, end), oldest first"""
+    rows = []
+    for readings, _ in shards.tables(conn, start, end):
+        rows.extend(conn.execute(f'''
+            SELECT ts, aqi_value, co2_ppm FROM {readings}
+            WHERE sensor_id = ? AND ts >= ? AND ts < ?
+            ORDER BY ts
+        ''', (sensor_id, start * 1000, end * 1000)))
+    # The main database can hold late readings of archived months
+    rows.sort(key=lambda row: row[0])
+    return rows
+
+
+def render(sensor_id, name, start, end, resolution, fmt, output, path=None):
+    """Render one sensor's chart to a file in output; returns its path, or None without data"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import numpy as np
+
+    conn = db.connect(path)
+    try:
+        if resolution:
+            rows = [(bucket * 1000, aqi_avg, aqi_min, aqi_max, co2_avg, co2_min, co2_max)
+                    for _, bucket, _, aqi_avg, aqi_min, aqi_max, co2_avg, co2_min, co2_max
+                    in rollups.query(conn, resolution, start, end, [sensor_id])]
+        else:
+            rows = read_raw(conn, sensor_id, start, end)
+    finally:
+        conn.close()
+    if not rows:
+        return None
+
+    # Missing values become NaN, which leaves gaps in the lines
+    data = np.array(rows, dtype=float)
+    times = data[:, 0].astype('datetime64[ms]')
+
+    fig, (aqi_axis, co2_axis) = plt.subplots(2, 1, sharex=True, figsize=FIGURE_SIZE)
+    # Column of each panel's values; bucket averages are followed by their min and max
+    panels = [(aqi_axis, 'AQI', 1, 'tab:blue'), (co2_axis, 'CO2 (ppm)', 4 if resolution else 2, 'tab:green')]
+    for axis, label, column, color in panels:
+        if resolution:
+            axis.fill_between(times, data[:, column + 1], data[:, column + 2],
+                              color=color, alpha=0.2, linewidth=0)
+        axis.plot(times, data[:, column], color=color, linewidth=1)
+        axis.set_ylabel(label)
+        axis.grid(True)
+
+    window = f'{rollups.to_iso(start)} to {rollups.to_iso(end)} UTC'
+    if resolution:
+        window += f', {resolution}s averages'
+    aqi_axis.set_title(f'Sensor Data: {name} (ID: {sensor_id}), {window}')
+    co2_axis.set_xlabel('Time (UTC)')
+    fig.autofmt_xdate()
+    fig.tight_layout()
+
+    filename = os.path.join(output, f'sensor_{sensor_id}_{_stamp(start)}_{_stamp(end)}.{fmt}')
+    fig.savefig(filename, dpi=100)
+    plt.close(fig)
+    return filename
+
+
+def _stamp(epoch):
+    return datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc).strftime('%Y%m%dT%H%M')
+
+
+def render_all(sensor_ids, start, end, resolution=None, fmt='png', output='.', workers=None, path=None):
+    """Render a chart for each sensor (all sensors when sensor_ids is None) in a process pool.
+
+    Returns the paths written, in sensor order. Sensors without readings in
+    the window are skipped.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    conn = db.connect(path)
+    try:
+        if sensor_ids is None:
+            sensors = conn.execute('SELECT id, name FROM sensors ORDER BY id').fetchall()
+        else:
+            placeholders = ','.join('?' * len(sensor_ids))
+            sensors = conn.execute(
+                f'SELECT id, name FROM sensors WHERE id IN ({placeholders}) ORDER BY id', sensor_ids).fetchall()
+    finally:
+        conn.close()
+
+    found = {sensor_id for sensor_id, _ in sensors}
+    for sensor_id in sensor_ids or ():
+        if sensor_id not in found:
+            print(f"Sensor ID {sensor_id} not found")
+    if not sensors:
+        return []
+
+    os.makedirs(output, exist_ok=True)
+    workers = min(workers or os.cpu_count() or 1, len(sensors))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [(sensor_id, pool.submit(render, sensor_id, name, start, end, resolution, fmt, output, path))
+                   for sensor_id, name in sensors]
+        written = []
+        for sensor_id, future in futures:
+            filename = future.result()
+            if filename is None:
+                print(f"No data found for sensor ID {sensor_id}")
+            else:
+                print(f"Plot saved as {filename}")
+                written.append(filename)
+    return written
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Visualize sensor data')
     parser.add_argument('--list', action='store_true', help='List all available sensors')
-    parser.add_argument('--sensor', type=int, help='Sensor ID to visualize')
-    parser.add_argument('--limit', type=int, default=100, help='Maximum number of readings to fetch')
-    
+    parser.add_argument('--sensor', type=int, action='append', help='Sensor ID to visualize (repeatable)')
+    parser.add_argument('--all', action='store_true', help='Visualize every sensor')
+    parser.add_argument('--from', dest='start', help='Start of the window (ISO timestamp or epoch seconds, default 24 hours before --to)')
+    parser.add_argument('--to', dest='end', help='End of the window, exclusive (ISO timestamp or epoch seconds, default now)')
+    parser.add_argument('--resolution', help=f'Plot bucket averages, e.g. 15m or 1h (default raw readings up to {RAW_MAX_HOURS:g} hours)')
+    parser.add_argument('--format', choices=FORMATS, default='png', help='Image format')
+    parser.add_argument('-o', '--output', default='.', help='Directory to write the charts to')
+    parser.add_argument('--workers', type=int, help='Rendering processes (default one per CPU)')
+    parser.add_argument('--db', default=db.DATABASE, help='Path to the SQLite database')
+
     args = parser.parse_args()
-    
+
     if args.list:
-        list_sensors()
-    elif args.sensor is not None:
-        plot_sensor_data(args.sensor, args.limit)
+        list_sensors(args.db)
+    elif args.sensor or args.all:
+        end = rollups.to_epoch(args.end) if args.end else rollups.now_epoch() + 1
+        start = rollups.to_epoch(args.start) if args.start else (end - 86400 if end is not None else None)
+        if start is None or end is None:
+            parser.error("--from and --to must be ISO timestamps or epoch seconds")
+        if start >= end:
+            parser.error("--from must be before --to")
+        try:
+            resolution = rollups.parse_resolution(args.resolution) or auto_resolution(start, end)
+        except ValueError as e:
+            parser.error(str(e))
+        render_all(None if args.all else args.sensor, start, end, resolution,
+                   args.format, args.output, args.workers, args.db)
     else:
-        parser.print_help() 
\ No newline at end of file
+        parser.print_help()
@@ -0,0 +1,379 @@
+"""Single writer process for running under gunicorn.
+
+SQLite allows one writer at a time, so with several web workers the gunicorn
+master starts one extra process (see gunicorn.conf.py). That process creates
+the schema, runs the migration and retention jobs and owns the write-behind
+queue. Each worker's write-behind thread sends its groups of readings to it
+over a Unix socket, and the writer process group-commits readings from all
+workers together. Workers never contend for the write lock when storing readings.
+
+Readings stored by a worker itself (with INGEST_WRITE_BEHIND=0, or from the
+web forms) are reported to the writer process too. The writer process
+evaluates the alert rules on every committed group, wherever it was stored,
+and relays the group to every worker, whose live hub then publishes it. Each
+worker keeps one connection open to receive them (see WriterClient.listen).
+So every live stream sees every reading, and only once it is committed.
+When the commit of a group fails, the keys of its readings are relayed the
+same way, so that the worker which accepted them forgets them and lets the
+device's retry through.
+
+The gunicorn master checks every WATCH_SECONDS that the writer process is
+running and starts a new one if it exited (see Supervisor). Until it is back,
+workers commit the groups they cannot forward themselves, so readings
+answered with 202 are not dropped. Groups the writer process had already
+received but not yet committed are lost with it.
+
+Each message travels as a length-prefixed JSON array of its kind and its
+rows. The socket is only accessible to the server's user, and its address is
+passed to the workers in the environment, which they inherit from the master.
+"""
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+import dedup
+import ingest
+
+ADDRESS_ENV = 'INGEST_WRITER_ADDRESS'
+START_TIMEOUT = 60
+# A worker that takes longer than this to take a relayed group is cut off;
+# it reconnects and carries on from the next group
+RELAY_TIMEOUT = 5
+# Pause before a worker reconnects to receive relayed groups
+RECONNECT_SECONDS = 1
+# How often the gunicorn master checks that the writer process is running
+WATCH_SECONDS = 1
+# Signals the gunicorn master handles; a writer process it forks later must not
+SIGNALS = ('SIGHUP', 'SIGQUIT', 'SIGUSR1', 'SIGUSR2', 'SIGWINCH', 'SIGTTIN', 'SIGTTOU', 'SIGCHLD')
+
+# Message kinds: rows for the writer process to store, rows that were
+# committed, a request to be sent every committed group, and the
+# (sensor_id, dedup_key) pairs of readings whose commit failed
+SUBMIT = 'submit'
+COMMITTED = 'committed'
+SUBSCRIBE = 'subscribe'
+FAILED = 'failed'
+
+_HEADER = struct.Struct('>I')
+
+
+def start():
+    """Start the writer process and wait until the schema is ready; call before forking workers.
+
+    Returns the writer's pid. A plain fork is used rather than multiprocessing,
+    whose child bookkeeping would be inherited by the gunicorn workers.
+    """
+    address = os.path.join(tempfile.gettempdir(), f'sensor-writer-{os.getpid()}.sock')
+    ready_read, ready_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(ready_read)
+        # A restarted writer process is forked from a master with its signal handlers set
+        signal.set_wakeup_fd(-1)
+        for name in SIGNALS:
+            signal.signal(getattr(signal, name), signal.SIG_DFL)
+        code = 1
+        try:
+            _serve(address, ready_write)
+            code = 0
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+
+    os.close(ready_write)
+    readable, _, _ = select.select([ready_read], [], [], START_TIMEOUT)
+    ready = readable and os.read(ready_read, 1)
+    os.close(ready_read)
+    if not ready:
+        stop(pid, timeout=5)
+        raise RuntimeError("Writer process did not start")
+    os.environ[ADDRESS_ENV] = address
+    return pid
+
+
+def stop(pid, timeout=30):
+    """Ask the writer process to flush its queue and exit"""
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            done, _ = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            # Already reaped by the gunicorn master's SIGCHLD handler
+            return
+        if done:
+            return
+        time.sleep(0.05)
+    os.kill(pid, signal.SIGKILL)
+
+
+def _alive(pid):
+    try:
+        done, _ = os.waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        # Already reaped by the gunicorn master's SIGCHLD handler
+        return False
+    return not done
+
+
+class Supervisor:
+    """Starts the writer process, and starts it again whenever it exits; runs in the gunicorn master"""
+
+    def __init__(self):
+        self.pid = start()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='writer-supervisor', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopping.wait(WATCH_SECONDS):
+            # It may have been stopped by stop() since the last check
+            if _alive(self.pid) or self._stopping.is_set():
+                continue
+            print(f"Writer process {self.pid} exited; starting a new one")
+            try:
+                self.pid = start()
+            except (OSError, RuntimeError) as e:
+                print(f"Writer process could not be started: {e}")
+
+    def stop(self, timeout=30):
+        self._stopping.set()
+        self._thread.join()
+        stop(self.pid, timeout)
+
+
+def _peer_closed(sock):
+    # The writer process never sends on a forwarding connection, so anything
+    # to read means it was closed
+    readable, _, _ = select.select([sock], [], [], 0)
+    return bool(readable)
+
+
+def _recv_exactly(conn, size):
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise EOFError
+        data += chunk
+    return data
+
+
+def _pack(kind, rows):
+    data = json.dumps([kind, rows], separators=(',', ':')).encode()
+    return _HEADER.pack(len(data)) + data
+
+
+def _read_message(conn):
+    """(kind, rows) of the next message; raises EOFError, OSError or ValueError"""
+    size, = _HEADER.unpack(_recv_exactly(conn, _HEADER.size))
+    kind, rows = json.loads(_recv_exactly(conn, size))
+    return kind, rows
+
+
+class Relay:
+    """The workers' connections that committed groups are relayed to"""
+
+    def __init__(self):
+        self._conns = set()
+        self._lock = threading.Lock()
+
+    def add(self, conn):
+        with self._lock:
+            self._conns.add(conn)
+
+    def discard(self, conn):
+        with self._lock:
+            self._conns.discard(conn)
+
+    def publish(self, rows):
+        self._send(_pack(COMMITTED, [list(row[:5]) for row in rows]))
+
+    def failed(self, rows):
+        pairs = dedup.row_keys(rows)
+        if pairs:
+            self._send(_pack(FAILED, pairs))
+
+    def _send(self, data):
+        with self._lock:
+            conns = list(self._conns)
+        for conn in conns:
+            try:
+                conn.sendall(data)
+            except OSError:
+                # Part of the message may have gone out; the worker has to start over
+                self.discard(conn)
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def _wait_closed(conn):
+    while True:
+        try:
+            if not conn.recv(1):
+                return
+        except socket.timeout:
+            continue
+        except OSError:
+            return
+
+
+def _receive(conn, submit, committed, relay):
+    with conn:
+        while True:
+            try:
+                kind, rows = _read_message(conn)
+            except (EOFError, OSError, ValueError):
+                return
+            if kind == SUBSCRIBE:
+                conn.settimeout(RELAY_TIMEOUT)
+                relay.add(conn)
+                try:
+                    _wait_closed(conn)
+                finally:
+                    relay.discard(conn)
+                return
+            if kind == COMMITTED:
+                committed(rows)
+                continue
+            # Hold the sending worker back until there is room
+            while True:
+                try:
+                    submit(rows)
+                    break
+                except ingest.QueueFullError:
+                    time.sleep(0.05)
+
+
+def _serve(address, ready_fd):
+    # Write locally: this is the process the others forward to
+    os.environ.pop(ADDRESS_ENV, None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    import main
+    import migrations
+    import retention
+    relay = Relay()
+    main.hub.add_listener(relay.publish)
+    main.writer.on_failure = relay.failed
+    main.init_db()
+    migrations.start()
+    retention.start()
+
+    if os.path.exists(address):
+        os.unlink(address)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        listener.bind(address)
+    finally:
+        os.umask(old_umask)
+    listener.listen(64)
+    os.write(ready_fd, b'1')
+    os.close(ready_fd)
+    print(f"Writer process {os.getpid()} listening on {address}")
+    try:
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                continue
+            threading.Thread(target=_receive, args=(conn, main.writer.submit, main.readings_committed, relay),
+                             daemon=True).start()
+    finally:
+        listener.close()
+        os.unlink(address)
+        main.writer.stop()
+
+
+class WriterClient:
+    """Talks to the writer process from a worker; enabled when its address is set"""
+
+    def __init__(self):
+        self.address = os.environ.get(ADDRESS_ENV)
+        self._sock = None
+        # Forwarded groups come from the write-behind thread, committed ones from requests
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.address is not None
+
+    def send(self, rows):
+        """Hand rows to the writer process to store"""
+        self._send(_pack(SUBMIT, rows))
+
+    def committed(self, rows):
+        """Report rows this worker stored, for the alerts and every worker's live streams"""
+        self._send(_pack(COMMITTED, [list(row[:5]) for row in rows]))
+
+    def _send(self, data):
+        with self._lock:
+            try:
+                if self._sock is not None and _peer_closed(self._sock):
+                    # The writer process exited; a new one may be listening
+                    self._sock.close()
+                    self._sock = None
+                if self._sock is None:
+                    self._sock = self._connect()
+                self._sock.sendall(data)
+            except OSError:
+                # Reconnect on the next message; this one is reported as failed
+                if self._sock is not None:
+                    self._sock.close()
+                    self._sock = None
+                raise
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def listen(self, publish, discard_keys=None):
+        """Call publish(rows) with every committed group the writer process relays, from a thread.
+
+        discard_keys(pairs), if given, is called with the (sensor_id,
+        dedup_key) pairs of every group whose commit failed. Start it in each
+        worker after the fork. Messages relayed while the connection is down
+        are missed.
+        """
+        def loop():
+            while True:
+                try:
+                    with self._connect() as sock:
+                        sock.sendall(_pack(SUBSCRIBE, []))
+                        while True:
+                            kind, rows = _read_message(sock)
+                            if kind == FAILED:
+                                if discard_keys is not None:
+                                    discard_keys([tuple(pair) for pair in rows])
+                                continue
+                            publish(rows)
+                except (EOFError, OSError, ValueError):
+                    pass
+                time.sleep(RECONNECT_SECONDS)
+
+        thread = threading.Thread(target=loop, name='relay', daemon=True)
+        thread.start()
+        return thread